@@ -0,0 +1,156 @@
+'''Бенчмарк масштабирования cluster.py: сценарий записи на прием при разном числе воркеров.
+
+Запускает фронт кластера (cluster.Cluster) с N воркерами, у которых Bot подменен заглушкой
+(bench/stub_bot.py), и прогоняет через фронт сценарий записи тех же чатов, что и bench/load_test.py:
+
+    "Записаться на прием" -> имя -> телефон -> дата в календаре -> время -> "да"
+
+Для каждого N из --workers выводит время, число записей и апдейтов в секунду и ускорение относительно
+первого N. Все прогоны пишут в одну временную базу SQLite, у каждого прогона свои чаты и даты.
+Ускорение ограничено числом ядер (os.cpu_count()) и одной блокировкой записи SQLite на все процессы.
+
+Запуск из корня проекта:
+    python -m bench.cluster --workers 1 2 4 --chats 1000
+'''
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+if '--worker' not in sys.argv:  # Воркеры получают окружение (и путь к базе) от фронта
+    _workdir = tempfile.mkdtemp(prefix='bench_')
+    os.environ['DB_LITE'] = f"sqlite+aiosqlite:///{os.path.join(_workdir, 'bench.db')}"
+    os.environ.setdefault('TOKEN', '42:BENCHMARK')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('THROTTLE', '0')  # Сценарии шлют апдейты без пауз - ограничение частоты их бы отсекло
+
+from sqlalchemy import func, select  # noqa: E402
+
+import cluster  # noqa: E402
+from bench.stub_bot import make_stub_bot  # noqa: E402
+from db.engine import create_db, session_maker  # noqa: E402
+from db.models import User  # noqa: E402
+from db.orm_query import orm_change_banner_image  # noqa: E402
+from db.write_queue import write_queue  # noqa: E402
+from kbrd.inline import CalendarCallBack  # noqa: E402
+
+
+class Chat:
+    """Симуляция одного чата: апдейты в виде словарей, как их получает фронт кластера."""
+
+    def __init__(self, chat_id: int, update_ids) -> None:
+        self.chat_id = chat_id
+        self.update_ids = update_ids
+        self.user = {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}
+        self.chat = {'id': chat_id, 'type': 'private'}
+
+    def message(self, text: str) -> dict:
+        update_id = next(self.update_ids)
+        return {'update_id': update_id, 'message': {'message_id': update_id, 'date': int(time.time()),
+                                                    'chat': self.chat, 'from': self.user, 'text': text}}
+
+    def callback(self, data: str) -> dict:
+        update_id = next(self.update_ids)
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'chat_instance': str(self.chat_id), 'from': self.user, 'data': data,
+            'message': {'message_id': 1, 'date': int(time.time()), 'chat': self.chat, 'text': 'menu'}}}
+
+    def pick_date(self, day: date) -> dict:
+        return self.callback(CalendarCallBack(action='day', year=day.year, month=day.month, day=day.day).pack())
+
+
+async def run_once(workers: int, run: int, args, update_ids) -> dict:
+    """Прогоняет сценарий записи через кластер из workers воркеров."""
+    acks: dict[int, asyncio.Future] = {}
+
+    def on_ack(update_id: int) -> None:
+        future = acks.pop(update_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def feed(update: dict) -> None:
+        future = acks[update['update_id']] = asyncio.get_running_loop().create_future()
+        await group.route(update)
+        await future
+
+    group = cluster.Cluster(workers, worker_args=[sys.executable, '-m', 'bench.cluster',
+                                                  '--api-latency', str(args.api_latency)], on_ack=on_ack)
+    group.start()
+    # Прогрев: каждый воркер должен запуститься и обработать апдейт до начала замера
+    await asyncio.gather(*(feed(Chat(index, update_ids).message('/start')) for index in range(1, workers + 1)))
+
+    base = 1_000_000 * (run + 1)
+    first_day = date.today() + timedelta(days=1 + run * args.chats)
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def scenario(index: int) -> None:
+        chat = Chat(base + index, update_ids)
+        async with limit:
+            for update in (chat.callback('menu:make an appoint:1'), chat.message(f'Пользователь {index}'),
+                           chat.message(f'8{9_000_000_000 + base + index}'),
+                           chat.pick_date(first_day + timedelta(days=index)), chat.message('1'),
+                           chat.message('да')):
+                await feed(update)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(scenario(index) for index in range(args.chats)))
+    elapsed = time.perf_counter() - started
+    stats = group.stats()
+    await group.stop()
+
+    async with session_maker() as session:
+        booked = (await session.execute(
+            select(func.count()).select_from(User).where(User.chat_id >= base, User.chat_id < base + args.chats)
+        )).scalar()
+    return {'workers': workers, 'elapsed_s': round(elapsed, 3), 'booked': booked,
+            'bookings_per_s': round(booked / elapsed, 1), 'updates_per_s': round(6 * args.chats / elapsed, 1),
+            'restarts': sum(worker['restarts'] for worker in stats)}
+
+
+async def run(args) -> list[dict]:
+    # У каждого прогона свои даты - календарь воркеров должен их принимать
+    os.environ['CALENDAR_MONTHS_AHEAD'] = str((len(args.workers) * args.chats + 1) // 28 + 2)
+    await create_db()
+    for page in ('main', 'about'):  # В свежей базе у баннеров нет изображения
+        await orm_change_banner_image(page, f'bench-{page}')
+    await write_queue.close()
+    update_ids = iter(range(1, 10 ** 9))
+    return [await run_once(workers, run_index, args, update_ids) for run_index, workers in enumerate(args.workers)]
+
+
+def print_report(results: list[dict]) -> None:
+    print(f"Ядер: {os.cpu_count()}")
+    print(f"{'воркеров':>8} {'время, с':>9} {'записей':>8} {'записей/с':>10} {'апдейтов/с':>11} {'ускорение':>10}")
+    for result in results:
+        speedup = result['bookings_per_s'] / max(results[0]['bookings_per_s'], 1e-9)
+        print(f"{result['workers']:>8} {result['elapsed_s']:>9} {result['booked']:>8} {result['bookings_per_s']:>10} "
+              f"{result['updates_per_s']:>11} {speedup:>10.2f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='число воркеров в прогонах')
+    parser.add_argument('--chats', type=int, default=1000, help='число симулируемых чатов в прогоне')
+    parser.add_argument('--concurrency', type=int, default=200, help='сколько чатов проходят сценарий одновременно')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='задержка ответа заглушки Bot API, мс')
+    parser.add_argument('--worker', type=int, help='номер воркера (задает фронт при запуске процесса)')
+    parser.add_argument('--json', help='сохранить отчет в JSON-файл')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    if arguments.worker is not None:
+        # Процесс-воркер: parse_args разбирает и номер воркеров кластера (--workers N)
+        cluster.worker_main(arguments.worker, arguments.workers[0], make_stub_bot(arguments.api_latency / 1000))
+        sys.exit(0)
+    result = asyncio.run(run(arguments))
+    print_report(result)
+    if arguments.json:
+        with open(arguments.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if any(item['booked'] < arguments.chats for item in result) else 0)
@@ -0,0 +1,95 @@
+'''Микробенчмарк клавиатур: сборка на каждый апдейт против реестра kbrd.registry.
+
+Сравнивает для одного апдейта:
+
+    меню:       InlineKeyboardBuilder + упаковка трех MenuCallBack   vs  готовая USER_MAIN_KB
+    reply:      ReplyKeyboardBuilder для клавиатуры администратора    vs  get_keyboard из реестра
+    фильтр:     MenuCallBack.filter() (разбор строки)                 vs  keyboards.filter(MenuCallBack)
+    календарь:  CalendarCallBack.filter()                             vs  keyboards.filter(CalendarCallBack)
+
+Запуск из корня проекта:
+    python -m bench.keyboards --number 20000
+'''
+import argparse
+import asyncio
+import time
+from datetime import date
+
+from aiogram.types import CallbackQuery, InlineKeyboardButton, KeyboardButton, User
+from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
+
+from kbrd.inline import USER_MAIN_KB, CalendarCallBack, MenuCallBack, get_calendar_btns
+from kbrd.registry import keyboards
+from kbrd.reply import get_keyboard
+
+MENU_BTNS = {
+    "Записаться на прием ✐": 'make an appoint',
+    'О нас ✋': 'about',
+    'Получить список 📝': 'view_app',
+}
+ADMIN_BTNS = ("Добавить/Изменить баннер", "Статистика кэша", "Рассылка", "Остановить рассылку")
+
+
+def build_menu():
+    keyboard = InlineKeyboardBuilder()
+    for text, menu_name in MENU_BTNS.items():
+        keyboard.add(InlineKeyboardButton(text=text, callback_data=MenuCallBack(menu_name=menu_name).pack()))
+    return keyboard.adjust(2, 1).as_markup()
+
+
+def build_reply():
+    keyboard = ReplyKeyboardBuilder()
+    for text in ADMIN_BTNS:
+        keyboard.add(KeyboardButton(text=text))
+    return keyboard.adjust(2).as_markup(resize_keyboard=True, input_field_placeholder="Выберите действие")
+
+
+def per_call(func, number: int) -> float:
+    """Среднее время вызова func в микросекундах."""
+    started = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - started) / number * 1e6
+
+
+async def per_filter_call(flt, query: CallbackQuery, number: int) -> float:
+    """Среднее время проверки фильтра в микросекундах."""
+    assert await flt(query)
+    started = time.perf_counter()
+    for _ in range(number):
+        await flt(query)
+    return (time.perf_counter() - started) / number * 1e6
+
+
+def query(data: str) -> CallbackQuery:
+    return CallbackQuery(id='1', chat_instance='1', from_user=User(id=1, is_bot=False, first_name='bench'), data=data)
+
+
+async def main(number: int) -> list[tuple[str, float, float]]:
+    today = date.today()
+    get_calendar_btns(today.year, today.month, full_days=set(), today=today)  # Кнопки календаря в реестре
+    menu_query = query(MenuCallBack(menu_name='about').pack())
+    day_query = query(CalendarCallBack(action='day', year=today.year, month=today.month, day=28).pack())
+    return [
+        ('меню (сборка клавиатуры)', per_call(build_menu, number), per_call(lambda: USER_MAIN_KB, number)),
+        ('reply-клавиатура', per_call(build_reply, number),
+         per_call(lambda: get_keyboard(*ADMIN_BTNS, placeholder="Выберите действие", sizes=(2,)), number)),
+        ('фильтр MenuCallBack', await per_filter_call(MenuCallBack.filter(), menu_query, number),
+         await per_filter_call(keyboards.filter(MenuCallBack), menu_query, number)),
+        ('фильтр CalendarCallBack', await per_filter_call(CalendarCallBack.filter(), day_query, number),
+         await per_filter_call(keyboards.filter(CalendarCallBack), day_query, number)),
+    ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=20000, help='Повторов каждого замера')
+    args = parser.parse_args()
+
+    rows = asyncio.run(main(args.number))
+    print(f"{'операция':<28}{'сборка, мкс':>14}{'реестр, мкс':>14}{'экономия, мкс':>16}")
+    for name, before, after in rows:
+        print(f"{name:<28}{before:>14.2f}{after:>14.2f}{before - after:>16.2f}")
+    # Нажатие кнопки меню: разбор callback_data и клавиатура для ответа
+    saved = rows[0][1] + rows[2][1] - rows[0][2] - rows[2][2]
+    print(f"\nНажатие кнопки меню: экономия {saved:.1f} мкс на апдейт")
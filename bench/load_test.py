@@ -0,0 +1,236 @@
+'''Нагрузочный тест сценариев записи на прием без обращения к Telegram.
+
+Собирает настоящий диспетчер бота (main.dp с роутерами из main.include_routers и мидлварями
+из main.register_middlewares), подменяет Bot заглушкой, которая записывает исходящие вызовы,
+и прогоняет через dp.feed_update сценарии N одновременных чатов на временной базе SQLite:
+
+    запись:    "Записаться на прием" -> имя -> телефон -> дата в календаре -> время -> "да"
+    изменение: "Получить список" -> телефон -> 1 -> номер заявки -> новая дата в календаре -> время -> "да"
+    удаление:  "Получить список" -> телефон -> 2 -> номер заявки
+
+Результат: пропускная способность, p50/p95/p99 по обработчикам, число запросов к базе на одну
+успешную запись и пиковый RSS процесса.
+
+Запуск из корня проекта:
+    python -m bench.load_test --chats 2000 --concurrency 500
+'''
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+# Окружение нужно задать до импорта модулей бота: движок базы создается при импорте db.engine
+_workdir = tempfile.mkdtemp(prefix='bench_')
+os.environ['DB_LITE'] = f"sqlite+aiosqlite:///{os.path.join(_workdir, 'bench.db')}"
+os.environ.setdefault('TOKEN', '42:BENCHMARK')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('THROTTLE', '0')  # Сценарии шлют апдейты без пауз - ограничение частоты их бы отсекло
+
+from aiogram import types  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+import main  # noqa: E402
+from bench.stub_bot import make_stub_bot  # noqa: E402
+from db.banner_cache import banner_cache  # noqa: E402
+from db.engine import create_db, engine, session_maker  # noqa: E402
+from db.orm_query import orm_change_banner_image  # noqa: E402
+from db.write_queue import write_queue  # noqa: E402
+from kbrd import inline  # noqa: E402
+from kbrd.inline import CalendarCallBack  # noqa: E402
+
+
+class HandlerTimer:
+    """
+    Мидлвар, который замеряет время выполнения каждого обработчика (вместе с внутренними мидлварями).
+    """
+
+    def __init__(self) -> None:
+        self.samples = defaultdict(list)
+
+    async def __call__(self, handler, event, data):
+        name = data['handler'].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.samples[name].append(time.perf_counter() - started)
+
+
+class QueryCounter:
+    """Счетчик SQL-запросов движка."""
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+class Chat:
+    """Симуляция одного чата: собирает апдейты от имени пользователя."""
+
+    _update_ids = itertools.count(1)
+
+    def __init__(self, chat_id: int) -> None:
+        self.chat_id = chat_id
+        self.user = types.User(id=chat_id, is_bot=False, first_name=f'user{chat_id}')
+        self.chat = types.Chat(id=chat_id, type='private')
+
+    def message(self, text: str) -> types.Update:
+        update_id = next(self._update_ids)
+        return types.Update(update_id=update_id, message=types.Message(
+            message_id=update_id, date=datetime.now(), chat=self.chat, from_user=self.user, text=text))
+
+    def pick_date(self, day: date) -> types.Update:
+        return self.callback(CalendarCallBack(action='day', year=day.year, month=day.month, day=day.day).pack())
+
+    def callback(self, data: str) -> types.Update:
+        update_id = next(self._update_ids)
+        return types.Update(update_id=update_id, callback_query=types.CallbackQuery(
+            id=str(update_id), chat_instance=str(self.chat_id), from_user=self.user, data=data,
+            message=types.Message(message_id=1, date=datetime.now(), chat=self.chat, text='menu')))
+
+
+def percentile(sorted_values: list, share: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * share))]
+
+
+async def run(args) -> dict:
+    inline.CALENDAR_MONTHS_AHEAD = (2 * args.days + 1) // 28 + 2  # Календарь должен принимать даты изменений
+    await create_db()
+    async with session_maker() as session:
+        for page in ('main', 'about'):  # В свежей базе у баннеров нет изображения
+            await orm_change_banner_image(page, f'bench-{page}')
+        await banner_cache.warm(session)
+
+    dp = main.dp
+    timer = HandlerTimer()
+    dp.message.middleware(timer)  # Регистрируется первым, чтобы учитывать и время мидлварей
+    dp.callback_query.middleware(timer)
+    main.include_routers(dp)
+    main.register_middlewares(dp)
+    queries = QueryCounter()
+    event.listen(engine.sync_engine, 'before_cursor_execute', queries)
+
+    bot = make_stub_bot(args.api_latency / 1000)
+    limit = asyncio.Semaphore(args.concurrency)
+    errors = defaultdict(int)
+    completed = defaultdict(int)
+    first_day = date.today() + timedelta(days=1)
+
+    async def feed(update: types.Update) -> bool:
+        try:
+            await dp.feed_update(bot, update)
+            return True
+        except Exception as e:
+            errors[type(e).__name__] += 1
+            return False
+
+    async def scenario(index: int) -> None:
+        chat = Chat(10_000 + index)
+        phone = f'8{9_000_000_000 + index}'
+        day = first_day + timedelta(days=index % args.days)
+        async with limit:
+            steps = [chat.callback('menu:make an appoint:1'), chat.message(f'Пользователь {index}'),
+                     chat.message(phone), chat.pick_date(day), chat.message('1'),
+                     chat.message('да')]
+            for update in steps:
+                if not await feed(update):
+                    return
+            completed['booking'] += 1
+
+            share = (index % 100) / 100
+            if share < args.change_share:
+                new_day = day + timedelta(days=args.days)
+                steps = [chat.callback('menu:view_app:1'), chat.message(phone), chat.message('1'),
+                         chat.message('1'), chat.pick_date(new_day), chat.message('1'),
+                         chat.message('да')]
+                flow = 'change'
+            elif share < args.change_share + args.delete_share:
+                steps = [chat.callback('menu:view_app:1'), chat.message(phone), chat.message('2'),
+                         chat.message('1')]
+                flow = 'delete'
+            else:
+                return
+            for update in steps:
+                if not await feed(update):
+                    return
+            completed[flow] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(scenario(index) for index in range(args.chats)))
+    elapsed = time.perf_counter() - started
+    await dp.storage.close()
+    await write_queue.close()
+
+    updates = sum(len(samples) for samples in timer.samples.values())
+    handlers = {}
+    for name, samples in sorted(timer.samples.items()):
+        samples.sort()
+        handlers[name] = {'count': len(samples),
+                          'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+                          'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+                          'p99_ms': round(percentile(samples, 0.99) * 1000, 3)}
+    return {
+        'chats': args.chats,
+        'concurrency': args.concurrency,
+        'elapsed_s': round(elapsed, 3),
+        'completed': dict(completed),
+        'errors': dict(errors),
+        'bookings_per_s': round(completed['booking'] / elapsed, 1),
+        'updates_per_s': round(updates / elapsed, 1),
+        'db_queries': queries.count,
+        'db_queries_per_booking': round(queries.count / max(completed['booking'], 1), 2),
+        'write_queue': write_queue.stats(),
+        'bot_calls': dict(bot.session.calls),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'handlers': handlers,
+    }
+
+
+def print_report(report: dict) -> None:
+    print(f"Чатов: {report['chats']}, одновременно: {report['concurrency']}, время: {report['elapsed_s']} с")
+    print(f"Завершено: {report['completed']}, ошибки: {report['errors'] or 'нет'}")
+    print(f"Записей в секунду: {report['bookings_per_s']}, апдейтов в секунду: {report['updates_per_s']}")
+    print(f"Запросов к БД: {report['db_queries']} ({report['db_queries_per_booking']} на запись)")
+    print(f"Очередь записи: {report['write_queue']}")
+    print(f"Вызовов Bot API: {sum(report['bot_calls'].values())} {report['bot_calls']}")
+    print(f"Пиковый RSS: {report['peak_rss_mb']} МБ")
+    print(f"\n{'обработчик':32} {'вызовов':>8} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    for name, stats in report['handlers'].items():
+        print(f"{name:32} {stats['count']:>8} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chats', type=int, default=1000, help='число симулируемых чатов')
+    parser.add_argument('--concurrency', type=int, default=200, help='сколько чатов проходят сценарий одновременно')
+    parser.add_argument('--days', type=int, default=None,
+                        help='на сколько дат распределять записи (меньше - больше конкуренции за слоты)')
+    parser.add_argument('--change-share', type=float, default=0.1, help='доля чатов, которые затем меняют запись')
+    parser.add_argument('--delete-share', type=float, default=0.1, help='доля чатов, которые затем удаляют запись')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='задержка ответа заглушки Bot API, мс')
+    parser.add_argument('--json', help='сохранить отчет в JSON-файл')
+    args = parser.parse_args(argv)
+    if args.days is None:
+        args.days = args.chats  # По умолчанию у каждого чата своя дата - без конфликтов за слоты
+    return args
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    result = asyncio.run(run(arguments))
+    print_report(result)
+    if arguments.json:
+        with open(arguments.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if result['errors'] else 0)
@@ -0,0 +1,63 @@
+# Заглушка Telegram Bot API для нагрузочных тестов: запросы не отправляются, а записываются
+import asyncio
+import itertools
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Any, AsyncGenerator, Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import Chat, Message, User
+
+
+class RecordingSession(BaseSession):
+    """
+    Сессия aiogram, которая вместо HTTP-запросов к Telegram записывает вызовы и возвращает
+    правдоподобные ответы (Message для отправки сообщений, True для остальных методов).
+
+    :param latency: Искусственная задержка ответа "Telegram" в секундах.
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()  # Имя метода -> количество вызовов
+        self.sent: list = []  # (время, имя метода, chat_id)
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        name = type(method).__name__
+        chat_id = getattr(method, 'chat_id', None)
+        self.calls[name] += 1
+        self.sent.append((time.perf_counter(), name, chat_id))
+
+        if name == 'GetMe':
+            return User(id=bot.id, is_bot=True, first_name='bench', username='bench_bot')
+        if chat_id is not None or name.startswith(('Send', 'Edit', 'Copy', 'Forward')):
+            return Message(message_id=next(self._message_ids), date=datetime.now(),
+                           chat=Chat(id=chat_id or 0, type='private'),
+                           text=getattr(method, 'text', None), caption=getattr(method, 'caption', None))
+        return True
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        yield b''
+
+    async def close(self) -> None:
+        pass
+
+
+def make_stub_bot(latency: float = 0.0) -> Bot:
+    """
+    Создает бота с записывающей сессией.
+
+    :param latency: Искусственная задержка ответа "Telegram" в секундах.
+    :return: Экземпляр Bot, сессия доступна как bot.session.
+    """
+    bot = Bot(token='42:BENCHMARK', session=RecordingSession(latency))
+    bot.a_admins_list = []
+    return bot
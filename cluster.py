@@ -0,0 +1,485 @@
+# Запуск бота в нескольких процессах: фронт получает апдейты и распределяет их по воркерам по chat_id
+'''Многопроцессный режим бота.
+
+Один процесс (фронт) получает апдейты от Telegram - long polling или вебхуком, как main.py - и передает
+каждый апдейт воркеру abs(chat_id) % N. Все апдейты одного чата обрабатывает один и тот же воркер, поэтому
+состояние FSM, ограничение частоты и очередь исходящих сообщений чата остаются локальными для процесса,
+как в однопроцессном режиме. Воркеры - обычные процессы бота (диспетчер, мидлвари и on_startup
+из main.py), работают с одной базой SQLite в режиме WAL с настройками db.engine_profile; каждый пишет
+через свою очередь записи, одновременные транзакции разных процессов ждут друг друга (busy_timeout).
+
+Обмен фронта и воркера идет строками через stdin/stdout воркера (логи воркер пишет в stderr и в свои файлы
+logs/*.workerN.log):
+    u<JSON апдейта>  - фронт -> воркер: апдейт для обработки;
+    a<update_id>     - воркер -> фронт: апдейт обработан;
+    e<JSON события>  - изменение индекса слотов, брони слота или кэша баннеров, запуск или остановка
+                       рассылки; фронт пересылает его остальным воркерам.
+
+Фронт перезапускает упавший воркер (с растущей паузой, если он падает сразу после запуска) и заново
+доставляет ему неподтвержденные апдейты. Общий лимит исходящих сообщений (OUTBOUND_RATE) делится поровну
+между воркерами, напоминания и рассылки каждый воркер выполняет для своих чатов: рассылка, запущенная
+в одном воркере, идет во всех одновременно и в сумме использует весь лимит.
+
+Запуск из корня проекта (число воркеров - WORKERS или --workers, по умолчанию по числу ядер):
+    python -m cluster --workers 4
+'''
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+from collections import deque
+from datetime import date
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import GetUpdates
+from aiohttp import web
+
+import main
+from db.archive import archiver
+from db.banner_cache import banner_cache
+from db.broadcast import broadcaster
+from db.engine import create_db
+from db.reminders import reminders
+from db.slot_hold import slot_holds
+from db.slot_index import slot_index
+from logging_config import setup_logging
+
+# Настройка логгирования
+app_logger = setup_logging("cluster", "logs/main.log")
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MAX_LINE = 16 * 1024 * 1024  # Максимальная длина строки протокола (апдейт целиком)
+RESTART_DELAY_MAX = 30.0  # Максимальная пауза перед перезапуском воркера, с
+STABLE_UPTIME = 60.0  # Воркер, проработавший дольше, после падения перезапускается без паузы
+MAX_ATTEMPTS = 2  # Сколько раз апдейт доставляется воркерам: апдейт, роняющий процесс, не зациклит перезапуски
+
+
+def shard_of(chat_id: int | None, count: int) -> int:
+    """
+    Возвращает номер воркера, который обслуживает чат.
+
+    :param chat_id: ID чата (None - апдейт без чата, его обрабатывает воркер 0).
+    :param count: Число воркеров.
+    :return: Номер воркера от 0 до count - 1.
+    """
+    return abs(chat_id) % count if chat_id else 0
+
+
+def update_chat_id(update: dict) -> int | None:
+    """
+    Возвращает chat_id апдейта, не разбирая его в объекты aiogram.
+
+    Для колбэков берется чат сообщения с кнопкой (как в ключе FSM), для событий без чата - id пользователя.
+
+    :param update: Апдейт Telegram в виде словаря.
+    :return: ID чата или None.
+    """
+    for key, event in update.items():
+        if key == 'update_id' or not isinstance(event, dict):
+            continue
+        chat = event.get('chat') or (event.get('message') or {}).get('chat')
+        if chat:
+            return chat.get('id')
+        user = event.get('from') or event.get('user')
+        return user.get('id') if user else None
+    return None
+
+
+class WorkerProcess:
+    """
+    Процесс-воркер под надзором фронта.
+
+    Апдейты ждут в очереди фронта (не больше queue_size): когда воркер не успевает, фронт перестает
+    забирать апдейты у Telegram. Переданные воркеру, но не подтвержденные апдейты после падения процесса
+    доставляются перезапущенному воркеру еще раз (не больше MAX_ATTEMPTS раз).
+
+    :param cluster: Кластер, которому принадлежит воркер.
+    :param index: Номер воркера.
+    :param queue_size: Размер очереди апдейтов воркера на фронте.
+    """
+
+    def __init__(self, cluster: 'Cluster', index: int, queue_size: int) -> None:
+        self.cluster = cluster
+        self.index = index
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)  # (update_id, строка протокола)
+        self.process: asyncio.subprocess.Process | None = None
+        self.restarts = 0
+        self.processed = 0
+        self._retry: deque = deque()  # Апдейты упавшего процесса - отправляются перед очередью
+        self._in_flight: dict[int, bytes] = {}  # Переданы процессу, ждут подтверждения
+        self._attempts: dict[int, int] = {}
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def supervise(self) -> None:
+        """
+        Запускает процесс воркера и перезапускает его, пока кластер не остановлен.
+        """
+        delay = 1.0
+        while True:
+            started = time.monotonic()
+            self.process = await asyncio.create_subprocess_exec(
+                *self.cluster.worker_command(self.index), cwd=ROOT, env=self.cluster.worker_env(self.index),
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, limit=MAX_LINE)
+            app_logger.info(f'Воркер {self.index} запущен, pid {self.process.pid}')
+            pump = asyncio.create_task(self._pump())
+            try:
+                await self._read()
+                code = await self.process.wait()
+            finally:
+                pump.cancel()
+            if self.cluster.stopping:
+                app_logger.info(f'Воркер {self.index} остановлен')
+                return
+
+            self.restarts += 1
+            self._requeue()
+            if time.monotonic() - started >= STABLE_UPTIME:
+                delay = 1.0
+            app_logger.error(f'Воркер {self.index} завершился с кодом {code}, перезапуск через {delay:.0f} с, '
+                             f'повторно доставляется апдейтов: {len(self._retry)}')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RESTART_DELAY_MAX)
+
+    def _requeue(self) -> None:
+        """Возвращает неподтвержденные апдейты упавшего процесса в начало очереди."""
+        for update_id in sorted(self._in_flight):
+            if self._attempts[update_id] >= MAX_ATTEMPTS:
+                app_logger.error(f'Апдейт {update_id} отброшен: воркер {self.index} падал при его обработке')
+                self._attempts.pop(update_id)
+            else:
+                self._retry.append((update_id, self._in_flight[update_id]))
+        self._in_flight.clear()
+
+    async def _pump(self) -> None:
+        """Передает апдейты процессу воркера."""
+        stdin = self.process.stdin
+        try:
+            while True:
+                if self._retry:
+                    update_id, line = self._retry.popleft()
+                else:
+                    update_id, line = await self.queue.get()
+                    self.queue.task_done()
+                self._in_flight[update_id] = line
+                self._attempts[update_id] = self._attempts.get(update_id, 0) + 1
+                stdin.write(line)
+                await stdin.drain()  # Ждем, если процесс не успевает читать
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Процесс завершился - апдейт вернется в очередь через _requeue
+
+    async def _read(self) -> None:
+        """Читает подтверждения и события процесса воркера до его завершения."""
+        stdout = self.process.stdout
+        while line := await stdout.readline():
+            tag = line[:1]
+            if tag == b'a':
+                update_id = int(line[1:])
+                self._in_flight.pop(update_id, None)
+                self._attempts.pop(update_id, None)
+                self.processed += 1
+                self.cluster.acked(update_id)
+            elif tag == b'e':
+                self.cluster.publish(self.index, line)
+
+    def send_event(self, line: bytes) -> None:
+        """
+        Передает процессу событие другого воркера. Перезапускаемый процесс событие не получит:
+        индекс и кэш нового процесса пусты и читаются из базы данных.
+        """
+        if self.alive and not self.process.stdin.is_closing():
+            self.process.stdin.write(line)
+
+    def close(self) -> None:
+        """Закрывает stdin процесса: воркер дообрабатывает принятые апдейты и завершается."""
+        if self.alive and not self.process.stdin.is_closing():
+            self.process.stdin.close()
+
+    def stats(self) -> dict:
+        return {'pid': self.process.pid if self.alive else None, 'queued': self.queue.qsize() + len(self._retry),
+                'in_flight': len(self._in_flight), 'processed': self.processed, 'restarts': self.restarts}
+
+
+class Cluster:
+    """
+    Набор воркеров и маршрутизация апдейтов между ними.
+
+    :param workers: Число процессов-воркеров.
+    :param worker_args: Команда запуска воркера без номера (по умолчанию python -m cluster).
+    :param queue_size: Размер очереди апдейтов каждого воркера на фронте.
+    :param on_ack: Функция on_ack(update_id), вызывается, когда воркер обработал апдейт.
+    """
+
+    def __init__(self, workers: int, worker_args: list[str] | None = None, queue_size: int = 1000,
+                 on_ack=None) -> None:
+        self.count = workers
+        self.worker_args = worker_args or [sys.executable, '-m', 'cluster']
+        self.on_ack = on_ack
+        self.stopping = False
+        self.workers = [WorkerProcess(self, index, queue_size) for index in range(workers)]
+        self._tasks: list[asyncio.Task] = []
+
+    def worker_command(self, index: int) -> list[str]:
+        return [*self.worker_args, '--worker', str(index), '--workers', str(self.count)]
+
+    def worker_env(self, index: int) -> dict:
+        env = dict(os.environ)
+        # Лимит Telegram общий для бота - каждому воркеру достается своя доля
+        env['OUTBOUND_RATE'] = str(float(os.getenv('OUTBOUND_RATE', 30)) / self.count)
+        env['LOG_FILE_SUFFIX'] = f'worker{index}'
+        if os.getenv('METRICS_PORT'):  # Метрики каждого воркера - на своем порту: METRICS_PORT + 1 + номер
+            env['METRICS_PORT'] = str(int(os.getenv('METRICS_PORT')) + 1 + index)
+        return env
+
+    def start(self) -> None:
+        """Запускает процессы воркеров."""
+        self._tasks = [asyncio.create_task(worker.supervise()) for worker in self.workers]
+
+    async def route(self, update: dict) -> None:
+        """
+        Передает апдейт воркеру его чата. Ждет, если очередь этого воркера заполнена.
+
+        :param update: Апдейт Telegram в виде словаря.
+        """
+        worker = self.workers[shard_of(update_chat_id(update), self.count)]
+        line = b'u' + json.dumps(update, ensure_ascii=False, separators=(',', ':')).encode() + b'\n'
+        await worker.queue.put((update['update_id'], line))
+
+    def publish(self, source: int, line: bytes) -> None:
+        """Пересылает событие воркера source остальным воркерам."""
+        for worker in self.workers:
+            if worker.index != source:
+                worker.send_event(line)
+
+    def acked(self, update_id: int) -> None:
+        if self.on_ack is not None:
+            self.on_ack(update_id)
+
+    def stats(self) -> list[dict]:
+        """
+        :return: Состояние каждого воркера: pid, апдейтов в очереди и в обработке, обработано, перезапусков.
+        """
+        return [worker.stats() for worker in self.workers]
+
+    async def stop(self, timeout: float = 30) -> None:
+        """
+        Передает воркерам апдейты из очередей и останавливает их, дождавшись обработки.
+
+        :param timeout: Сколько секунд ждать воркеры, после этого процессы завершаются принудительно.
+        """
+        try:
+            await asyncio.wait_for(asyncio.gather(*(worker.queue.join() for worker in self.workers)), timeout)
+        except asyncio.TimeoutError:
+            app_logger.error('Не все апдейты переданы воркерам до остановки')
+        self.stopping = True
+        for worker in self.workers:
+            worker.close()
+        done, pending = await asyncio.wait(self._tasks, timeout=timeout)
+        for worker in self.workers:
+            if worker.alive:
+                app_logger.error(f'Воркер {worker.index} не завершился за {timeout} с')
+                worker.process.kill()
+        if pending:
+            await asyncio.wait(pending)
+
+
+async def run_polling(cluster: Cluster, bot: Bot, dp: Dispatcher) -> None:
+    """
+    Получает апдейты long polling и распределяет их по воркерам.
+    Следующий запрос подтверждает Telegram полученные апдейты, поэтому апдейты,
+    которые не поместились в очереди воркеров, Telegram придерживает у себя.
+    """
+    await bot.delete_webhook(drop_pending_updates=os.getenv('DROP_PENDING_UPDATES', '0') == '1')
+    polling_timeout = 30
+    kwargs = {'request_timeout': int(bot.session.timeout + polling_timeout)} if bot.session.timeout else {}
+    offset = None
+    while True:
+        try:
+            updates = await bot(GetUpdates(offset=offset, timeout=polling_timeout,
+                                           allowed_updates=dp.resolve_used_update_types()), **kwargs)
+        except Exception as e:
+            app_logger.error(f'Ошибка получения апдейтов: {e}')
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            await cluster.route(update.model_dump(mode='json', by_alias=True, exclude_unset=True))
+            offset = update.update_id + 1
+
+
+async def run_webhook(cluster: Cluster, bot: Bot, dp: Dispatcher) -> None:
+    """
+    Принимает апдейты вебхуком и распределяет их по воркерам.
+    Параметры окружения - как у webhook_server.run_webhook.
+    """
+    from webhook_server import webhook_url  # aiohttp-сервер aiogram нужен только в режиме вебхука
+
+    path = os.getenv('WEBHOOK_PATH', '/webhook')
+    url = webhook_url(path)
+    secret = os.getenv('WEBHOOK_SECRET') or None
+
+    async def handle(request: web.Request) -> web.Response:
+        if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            return web.Response(status=401)
+        await cluster.route(await request.json())  # Ответ задерживается, пока очередь воркера заполнена
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=os.getenv('WEBHOOK_HOST', '127.0.0.1'), port=int(os.getenv('WEBHOOK_PORT', 8080)))
+    await site.start()
+    await bot.set_webhook(url, secret_token=secret, allowed_updates=dp.resolve_used_update_types(),
+                          drop_pending_updates=os.getenv('DROP_PENDING_UPDATES', '0') == '1',
+                          max_connections=min(int(os.getenv('MAX_CONCURRENT_UPDATES', 100)), 100))
+    app_logger.info(f'Вебхук установлен: {url}, воркеров: {cluster.count}')
+    try:
+        await asyncio.Event().wait()  # Сервер работает до остановки процесса
+    finally:
+        await runner.cleanup()
+
+
+async def run_front(workers: int) -> None:
+    """
+    Запускает фронт: применяет миграции, запускает воркеры и получает апдейты.
+
+    :param workers: Число воркеров.
+    """
+    app_logger.info(f'Запуск кластера, воркеров: {workers}')
+    await create_db()  # Миграции выполняются один раз, до запуска воркеров
+    await main.sync_media()  # Новые изображения загружаются один раз, воркеры берут file_id из базы
+    main.include_routers(main.dp)  # allowed_updates для Telegram - по типам апдейтов обработчиков
+    cluster = Cluster(workers)
+    cluster.start()
+    task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        if os.getenv('BOT_MODE', 'polling') == 'webhook':
+            await run_webhook(cluster, main.bot, main.dp)
+        else:
+            await run_polling(cluster, main.bot, main.dp)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await cluster.stop()
+        await main.bot.session.close()
+        app_logger.info('Кластер остановлен')
+
+
+def _apply_event(line: bytes) -> None:
+    """Применяет изменение индекса слотов, брони слота, кэша баннеров или рассылки, сделанное другим воркером."""
+    kind, *args = json.loads(line[1:])
+    if kind == 'slot':
+        operation, day, slot = args
+        slot_index.apply_change(operation, day and date.fromisoformat(day), slot)
+    elif kind == 'hold':
+        operation, holder, day, slot = args
+        slot_holds.apply_change(operation, holder, day and date.fromisoformat(day), slot)
+    elif kind == 'banner':
+        banner_cache.apply_change(args[0])
+    elif kind == 'broadcast':
+        broadcaster.apply_change(*args)
+
+
+async def run_worker(index: int, count: int, output, bot: Bot) -> None:
+    """
+    Обрабатывает апдейты, которые фронт передает через stdin, и подтверждает их через output.
+
+    :param index: Номер воркера.
+    :param count: Число воркеров.
+    :param output: Файл (двоичный) для строк протокола - исходный stdout процесса.
+    :param bot: Экземпляр бота.
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=MAX_LINE)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, output)
+    writer = asyncio.StreamWriter(transport, protocol, None, loop)
+
+    def publish(*event) -> None:
+        writer.write(b'e' + json.dumps(event, ensure_ascii=False).encode() + b'\n')
+
+    slot_index.on_change = lambda operation, day, slot: publish('slot', operation, day and day.isoformat(), slot)
+    slot_holds.on_change = lambda operation, holder, day, slot: publish('hold', operation, holder,
+                                                                          day and day.isoformat(), slot)
+    banner_cache.on_change = lambda page: publish('banner', page)
+    broadcaster.on_change = lambda operation, broadcast_id: publish('broadcast', operation, broadcast_id)
+    # Напоминания, рассылки и архивация - только для своих чатов
+    reminders.shard = broadcaster.shard = archiver.shard = (index, count)
+
+    dp = main.dp
+    dp.startup.register(main.on_startup)
+    dp.shutdown.register(main.on_shutdown)
+    main.include_routers(dp)
+    main.register_middlewares(dp)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    app_logger.info(f'Воркер {index} из {count} готов')
+
+    limit = asyncio.Semaphore(int(os.getenv('MAX_CONCURRENT_UPDATES', 100)))
+    tasks = set()
+
+    async def handle(update: dict) -> None:
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            app_logger.error(f'Update: {update} caused error: {e}')
+        finally:
+            limit.release()
+            writer.write(b'a%d\n' % update['update_id'])
+
+    try:
+        while line := await reader.readline():
+            if line[:1] == b'e':
+                _apply_event(line)
+                continue
+            await limit.acquire()
+            task = asyncio.create_task(handle(json.loads(line[1:])))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:  # Фронт закрыл stdin - дообрабатываем принятые апдейты
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+        await writer.drain()
+        writer.close()
+
+
+def worker_main(index: int, count: int, bot: Bot | None = None) -> None:
+    """
+    Точка входа процесса-воркера.
+
+    :param index: Номер воркера.
+    :param count: Число воркеров.
+    :param bot: Экземпляр бота (по умолчанию main.bot; нагрузочный тест передает заглушку).
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Воркер останавливает фронт, закрывая stdin
+    output = os.fdopen(os.dup(sys.stdout.fileno()), 'wb', buffering=0)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())  # Случайный print не испортит протокол
+    if bot is not None:
+        main.bot = bot  # Напоминания и рассылки отправляются через main.bot
+    asyncio.run(run_worker(index, count, output, bot or main.bot))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WORKERS', 0)) or os.cpu_count() or 1,
+                        help='число процессов-воркеров')
+    parser.add_argument('--worker', type=int, help='номер воркера (задает фронт при запуске процесса)')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    if arguments.worker is None:
+        try:
+            asyncio.run(run_front(arguments.workers))
+        except KeyboardInterrupt:
+            pass
+    else:
+        worker_main(arguments.worker, arguments.workers)
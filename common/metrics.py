@@ -0,0 +1,250 @@
+# Метрики бота: гистограммы времени обработки апдейтов и счетчики запросов к базе данных
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable
+
+from sqlalchemy import event
+
+# Границы корзин гистограмм, с (как в клиентах Prometheus по умолчанию, с добавлением 1 мс)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+QUERIES_PER_UPDATE_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами: наблюдение - поиск корзины (bisect) и три сложения.
+
+    Блокировки не нужны: метрики обновляются только из потока цикла событий, между операциями
+    которого нет переключений задач.
+
+    :param bounds: Верхние границы корзин по возрастанию (последняя корзина - +Inf).
+    """
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: tuple) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, share: float) -> float:
+        """
+        Оценивает квантиль линейной интерполяцией внутри корзины (как histogram_quantile в Prometheus).
+
+        :param share: Доля, например 0.95.
+        :return: Оценка квантиля; для последней корзины - ее нижняя граница.
+        """
+        if not self.count:
+            return 0.0
+        rank = share * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                if index == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[index - 1] if index else 0.0
+                return lower + (self.bounds[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+
+class UpdateRecord:
+    """Замеры одного апдейта: обработчик, роутер и запросы к базе данных во время его обработки."""
+
+    __slots__ = ('handler', 'router', 'queries', 'db_seconds')
+
+    def __init__(self) -> None:
+        self.handler: str | None = None
+        self.router = ''
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# Апдейт, который обрабатывается в текущей задаче (запросы движка выполняются в ее контексте)
+current_update: ContextVar[UpdateRecord | None] = ContextVar('current_update', default=None)
+
+
+class Metrics:
+    """
+    Реестр метрик процесса.
+
+    Заполняется мидлварем middlewares.metrics.MetricsMiddleware (время обработки апдейта по обработчику,
+    роутеру и состоянию FSM) и обработчиками событий движка SQLAlchemy (install_engine_hooks: число и время
+    запросов - всего и в рамках апдейта). Счетчики других компонентов (очереди записи, исходящих и т.д.)
+    подключаются через register_stats и читаются только при выгрузке.
+    """
+
+    def __init__(self) -> None:
+        self.updates: dict[tuple[str, str, str], Histogram] = {}  # (обработчик, роутер, состояние)
+        self.handler_queries: dict[str, list] = {}  # Обработчик -> [запросов, время запросов, апдейтов]
+        self.queries_per_update = Histogram(QUERIES_PER_UPDATE_BUCKETS)
+        self.query_seconds = Histogram(QUERY_BUCKETS)
+        self.queries = 0
+        self._stats: dict[str, Callable[[], dict]] = {}
+
+    def observe_update(self, record: UpdateRecord, state: str, seconds: float) -> None:
+        """
+        Учитывает обработанный апдейт.
+
+        :param record: Замеры апдейта.
+        :param state: Состояние FSM ('none', если его нет).
+        :param seconds: Время обработки, с.
+        """
+        key = (record.handler, record.router, state)
+        histogram = self.updates.get(key)
+        if histogram is None:
+            histogram = self.updates[key] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(seconds)
+        totals = self.handler_queries.get(record.handler)
+        if totals is None:
+            totals = self.handler_queries[record.handler] = [0, 0.0, 0]
+        totals[0] += record.queries
+        totals[1] += record.db_seconds
+        totals[2] += 1
+        self.queries_per_update.observe(record.queries)
+
+    def observe_query(self, seconds: float) -> None:
+        """Учитывает выполненный SQL-запрос (в том числе вне апдейтов: очередь записи, напоминания)."""
+        self.queries += 1
+        self.query_seconds.observe(seconds)
+        record = current_update.get()
+        if record is not None:
+            record.queries += 1
+            record.db_seconds += seconds
+
+    def register_stats(self, name: str, stats: Callable[[], dict]) -> None:
+        """
+        Подключает счетчики компонента: числовые значения stats() выгружаются как bot_<name>_<ключ>.
+
+        :param name: Имя компонента, например 'outbound'.
+        :param stats: Функция, возвращающая словарь счетчиков (например, outbound.stats).
+        """
+        self._stats[name] = stats
+
+    def handlers(self) -> list[dict]:
+        """
+        :return: Сводка по обработчикам (все роутеры и состояния вместе), по убыванию числа апдейтов.
+        """
+        merged: dict[str, Histogram] = {}
+        for (handler, _, _), histogram in self.updates.items():
+            total = merged.get(handler)
+            if total is None:
+                total = merged[handler] = Histogram(LATENCY_BUCKETS)
+            total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+            total.sum += histogram.sum
+            total.count += histogram.count
+        rows = []
+        for handler, histogram in merged.items():
+            queries, db_seconds, updates = self.handler_queries.get(handler, (0, 0.0, 0))
+            rows.append({'handler': handler, 'count': histogram.count,
+                         'p50_ms': round(histogram.quantile(0.50) * 1000, 1),
+                         'p95_ms': round(histogram.quantile(0.95) * 1000, 1),
+                         'p99_ms': round(histogram.quantile(0.99) * 1000, 1),
+                         'queries': round(queries / max(updates, 1), 2),
+                         'db_ms': round(db_seconds / max(updates, 1) * 1000, 2)})
+        rows.sort(key=lambda row: row['count'], reverse=True)
+        return rows
+
+    def render(self) -> str:
+        """
+        Выгружает метрики в текстовом формате Prometheus (version 0.0.4).
+        """
+        lines = ['# HELP bot_update_seconds Время обработки апдейта.', '# TYPE bot_update_seconds histogram']
+        for (handler, router, state), histogram in self.updates.items():
+            _histogram_lines(lines, 'bot_update_seconds', histogram,
+                             f'handler="{handler}",router="{router}",state="{_escape(state)}"')
+        lines += ['# HELP bot_update_db_queries_total Запросов к базе данных при обработке апдейтов.',
+                  '# TYPE bot_update_db_queries_total counter']
+        lines += [f'bot_update_db_queries_total{{handler="{handler}"}} {totals[0]}'
+                  for handler, totals in self.handler_queries.items()]
+        lines += ['# HELP bot_update_db_seconds_total Время запросов к базе данных при обработке апдейтов.',
+                  '# TYPE bot_update_db_seconds_total counter']
+        lines += [f'bot_update_db_seconds_total{{handler="{handler}"}} {totals[1]:.6f}'
+                  for handler, totals in self.handler_queries.items()]
+        lines += ['# HELP bot_update_db_queries Запросов к базе данных на один апдейт.',
+                  '# TYPE bot_update_db_queries histogram']
+        _histogram_lines(lines, 'bot_update_db_queries', self.queries_per_update)
+        lines += ['# HELP bot_db_query_seconds Время выполнения SQL-запроса.', '# TYPE bot_db_query_seconds histogram']
+        _histogram_lines(lines, 'bot_db_query_seconds', self.query_seconds)
+        for name, stats in self._stats.items():
+            for key, value in stats().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines += [f'# TYPE bot_{name}_{key} gauge', f'bot_{name}_{key} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _histogram_lines(lines: list, name: str, histogram: Histogram, labels: str = '') -> None:
+    prefix = labels + ',' if labels else ''
+    cumulative = 0
+    for bound, count in zip(histogram.bounds, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+    suffix = f'{{{labels}}}' if labels else ''
+    lines.append(f'{name}_sum{suffix} {histogram.sum:.6f}')
+    lines.append(f'{name}_count{suffix} {histogram.count}')
+
+
+def install_engine_hooks(engine, registry: 'Metrics | None' = None) -> None:
+    """
+    Подключает к движку обработчики событий, которые считают и замеряют SQL-запросы.
+
+    :param engine: Асинхронный (или синхронный) движок SQLAlchemy.
+    :param registry: Реестр метрик, по умолчанию общий metrics.
+    """
+    registry = registry or metrics
+    sync_engine = getattr(engine, 'sync_engine', engine)
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        registry.observe_query(time.perf_counter() - conn.info['query_started'].pop())
+
+    @event.listens_for(sync_engine, 'handle_error')
+    def handle_error(context):
+        started = context.connection.info.get('query_started') if context.connection is not None else None
+        if started:
+            started.pop()  # Запрос с ошибкой не учитывается
+
+
+async def serve_metrics(host: str, port: int, registry: 'Metrics | None' = None):
+    """
+    Запускает локальный HTTP-сервер с метриками в формате Prometheus (GET /metrics).
+
+    :param host: Адрес (по умолчанию метрики доступны только с этой машины).
+    :param port: Порт.
+    :param registry: Реестр метрик, по умолчанию общий metrics.
+    :return: aiohttp AppRunner (runner.cleanup() останавливает сервер).
+    """
+    from aiohttp import web  # Сервер нужен, только если метрики включены
+
+    registry = registry or metrics
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    return runner
+
+
+metrics = Metrics()
@@ -0,0 +1,257 @@
+# Планировщик исходящих запросов к Telegram: общий лимит, темп в каждом чате, приоритеты и retry_after
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+from common.metrics import current_update
+from logging_config import setup_logging
+
+# Настройка логгирования
+app_logger = setup_logging("outbound", "logs/main.log")
+
+# Приоритеты: чем меньше число, тем раньше отправка
+INTERACTIVE = 0  # Ответы на действия пользователя
+MENU = 1  # Стартовое меню с фото (send_start_menu)
+REMINDER = 2  # Напоминания о записи (db.reminders)
+BULK = 3  # Рассылки и прочие массовые отправки
+
+
+class _Item:
+    __slots__ = ('method', 'priority', 'future', 'enqueued')
+
+    def __init__(self, method: TelegramMethod, priority: int, future: asyncio.Future) -> None:
+        self.method = method
+        self.priority = priority
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class OutboundScheduler:
+    """
+    Очередь исходящих запросов между обработчиками и Bot.
+
+    Обработчик ставит запрос в очередь и сразу завершается (а вместе с ним закрывается его сессия
+    базы данных), отправкой занимается фоновая задача:
+
+    - общий лимит - не больше rate запросов в секунду на бота;
+    - темп в каждом чате - chat_burst запросов подряд, дальше не чаще chat_rate в секунду; запросы
+      одного чата отправляются строго по очереди, в порядке постановки;
+    - приоритеты - из готовых к отправке чатов первым обслуживается тот, чей очередной запрос важнее:
+      INTERACTIVE, затем MENU, REMINDER и BULK;
+    - ответ 429 (TelegramRetryAfter) приостанавливает все отправки один раз на retry_after секунд,
+      сколько бы запросов его ни получили, после чего запрос повторяется первым в своем чате.
+
+    Запросы без chat_id (например, answerCallbackQuery) не ограничиваются темпом и отправляются сразу.
+    Пока планировщик не запущен (start), send отправляет запрос напрямую и ждет ответа.
+
+    :param rate: Общий лимит запросов в секунду.
+    :param chat_rate: Запросов в секунду в одном чате после исчерпания chat_burst.
+    :param chat_burst: Запросов подряд в одном чате.
+    :param concurrency: Сколько запросов может выполняться одновременно.
+    """
+
+    def __init__(self, rate: float = 30, chat_rate: float = 1, chat_burst: int = 3, concurrency: int = 16) -> None:
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+
+        self._chats: dict[int, deque] = {}  # chat_id -> очередь запросов чата
+        self._chat_tat: dict[int, float] = {}  # chat_id -> теоретическое время следующей отправки (GCRA)
+        self._ready: list = []  # (приоритет, номер, chat_id) - чаты, готовые к отправке
+        self._delayed: list = []  # (время готовности, номер, chat_id) - чаты, ждущие своего темпа
+        self._sending: set[int] = set()  # Чаты, запрос которых сейчас выполняется
+        self._order = itertools.count()
+        self._next_send = 0.0  # Время следующей отправки по общему лимиту
+        self._paused_until = 0.0  # Пауза после ответа 429
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._slots: asyncio.Semaphore | None = None
+        self._inflight: set[asyncio.Task] = set()
+
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self._latencies: deque = deque(maxlen=1000)  # Время от постановки в очередь до ответа, с
+
+    @property
+    def started(self) -> bool:
+        return self._task is not None
+
+    def start(self) -> None:
+        """
+        Запускает фоновую задачу отправки. Вызывается из on_startup.
+        """
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._task = asyncio.create_task(self._run())
+
+    async def send(self, method: TelegramMethod, priority: int = INTERACTIVE, wait: bool = False) -> None:
+        """
+        Отправляет запрос через очередь, не дожидаясь ответа Telegram.
+
+        Используется в обработчиках вместо `await message.answer(...)`:
+        `await outbound.send(message.answer(...))`.
+
+        :param method: Запрос, привязанный к боту (например, результат message.answer(...) без await).
+        :param priority: INTERACTIVE, MENU, REMINDER или BULK.
+        :param wait: Дождаться ответа Telegram (например, перед удалением отправляемого файла).
+        """
+        if self._task is None:
+            await method
+            return
+        future = self.submit(method, priority)
+        if wait:
+            await future
+
+    def submit(self, method: TelegramMethod, priority: int = INTERACTIVE) -> asyncio.Future:
+        """
+        Ставит запрос в очередь.
+
+        :param method: Запрос, привязанный к боту.
+        :param priority: INTERACTIVE, MENU, REMINDER или BULK.
+        :return: Future с ответом Telegram (или исключением).
+        """
+        future = asyncio.get_running_loop().create_future()
+        item = _Item(method, priority, future)
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:  # Запрос не относится к чату - темп чата не нужен
+            self._spawn(None, item)
+            return future
+
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = deque()
+        queue.append(item)
+        if len(queue) == 1 and chat_id not in self._sending:
+            self._schedule(chat_id)
+        return future
+
+    def _schedule(self, chat_id: int) -> None:
+        """Ставит чат в очередь готовых или отложенных, в зависимости от его темпа."""
+        now = time.monotonic()
+        ready_at = self._chat_tat.get(chat_id, now) - (self.chat_burst - 1) / self.chat_rate
+        if ready_at <= now:
+            heapq.heappush(self._ready, (self._chats[chat_id][0].priority, next(self._order), chat_id))
+        else:
+            heapq.heappush(self._delayed, (ready_at, next(self._order), chat_id))
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        current_update.set(None)  # Задача могла быть запущена в обработчике апдейта
+        last_cleanup = time.monotonic()
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:  # Темп чата позволяет отправку
+                _, _, chat_id = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (self._chats[chat_id][0].priority, next(self._order), chat_id))
+
+            wait = max(self._paused_until, self._next_send) - now
+            if self._ready and wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            if not self._ready:
+                self._wakeup.clear()
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._slots.acquire()
+            _, _, chat_id = heapq.heappop(self._ready)
+            item = self._chats[chat_id].popleft()
+            self._sending.add(chat_id)
+            tat = max(self._chat_tat.get(chat_id, now), now)
+            self._chat_tat[chat_id] = tat + 1 / self.chat_rate
+            self._next_send = max(self._next_send, now) + 1 / self.rate
+            self._spawn(chat_id, item, acquired=True)
+
+            if now - last_cleanup > 60:  # Забываем темп чатов, которые давно ничего не получали
+                last_cleanup = now
+                for stale in [key for key, tat in self._chat_tat.items() if tat < now and key not in self._chats]:
+                    del self._chat_tat[stale]
+
+    def _spawn(self, chat_id: int | None, item: _Item, acquired: bool = False) -> None:
+        task = asyncio.create_task(self._deliver(chat_id, item, acquired))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _deliver(self, chat_id: int | None, item: _Item, acquired: bool) -> None:
+        """Выполняет один запрос и возвращает чат в расписание."""
+        try:
+            result = await item.method
+        except TelegramRetryAfter as e:
+            self.retries += 1
+            # Одна общая пауза: следующий ответ 429 ее только продлевает, но не суммирует
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            app_logger.warning(f'Telegram просит подождать {e.retry_after} с, отправка приостановлена')
+            if chat_id is None:
+                await asyncio.sleep(max(0.0, self._paused_until - time.monotonic()))
+                self._spawn(None, item)
+            else:
+                self._chats[chat_id].appendleft(item)  # Повторяем первым, порядок в чате сохраняется
+        except Exception as e:
+            self.failed += 1
+            app_logger.error(f'Ошибка отправки {type(item.method).__name__} в чат {chat_id}: {e}')
+            if not item.future.done():
+                item.future.set_exception(e)
+                item.future.exception()  # Ошибка уже в логе, ждать Future не обязательно
+        else:
+            self.sent += 1
+            self._latencies.append(time.monotonic() - item.enqueued)
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            if acquired:
+                self._slots.release()
+            if chat_id is not None:
+                self._sending.discard(chat_id)
+                if self._chats[chat_id]:
+                    self._schedule(chat_id)
+                else:
+                    del self._chats[chat_id]
+
+    def stats(self) -> dict:
+        """
+        Возвращает глубину очереди и время отправки.
+
+        :return: Словарь: запросов в очереди (всего и по приоритетам), отправлено, ошибок, повторов после 429,
+                 медиана и 95-й перцентиль времени от постановки в очередь до ответа (мс).
+        """
+        depth = [0, 0, 0, 0]
+        for queue in self._chats.values():
+            for item in queue:
+                depth[item.priority] += 1
+        latencies = sorted(self._latencies)
+
+        def percentile(share: float) -> float:
+            return round(latencies[int(len(latencies) * share)] * 1000, 1) if latencies else 0.0
+
+        return {'queued': sum(depth), 'interactive': depth[INTERACTIVE], 'menu': depth[MENU],
+                'reminder': depth[REMINDER], 'bulk': depth[BULK],
+                'sending': len(self._inflight), 'sent': self.sent, 'failed': self.failed, 'retries': self.retries,
+                'latency_p50_ms': percentile(0.5), 'latency_p95_ms': percentile(0.95)}
+
+    async def close(self, timeout: float = 10) -> None:
+        """
+        Дожидается отправки очереди (не дольше timeout секунд) и останавливает фоновую задачу.
+        """
+        if self._task is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (self._chats or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self._task.cancel()
+        self._task = None
+
+
+outbound = OutboundScheduler()
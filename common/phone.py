@@ -0,0 +1,72 @@
+# Нормализация номеров телефонов: числовой ключ в формате E.164 для поиска заявок по индексу
+import unicodedata
+from typing import Iterable
+
+# Байты, удаляемые из номера (все, кроме цифр ASCII): bytes.translate удаляет их без регулярных выражений
+_NON_DIGITS = bytes(byte for byte in range(256) if not 0x30 <= byte <= 0x39)
+_NON_DIGITS_BATCH = _NON_DIGITS.replace(b'\x00', b'')  # Разделитель номеров пакета - байт \x00
+COUNTRY_PREFIX = 7 * 10 ** 10  # +7 и 10 цифр номера: ключ 7XXXXXXXXXX
+
+
+def _digits(phone: str) -> bytes:
+    """
+    Оставляет в номере только цифры.
+
+    Цифры других письменностей (арабские, полноширинные и т.п.) приводятся к ASCII: номер, набранный
+    на такой клавиатуре, дает тот же ключ. Символы, для которых str.isdigit истинно, но которые не являются
+    десятичными цифрами (например, надстрочные '²'), не учитываются.
+
+    :param phone: Номер телефона.
+    :return: Цифры номера в ASCII.
+    """
+    if phone.isascii():
+        return phone.encode('ascii').translate(None, _NON_DIGITS)
+    return ''.join(str(unicodedata.decimal(char)) for char in phone if char.isdecimal()).encode('ascii')
+
+
+def phone_key(phone: str | None) -> int | None:
+    """
+    Возвращает числовой ключ номера телефона (E.164 без '+', например 79161234567).
+
+    Как и в format_phone_number, учитываются последние 10 цифр, код страны всегда +7:
+    '8 (916) 123-45-67', '+7 916 1234567' и '9161234567' дают один ключ.
+
+    :param phone: Номер телефона в произвольном виде.
+    :return: Ключ или None, если в номере меньше 10 цифр.
+    """
+    if not phone:
+        return None
+    digits = _digits(phone)
+    if len(digits) < 10:
+        return None
+    return COUNTRY_PREFIX + int(digits[-10:])
+
+
+def phone_keys(phones: Iterable[str | None]) -> list[int | None]:
+    """
+    Пакетная версия phone_key для импорта и заполнения колонки user.phone_key.
+
+    Все номера пакета склеиваются и очищаются от лишних символов одним вызовом bytes.translate.
+
+    :param phones: Номера телефонов.
+    :return: Ключи в том же порядке (None для некорректных номеров).
+    """
+    phones = [phone or '' for phone in phones]
+    batch = '\x00'.join(phones)
+    if not batch.isascii():  # Цифры других письменностей приводятся к ASCII по одному номеру
+        return [phone_key(phone) for phone in phones]
+    parts = batch.encode('ascii').translate(None, _NON_DIGITS_BATCH).split(b'\x00')
+    if len(parts) != len(phones):  # В каком-то номере был сам разделитель
+        return [phone_key(phone) for phone in phones]
+    return [COUNTRY_PREFIX + int(digits[-10:]) if len(digits) >= 10 else None for digits in parts]
+
+
+def format_phone(key: int) -> str:
+    """
+    Форматирует ключ номера в вид +7(XXX)XXX-XX-XX.
+
+    :param key: Ключ, полученный из phone_key.
+    :return: Отформатированный номер телефона.
+    """
+    digits = f'{key - COUNTRY_PREFIX:010d}'
+    return f"+7({digits[:3]}){digits[3:6]}-{digits[6:8]}-{digits[8:10]}"
@@ -0,0 +1,61 @@
+# Замер времени запуска бота по этапам
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import Awaitable, TypeVar
+
+T = TypeVar('T')
+
+
+class StartupTimer:
+    """
+    Засекает длительность этапов запуска и собирает отчет для лога.
+
+    Независимые этапы выполняются одновременно (asyncio.gather), поэтому сумма этапов может быть
+    больше общего времени запуска.
+
+    :param started: Момент начала запуска (time.perf_counter()), по умолчанию - создание таймера.
+    """
+
+    def __init__(self, started: float | None = None) -> None:
+        self.started = time.perf_counter() if started is None else started
+        self.phases: dict[str, float] = {}  # Этап -> длительность, с
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Засекает длительность блока with как этапа name.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    async def measure(self, name: str, awaitable: Awaitable[T]) -> T:
+        """
+        Ожидает awaitable и записывает время ожидания как этап name.
+
+        :return: Результат awaitable.
+        """
+        with self.phase(name):
+            return await awaitable
+
+    async def gather(self, **awaitables: Awaitable) -> list:
+        """
+        Выполняет независимые этапы одновременно: timer.gather(banners=..., get_me=...).
+
+        :return: Результаты этапов в порядке аргументов.
+        """
+        return await asyncio.gather(*(self.measure(name, awaitable) for name, awaitable in awaitables.items()))
+
+    def elapsed(self) -> float:
+        """Время с начала запуска, с."""
+        return time.perf_counter() - self.started
+
+    def report(self) -> str:
+        """
+        :return: Строка для лога: общее время и длительность каждого этапа в миллисекундах.
+        """
+        phases = ', '.join(f'{name} {seconds * 1000:.1f}' for name, seconds in self.phases.items())
+        return f'Бот готов к работе через {self.elapsed() * 1000:.1f} мс (этапы, мс: {phases})'
@@ -2,3 +2,8 @@
 description_for_info_pages = {
     "main": "Добро пожаловать!",
     "about": 'Ветеринарная клиника "Пушок"\nРежим работы - c 8:00 до 22:00.'}
+
+# Изображения баннеров по умолчанию (файлы из папки image, см. db.media)
+images_for_info_pages = {
+    "main": "main.jpg",
+    "about": "О нас.jpg"}
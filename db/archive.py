@@ -0,0 +1,141 @@
+# Архивация прошедших записей: перенос из таблицы user в user_archive пакетами
+import asyncio
+from datetime import date, timedelta
+from typing import Callable
+
+from sqlalchemy import delete, func, insert, literal, or_, select, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from common.metrics import current_update
+from db.models import User, UserArchive
+from db.write_queue import write_queue
+from logging_config import setup_logging
+
+# Настройка логгирования
+app_logger = setup_logging("archive", "logs/orm.log")
+
+# Колонки, которые переносятся в архив как есть (id записи переносится в source_id)
+ARCHIVE_COLUMNS = ('name', 'phone', 'phone_key', 'date', 'day', 'time', 'chat_id', 'reminded', 'created', 'update')
+
+
+def appointments_union(columns: tuple[str, ...], where: Callable | None = None):
+    """
+    Собирает запрос к записям обеих таблиц (user и user_archive) с признаком archived.
+
+    :param columns: Имена колонок.
+    :param where: Функция модель -> условие (например, lambda model: model.phone_key == key),
+                  применяется к обеим таблицам.
+    :return: Подзапрос (subquery) с колонками columns и archived (False - горячая таблица, True - архив).
+             Для архивных записей колонка id - это id записи в таблице user (source_id).
+    """
+    selects = []
+    for model, archived in ((User, False), (UserArchive, True)):
+        fields = (getattr(model, 'source_id' if archived and name == 'id' else name).label(name) for name in columns)
+        query = select(*fields, literal(archived).label('archived'))
+        if where is not None:
+            query = query.where(where(model))
+        selects.append(query)
+    return union_all(*selects).subquery()
+
+
+class Archiver:
+    """
+    Переносит прошедшие записи в архив, чтобы горячая таблица user оставалась небольшой.
+
+    Раз в interval секунд записи, день которых раньше чем after_days дней назад, переносятся в таблицу
+    user_archive пакетами по batch_size строк: выбор id по индексу (day, time), INSERT ... SELECT
+    в архив и DELETE из user в одной транзакции через общую очередь записи (db.write_queue).
+    Транзакции короткие, между пакетами цикл событий и очередь записи обслуживают чаты, а освобожденные
+    страницы индексов user переиспользуются новыми записями. Запросы слотов, поиск заявок по телефону,
+    напоминания и сверка индекса слотов работают только с горячей таблицей; история заявок для
+    администратора, выгрузка и получатели рассылок читают обе (appointments_union).
+
+    При запуске в нескольких процессах (cluster.py) задается shard = (номер процесса, число процессов):
+    процесс переносит только записи своих чатов, записи без chat_id переносит процесс 0.
+
+    :param after_days: Сколько дней после даты запись остается в горячей таблице.
+    :param batch_size: Строк в одной транзакции переноса.
+    :param interval: Интервал между проходами, с.
+    """
+
+    def __init__(self, after_days: int = 30, batch_size: int = 1000, interval: float = 6 * 3600) -> None:
+        self.after_days = after_days
+        self.batch_size = batch_size
+        self.interval = interval
+        self.shard: tuple[int, int] | None = None
+        self.moved = 0
+        self.batches = 0
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """
+        Запускает периодическую архивацию. Вызывается из on_startup.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """
+        Останавливает периодическую архивацию. Вызывается из on_shutdown; пакет переносится одной
+        транзакцией, поэтому остановка между пакетами не оставляет записей в обеих таблицах.
+        """
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self) -> None:
+        current_update.set(None)  # Задача могла быть запущена в обработчике апдейта
+        while True:
+            try:
+                await self.archive(date.today() - timedelta(days=self.after_days))
+            except Exception as e:
+                app_logger.error(f'Ошибка архивации: {e}')
+            await asyncio.sleep(self.interval)
+
+    async def archive(self, before: date) -> int:
+        """
+        Переносит в архив все записи с днем раньше before.
+
+        :param before: Первая дата, записи которой остаются в горячей таблице.
+        :return: Число перенесенных записей.
+        """
+        total = 0
+        while True:
+            moved = await write_queue.submit(lambda session: self._move_batch(session, before))
+            total += moved
+            self.batches += bool(moved)
+            if moved < self.batch_size:
+                break
+            await asyncio.sleep(0)  # Между пакетами очередь записи выполняет изменения чатов
+        self.moved += total
+        if total:
+            app_logger.info(f'В архив перенесено записей: {total} (до {before})')
+        return total
+
+    async def _move_batch(self, session: AsyncSession, before: date) -> int:
+        """Переносит один пакет записей в архив в транзакции сессии очереди записи."""
+        query = select(User.id).where(User.day < before).order_by(User.day).limit(self.batch_size)
+        if self.shard is not None:
+            index, count = self.shard
+            mine = func.abs(User.chat_id) % count == index
+            query = query.where(or_(mine, User.chat_id.is_(None)) if index == 0 else mine)
+        ids = list((await session.execute(query)).scalars())
+        if not ids:
+            return 0
+        user = User.__table__
+        await session.execute(insert(UserArchive).from_select(
+            ('source_id',) + ARCHIVE_COLUMNS,
+            select(user.c.id, *(user.c[name] for name in ARCHIVE_COLUMNS)).where(user.c.id.in_(ids))))
+        await session.execute(delete(User).where(User.id.in_(ids)))
+        return len(ids)
+
+    def stats(self) -> dict:
+        """
+        :return: Счетчики перенесенных записей и транзакций переноса.
+        """
+        return {'moved': self.moved, 'batches': self.batches}
+
+
+archiver = Archiver()
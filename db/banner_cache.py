@@ -0,0 +1,133 @@
+# Кэш баннеров (информационных страниц) в памяти
+from typing import Callable, NamedTuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.models import Banner
+
+
+class BannerEntry(NamedTuple):
+    """
+    Снимок баннера, хранящийся в кэше.
+
+    :param name: Имя страницы (main, about, ...).
+    :param image: file_id изображения в Telegram или None.
+    :param description: Подпись баннера.
+    """
+    name: str
+    image: str | None
+    description: str | None
+
+    @classmethod
+    def from_model(cls, banner: Banner) -> 'BannerEntry':
+        return cls(name=banner.name, image=banner.image, description=banner.description)
+
+
+class BannerCache:
+    """
+    Кэш баннеров со сквозным чтением.
+
+    Баннеры меняются крайне редко, поэтому после прогрева в on_startup меню обслуживается
+    без обращений к базе данных. Запись по имени страницы сбрасывается функцией
+    orm_change_banner_image и перечитывается при следующем обращении. Если задан on_change, сброс
+    передается другим процессам бота (см. cluster.py), они применяют его через apply_change.
+    """
+
+    def __init__(self) -> None:
+        self._entries: dict[str, BannerEntry] = {}
+        self._names: set[str] = set()  # Имена всех страниц после прогрева
+        self._complete = False  # Загружен ли полный список страниц
+        self._generation = 0  # Растет при каждом сбросе, чтобы не сохранять устаревшие чтения
+        self.hits = 0
+        self.misses = 0
+        self.on_change: Callable[[str | None], None] | None = None
+
+    async def warm(self, session: AsyncSession) -> list[BannerEntry]:
+        """
+        Загружает в кэш все баннеры.
+
+        :param session: Асинхронная сессия базы данных.
+        :return: Список всех баннеров.
+        """
+        generation = self._generation
+        result = await session.execute(select(Banner))
+        entries = {banner.name: BannerEntry.from_model(banner) for banner in result.scalars()}
+        if generation != self._generation:  # Кэш сбросили во время чтения
+            return list(entries.values())
+        self._entries = entries
+        self._names = set(self._entries)
+        self._complete = True
+        return list(self._entries.values())
+
+    async def get(self, session: AsyncSession, page: str) -> BannerEntry | None:
+        """
+        Возвращает баннер по имени страницы, при промахе читая его из базы данных.
+
+        :param session: Асинхронная сессия базы данных.
+        :param page: Имя страницы.
+        :return: Баннер или None, если страницы нет.
+        """
+        entry = self._entries.get(page)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        if self._complete and page not in self._names:
+            return None  # Список страниц полный, такой страницы нет
+        generation = self._generation
+        result = await session.execute(select(Banner).where(Banner.name == page))
+        banner = result.scalar()
+        if banner is None:
+            return None
+        entry = BannerEntry.from_model(banner)
+        if generation == self._generation:
+            self._entries[page] = entry
+        return entry
+
+    async def pages(self, session: AsyncSession) -> list[BannerEntry]:
+        """
+        Возвращает список всех баннеров.
+
+        :param session: Асинхронная сессия базы данных.
+        :return: Список баннеров.
+        """
+        if self._complete and len(self._entries) == len(self._names):
+            self.hits += 1
+            return list(self._entries.values())
+        self.misses += 1
+        return await self.warm(session)
+
+    def invalidate(self, page: str | None = None) -> None:
+        """
+        Сбрасывает баннер страницы (или весь кэш).
+
+        :param page: Имя страницы. Если не указано, сбрасывается весь кэш.
+        """
+        self.apply_change(page)
+        if self.on_change is not None:
+            self.on_change(page)
+
+    def apply_change(self, page: str | None = None) -> None:
+        """
+        Сбрасывает баннер по сообщению другого процесса, не передавая сброс дальше.
+        """
+        self._generation += 1
+        if page is None:
+            self._entries.clear()
+            self._names.clear()
+            self._complete = False
+            return
+        self._entries.pop(page, None)
+
+    def stats(self) -> dict:
+        """
+        Возвращает счетчики попаданий и промахов кэша.
+
+        :return: Словарь со счетчиками и количеством закэшированных страниц.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'pages': len(self._entries)}
+
+
+banner_cache = BannerCache()
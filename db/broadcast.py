@@ -0,0 +1,333 @@
+# Рассылка администратора всем, кто когда-либо записывался: постраничный обход, пул отправителей, контрольные точки
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+from sqlalchemy import case, func, select, union, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from common.metrics import current_update
+from db.models import MIN_CHAT_ID, Broadcast, BroadcastShard, User, UserArchive
+from db.write_queue import write_queue
+from logging_config import setup_logging
+
+# Настройка логгирования
+app_logger = setup_logging("broadcast", "logs/orm.log")
+
+Send = Callable[[int, str | None, str | None], Awaitable[None]]
+Report = Callable[[int, str], Awaitable[None]]
+
+
+async def count_recipients(session: AsyncSession) -> int:
+    """
+    Возвращает число получателей рассылки.
+
+    :param session: Асинхронная сессия базы данных.
+    :return: Количество различных чатов в таблицах user и user_archive.
+    """
+    chats = union(*(select(model.chat_id).where(model.chat_id.is_not(None)) for model in (User, UserArchive)))
+    result = await session.execute(select(func.count()).select_from(chats.subquery()))
+    return result.scalar() or 0
+
+
+async def recipients_page(session: AsyncSession, after: int, limit: int,
+                          shard: tuple[int, int] | None = None) -> list[int]:
+    """
+    Возвращает следующую страницу получателей (keyset-пагинация по индексам ix_user_chat_id
+    и ix_user_archive_chat_id: из каждой таблицы читается не больше limit чатов).
+
+    :param session: Асинхронная сессия базы данных.
+    :param after: Последний chat_id предыдущей страницы (db.models.MIN_CHAT_ID - с начала).
+    :param limit: Размер страницы.
+    :param shard: (номер процесса, число процессов) - только чаты abs(chat_id) % число == номер.
+    :return: Отсортированный список различных chat_id больше after.
+    """
+    def query(model):
+        query = select(model.chat_id).where(model.chat_id > after)
+        if shard is not None:
+            index, count = shard
+            query = query.where(func.abs(model.chat_id) % count == index)
+        return query
+
+    pages = [query(model).group_by(model.chat_id).order_by(model.chat_id).limit(limit).subquery()
+             for model in (User, UserArchive)]
+    chats = union(*(select(page.c.chat_id) for page in pages)).subquery()
+    result = await session.execute(select(chats.c.chat_id).order_by(chats.c.chat_id).limit(limit))
+    return list(result.scalars())
+
+
+class Broadcaster:
+    """
+    Выполняет рассылки, не загружая список получателей целиком.
+
+    Получатели - различные chat_id из user и user_archive (записи, сделанные до появления этой колонки,
+    недоступны: в Telegram нельзя написать по номеру телефона). Они читаются страницами по batch_size через keyset-пагинацию
+    (chat_id > последний обработанный), следующая страница читается, пока отправляется текущая.
+    Отправкой занимаются workers задач; каждая ждет ответа Telegram на свое сообщение, поэтому в очереди
+    исходящих (common.outbound, приоритет BULK) одновременно стоит не больше workers сообщений рассылки
+    и ответы пользователям не ждут за ней. Общий лимит Telegram соблюдает сама очередь исходящих.
+
+    После каждой страницы прогресс (последний chat_id) сохраняется в таблице broadcast_shard, счетчики -
+    в broadcast. Если бот остановился, незавершенная рассылка продолжается при следующем запуске с последней
+    сохраненной страницы; повторно могут получить сообщение только получатели недописанной страницы.
+    Раз в report_interval секунд и по окончании администратору отправляется отчет о ходе рассылки.
+
+    При запуске в нескольких процессах (cluster.py) задается shard = (номер процесса, число процессов):
+    каждый процесс отправляет рассылку своим чатам со своей долей лимита исходящих, поэтому рассылка
+    идет с общим лимитом бота. О новой и остановленной рассылке процессы узнают через on_change/apply_change.
+    Рассылка завершена, когда свою часть закончили все процессы; промежуточные отчеты отправляет процесс,
+    который обслуживает чат администратора, итоговый - процесс, закончивший последним.
+
+    :param batch_size: Размер страницы получателей.
+    :param workers: Число одновременных отправок.
+    :param report_interval: Интервал между отчетами, с.
+    """
+
+    def __init__(self, batch_size: int = 500, workers: int = 8, report_interval: float = 30) -> None:
+        self.batch_size = batch_size
+        self.workers = workers
+        self.report_interval = report_interval
+        self.session_pool: async_sessionmaker | None = None
+        self.send: Send | None = None
+        self.report: Report | None = None
+        self._tasks: dict[int, asyncio.Task] = {}  # id рассылки -> задача
+        self._closing = False
+        self.shard: tuple[int, int] | None = None
+        self.on_change: Callable[[str, int], None] | None = None  # (операция, id рассылки)
+
+    @property
+    def running(self) -> list[int]:
+        """ID выполняющихся рассылок."""
+        return list(self._tasks)
+
+    async def start(self, session_pool: async_sessionmaker, send: Send, report: Report) -> None:
+        """
+        Запоминает фабрику сессий и функции отправки и продолжает незавершенные рассылки.
+        Вызывается из on_startup.
+
+        :param session_pool: Фабрика асинхронных сессий.
+        :param send: Корутина send(chat_id, text, photo), отправляет сообщение рассылки и ждет ответа Telegram.
+        :param report: Корутина report(chat_id, text), отправляет отчет администратору.
+        """
+        self.session_pool = session_pool
+        self.send = send
+        self.report = report
+        async with session_pool() as session:
+            result = await session.execute(select(Broadcast.id).where(Broadcast.status == 'running'))
+            unfinished = list(result.scalars())
+        for broadcast_id in unfinished:
+            app_logger.info(f'Продолжаем рассылку {broadcast_id}')
+            self._spawn(broadcast_id)
+
+    async def create(self, admin_chat_id: int, text: str | None, photo: str | None = None) -> int:
+        """
+        Сохраняет новую рассылку и запускает ее.
+
+        :param admin_chat_id: Чат администратора для отчетов.
+        :param text: Текст сообщения или подпись к фото.
+        :param photo: file_id фото или None.
+        :return: ID рассылки.
+        """
+        async def apply(session: AsyncSession):
+            broadcast = Broadcast(admin_chat_id=admin_chat_id, text=text, photo=photo, last_chat_id=MIN_CHAT_ID,
+                                  sent=0, failed=0, status='running')
+            session.add(broadcast)
+            await session.flush()
+            return broadcast.id
+
+        broadcast_id = await write_queue.submit(apply)
+        self._spawn(broadcast_id)
+        self._notify('start', broadcast_id)
+        return broadcast_id
+
+    async def stop(self) -> list[int]:
+        """
+        Останавливает выполняющиеся рассылки (во всех процессах). Отправленное до остановки сохраняется.
+
+        :return: ID остановленных рассылок.
+        """
+        async def apply(session: AsyncSession):
+            result = await session.execute(select(Broadcast.id).where(Broadcast.status == 'running'))
+            ids = list(result.scalars())
+            if ids:
+                await session.execute(update(Broadcast).where(Broadcast.id.in_(ids)).values(status='stopped'))
+            return ids
+
+        stopped = await write_queue.submit(apply)
+        for broadcast_id in stopped:
+            self._cancel(broadcast_id)
+            self._notify('stop', broadcast_id)
+        return stopped
+
+    def _notify(self, operation: str, broadcast_id: int) -> None:
+        if self.on_change is not None:
+            self.on_change(operation, broadcast_id)
+
+    def apply_change(self, operation: str, broadcast_id: int) -> None:
+        """
+        Запускает или останавливает свою часть рассылки по сообщению другого процесса.
+
+        :param operation: 'start' или 'stop'.
+        :param broadcast_id: ID рассылки.
+        """
+        if operation == 'stop':
+            self._cancel(broadcast_id)
+        elif self.session_pool is not None and broadcast_id not in self._tasks:
+            self._spawn(broadcast_id)
+
+    def _cancel(self, broadcast_id: int) -> None:
+        task = self._tasks.get(broadcast_id)
+        if task is not None:
+            task.cancel()
+
+    async def close(self) -> None:
+        """
+        Прерывает рассылки при остановке бота, не меняя их статус: после запуска они продолжатся.
+        """
+        self._closing = True
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, broadcast_id: int) -> None:
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _fetch(self, after: int) -> list[int]:
+        async with self.session_pool() as session:
+            return await recipients_page(session, after, self.batch_size, self.shard)
+
+    async def _run(self, broadcast_id: int) -> None:
+        current_update.set(None)  # Рассылка создается в обработчике апдейта администратора
+        index, count = self.shard or (0, 1)
+        async with self.session_pool() as session:
+            broadcast = await session.get(Broadcast, broadcast_id)
+            shard = await session.get(BroadcastShard, (broadcast_id, index))
+        if broadcast is None or broadcast.status != 'running':
+            return
+        if shard is not None and shard.shards == count:
+            if shard.done:
+                return
+            last_chat_id = shard.last_chat_id
+        else:  # Первый запуск или изменилось число процессов: с чата, до которого рассылку выполнили все
+            last_chat_id = broadcast.last_chat_id
+        admin_chat_id, text, photo = broadcast.admin_chat_id, broadcast.text, broadcast.photo
+        reporter = abs(admin_chat_id) % count == index  # Промежуточные отчеты - из процесса чата администратора
+        totals = {'sent': broadcast.sent, 'failed': broadcast.failed}  # Всех процессов на последнюю контрольную точку
+        started = last_report = time.monotonic()
+        sent_before = broadcast.sent  # Скорость считается по отправленному в этом запуске
+        queue: asyncio.Queue = asyncio.Queue()
+        counters = {'sent': 0, 'failed': 0}
+
+        async def worker() -> None:
+            while True:
+                chat_id = await queue.get()
+                try:
+                    await self.send(chat_id, text, photo)
+                except Exception:  # Ошибка уже в логе очереди исходящих
+                    counters['failed'] += 1
+                else:
+                    counters['sent'] += 1
+                finally:
+                    queue.task_done()
+
+        def progress() -> str:
+            elapsed = max(time.monotonic() - started, 1e-9)
+            sent = totals['sent'] + counters['sent']
+            return (f"отправлено {sent}, ошибок {totals['failed'] + counters['failed']}, "
+                    f"{(sent - sent_before) / elapsed:.1f} сообщений/с")
+
+        async def checkpoint(done: bool) -> tuple[str, bool]:
+            status, totals['sent'], totals['failed'], completed = await self._checkpoint(
+                broadcast_id, index, count, last_chat_id, counters['sent'], counters['failed'], done)
+            counters['sent'] = counters['failed'] = 0
+            return status, completed
+
+        pool = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        next_page = None
+        try:
+            page = await self._fetch(last_chat_id)
+            while page:
+                next_page = asyncio.create_task(self._fetch(page[-1]))  # Читаем, пока отправляется текущая
+                for chat_id in page:
+                    queue.put_nowait(chat_id)
+                await queue.join()
+
+                last_chat_id = page[-1]
+                status, _ = await checkpoint(done=False)
+                if status != 'running':  # Остановлена в другом процессе
+                    app_logger.info(f'Рассылка {broadcast_id} остановлена: {progress()}')
+                    return
+
+                page = await next_page
+                if reporter and time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    await self._report(admin_chat_id, f"Рассылка #{broadcast_id}: {progress()}")
+
+            _, completed = await checkpoint(done=True)
+            if completed:  # Свою часть закончили все процессы
+                app_logger.info(f'Рассылка {broadcast_id} завершена: {progress()}')
+                await self._report(admin_chat_id, f"Рассылка #{broadcast_id} завершена: {progress()}")
+            else:
+                app_logger.info(f'Рассылка {broadcast_id}: часть процесса {index} выполнена')
+        except asyncio.CancelledError:
+            reason = 'прервана остановкой бота, продолжится после запуска' if self._closing else 'остановлена'
+            app_logger.info(f'Рассылка {broadcast_id} {reason}: {progress()}')
+            if reporter:
+                await self._report(admin_chat_id, f"Рассылка #{broadcast_id} {reason}: {progress()}")
+            raise
+        except Exception as e:
+            app_logger.error(f'Ошибка рассылки {broadcast_id}: {e}')
+        finally:
+            for task in pool:
+                task.cancel()
+            if next_page is not None:
+                next_page.cancel()
+
+    @staticmethod
+    async def _checkpoint(broadcast_id: int, index: int, count: int, last_chat_id: int, sent: int, failed: int,
+                          done: bool) -> tuple[str, int, int, bool]:
+        """
+        Сохраняет прогресс процесса после отправки страницы и добавляет его счетчики к счетчикам рассылки.
+        Когда свою часть закончили все процессы, рассылка получает статус 'done'.
+
+        :return: Статус рассылки, отправлено и ошибок всеми процессами, True - рассылку завершил этот вызов.
+        """
+        async def apply(session: AsyncSession):
+            values = {'shards': count, 'last_chat_id': last_chat_id, 'done': done}
+            result = await session.execute(update(BroadcastShard).where(
+                BroadcastShard.broadcast_id == broadcast_id, BroadcastShard.shard == index).values(**values))
+            if not result.rowcount:
+                session.add(BroadcastShard(broadcast_id=broadcast_id, shard=index, **values))
+                await session.flush()
+            await session.execute(update(Broadcast).where(Broadcast.id == broadcast_id)
+                                  .values(sent=Broadcast.sent + sent, failed=Broadcast.failed + failed))
+
+            shards, finished, low = (await session.execute(
+                select(func.count(), func.sum(case((BroadcastShard.done, 1), else_=0)),
+                       func.min(case((BroadcastShard.done, None), else_=BroadcastShard.last_chat_id)))
+                .where(BroadcastShard.broadcast_id == broadcast_id, BroadcastShard.shards == count))).one()
+            completed = False
+            if finished == count:
+                result = await session.execute(update(Broadcast).where(
+                    Broadcast.id == broadcast_id, Broadcast.status == 'running').values(status='done'))
+                completed = bool(result.rowcount)
+            elif shards == count:  # Все процессы сохранили прогресс: до low рассылка выполнена всеми
+                await session.execute(update(Broadcast).where(
+                    Broadcast.id == broadcast_id, Broadcast.last_chat_id < low).values(last_chat_id=low))
+            status, total_sent, total_failed = (await session.execute(
+                select(Broadcast.status, Broadcast.sent, Broadcast.failed).where(Broadcast.id == broadcast_id))).one()
+            return status, total_sent, total_failed, completed
+
+        return await write_queue.submit(apply)
+
+    async def _report(self, admin_chat_id: int, text: str) -> None:
+        try:
+            await self.report(admin_chat_id, text)
+        except Exception as e:
+            app_logger.error(f'Не удалось отправить отчет о рассылке: {e}')
+
+
+broadcaster = Broadcaster()
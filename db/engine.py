@@ -2,13 +2,30 @@ import os
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 
 from common.text_for import description_for_info_pages
+from db.engine_profile import get_profile, install_profile
+from db.migrations import is_schema_current, run_migrations, save_schema_fingerprint
 from db.models import Base
 from db.orm_query import orm_add_banner_description
+from db.query_profile import query_profiler
+from db.write_queue import write_queue
+from logging_config import setup_logging
 
 
-engine = create_async_engine(os.getenv("DB_LITE"), echo=True)
+# SQL-запросы пишутся через общую очередь логирования и только если это включено настройкой
+# LOG_LEVELS="sqlalchemy.engine=INFO" (echo=True печатал каждый запрос синхронно в потоке event loop)
+setup_logging("sqlalchemy.engine", "logs/sql.log")
+
+# Профиль движка: для SQLite - WAL, PRAGMA на каждом соединении и размеры пула (см. db.engine_profile)
+engine_profile = get_profile(os.getenv("DB_LITE"))
+engine = create_async_engine(os.getenv("DB_LITE"), **engine_profile.engine_kwargs)
+install_profile(engine, engine_profile)
+# Вместо журнала всех запросов - сводка по отпечаткам и журнал запросов дольше SLOW_QUERY_MS (QUERY_PROFILE=0 отключает)
+query_profiler.threshold_ms = float(os.getenv('SLOW_QUERY_MS', 100))
+if os.getenv('QUERY_PROFILE', '1') != '0':
+    query_profiler.install(engine)
 
 session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+write_queue.session_pool = session_maker  # Изменения записей выполняются через общую очередь записи
 
 
 async def create_db():
@@ -16,18 +33,33 @@ async def create_db():
         Создает базу данных и добавляет данные в таблицу базы данных.
 
         Функция выполняет следующие действия:
-        1. Создает структуру базы данных, основанную на метаданных модели `Base`.
-        2. Открывает новую асинхронную сессию для взаимодействия с базой данных.
-        3. Добавляет описание баннера, полученное из `description_for_info_pages`, используя функцию `orm_add_banner_description`.
+        1. Сверяет отпечаток схемы в таблице schema_version (см. db.migrations.schema_fingerprint). Если схема
+           и начальные данные не менялись с прошлого запуска, на этом работа заканчивается: один запрос
+           вместо create_all (чтение описания каждой таблицы) и проверки баннеров.
+        2. Создает структуру базы данных, основанную на метаданных модели `Base`.
+        3. Применяет версионированные миграции (см. db.migrations), чтобы существующие базы получили новые
+           колонки и индексы.
+        4. Открывает новую асинхронную сессию для взаимодействия с базой данных.
+        5. Добавляет описание баннера, полученное из `description_for_info_pages`, используя функцию `orm_add_banner_description`.
+        6. Сохраняет отпечаток схемы для следующего запуска.
 
         Использует:
             - engine: асинхронный движок базы данных.
             - session_maker: фабрикатор сессий для создания асинхронных сессий.
+
+        :return: True, если схема проверялась и обновлялась, False, если она уже была актуальной.
         """
+    async with engine.connect() as conn:
+        if await conn.run_sync(is_schema_current):
+            return False
+
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(run_migrations)
 
     async with session_maker() as session:
         await orm_add_banner_description(session, description_for_info_pages)
 
-
+    async with engine.begin() as conn:
+        await conn.run_sync(save_schema_fingerprint)
+    return True
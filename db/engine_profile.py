@@ -0,0 +1,136 @@
+# Профили настроек движка базы данных (PRAGMA SQLite, размеры пула, периодическая оптимизация)
+import asyncio
+import os
+from dataclasses import dataclass, field
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from logging_config import setup_logging
+
+# Настройка логгирования
+app_logger = setup_logging("engine_profile", "logs/orm.log")
+
+
+@dataclass(frozen=True)
+class EngineProfile:
+    """
+    Именованный набор настроек движка.
+
+    :param name: Имя профиля (задается переменной окружения DB_PROFILE).
+    :param pragmas: PRAGMA, которые выполняются на каждом новом соединении (только SQLite).
+    :param engine_kwargs: Дополнительные аргументы create_async_engine (размеры пула и т.п.).
+    :param optimize_interval: Интервал запуска PRAGMA optimize в секундах, None - не запускать.
+    """
+    name: str
+    pragmas: dict = field(default_factory=dict)
+    engine_kwargs: dict = field(default_factory=dict)
+    optimize_interval: float | None = None
+
+
+PROFILES = {
+    # Настройки движка по умолчанию (например, для PostgreSQL)
+    'default': EngineProfile('default'),
+    # SQLite в режиме WAL: читатели не блокируют писателя, запись ждет блокировку до busy_timeout
+    # вместо немедленной ошибки "database is locked". Каждое соединение aiosqlite - отдельный поток,
+    # поэтому пул небольшой: запись в SQLite все равно идет по одной.
+    'sqlite': EngineProfile(
+        'sqlite',
+        pragmas={
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,  # мс
+            'cache_size': -16000,  # отрицательное значение - в КиБ (16 МиБ на соединение)
+            'mmap_size': 128 * 1024 * 1024,
+            'temp_store': 'MEMORY',
+        },
+        engine_kwargs={'pool_size': 4, 'max_overflow': 4, 'pool_timeout': 10},
+        optimize_interval=6 * 3600,
+    ),
+}
+
+
+def get_profile(url: str) -> EngineProfile:
+    """
+    Выбирает профиль движка: из переменной окружения DB_PROFILE или по адресу базы данных.
+
+    :param url: Адрес базы данных (DB_LITE).
+    :return: Профиль движка.
+    """
+    file_sqlite = url.startswith('sqlite') and ':memory:' not in url  # У базы в памяти нет пула и WAL
+    name = os.getenv('DB_PROFILE') or ('sqlite' if file_sqlite else 'default')
+    return PROFILES[name]
+
+
+def install_profile(engine: AsyncEngine, profile: EngineProfile) -> None:
+    """
+    Подключает к движку обработчик события connect, который выполняет PRAGMA профиля.
+
+    :param engine: Асинхронный движок.
+    :param profile: Профиль движка.
+    """
+    if not profile.pragmas or engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine.sync_engine, 'connect')
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in profile.pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+async def report_settings(engine: AsyncEngine, profile: EngineProfile) -> dict:
+    """
+    Выводит в лог фактические настройки движка: значения PRAGMA и параметры пула.
+
+    :param engine: Асинхронный движок.
+    :param profile: Профиль движка.
+    :return: Словарь с фактическими настройками.
+    """
+    settings = {'profile': profile.name, 'pool': engine.pool.status()}
+    if engine.dialect.name == 'sqlite':
+        async with engine.connect() as conn:
+            for name in profile.pragmas:
+                settings[name] = (await conn.exec_driver_sql(f'PRAGMA {name}')).scalar()
+    app_logger.info(f'Настройки движка базы данных: {settings}')
+    return settings
+
+
+async def optimize(engine: AsyncEngine) -> None:
+    """
+    Обновляет статистику планировщика SQLite (PRAGMA optimize с ограничением объема анализа).
+
+    :param engine: Асинхронный движок.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    async with engine.begin() as conn:
+        await conn.exec_driver_sql('PRAGMA analysis_limit=400')
+        await conn.exec_driver_sql('PRAGMA optimize')
+
+
+async def run_periodic_optimize(engine: AsyncEngine, profile: EngineProfile) -> None:
+    """
+    Периодически запускает optimize. Первый запуск выполняет ANALYZE, если статистики еще нет.
+
+    :param engine: Асинхронный движок.
+    :param profile: Профиль движка.
+    """
+    if profile.optimize_interval is None or engine.dialect.name != 'sqlite':
+        return
+    try:
+        async with engine.begin() as conn:
+            has_stats = (await conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")).scalar()
+            if not has_stats:
+                await conn.exec_driver_sql('PRAGMA analysis_limit=400')
+                await conn.exec_driver_sql('ANALYZE')
+    except Exception as e:
+        app_logger.error(f'Ошибка ANALYZE: {e}')
+    while True:
+        await asyncio.sleep(profile.optimize_interval)
+        try:
+            await optimize(engine)
+        except Exception as e:
+            app_logger.error(f'Ошибка PRAGMA optimize: {e}')
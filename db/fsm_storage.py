@@ -0,0 +1,174 @@
+# Хранилище состояний FSM в базе данных (вместо MemoryStorage aiogram)
+import asyncio
+import json
+import time
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from sqlalchemy import delete, insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from common.metrics import current_update
+from db.models import FSMRecord
+from logging_config import setup_logging
+
+# Настройка логгирования
+app_logger = setup_logging("fsm_storage", "logs/orm.log")
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM поверх существующего движка и session_maker.
+
+    Состояния читаются из базы лениво (один раз на чат) и дальше обслуживаются из памяти.
+    Изменения копятся в памяти и записываются пачками: раз в flush_interval секунд или сразу,
+    как только накопилось batch_size измененных ключей. Брошенные диалоги (без изменений дольше ttl)
+    удаляются из памяти и базы фоновой задачей. Данные хранятся в JSON, поэтому в них можно класть
+    только сериализуемые значения (ID записей, строки, числа), но не объекты ORM.
+
+    :param session_pool: Фабрика асинхронных сессий.
+    :param key_builder: Построитель ключей хранилища.
+    :param flush_interval: Максимальная задержка записи изменений в базу, в секундах.
+    :param batch_size: Количество измененных ключей, при котором запись начинается сразу.
+    :param ttl: Время жизни диалога без изменений, в секундах.
+    :param sweep_interval: Интервал между проверками брошенных диалогов, в секундах.
+    """
+
+    def __init__(self, session_pool: async_sessionmaker, key_builder: KeyBuilder | None = None,
+                 flush_interval: float = 0.5, batch_size: int = 100,
+                 ttl: float = 3600, sweep_interval: float = 300) -> None:
+        self.session_pool = session_pool
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+
+        self._records: dict[str, list] = {}  # ключ -> [состояние, данные, время изменения]
+        self._dirty: set[str] = set()
+        self._flush_requested: asyncio.Event | None = None
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        """
+        Запускает фоновые задачи записи и очистки. Вызывается автоматически при первом изменении.
+        """
+        if self._tasks:
+            return
+        self._flush_requested = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._flush_loop()), asyncio.create_task(self._sweep_loop())]
+
+    async def _record(self, key: StorageKey) -> list:
+        """
+        Возвращает запись ключа из памяти, при первом обращении загружая ее из базы данных.
+        """
+        storage_key = self.key_builder.build(key)
+        record = self._records.get(storage_key)
+        if record is not None:
+            return record
+
+        async with self.session_pool() as session:
+            row = await session.get(FSMRecord, storage_key)
+        record = self._records.get(storage_key)
+        if record is not None:  # Запись появилась, пока шел запрос
+            return record
+        if row is None:
+            record = [None, {}, time.time()]
+        else:
+            record = [row.state, json.loads(row.data) if row.data else {}, row.touched]
+        self._records[storage_key] = record
+        return record
+
+    def _touch(self, key: StorageKey, record: list) -> None:
+        record[2] = time.time()
+        self._dirty.add(self.key_builder.build(key))
+        self.start()
+        if len(self._dirty) >= self.batch_size:
+            self._flush_requested.set()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        record[0] = state.state if isinstance(state, State) else state
+        self._touch(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._record(key)
+        record[1] = data.copy()
+        self._touch(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._record(key))[1].copy()
+
+    async def flush(self) -> None:
+        """
+        Записывает накопленные изменения в базу данных одной транзакцией.
+        """
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        rows = []
+        for storage_key in keys:
+            record = self._records.get(storage_key)
+            if record is None or (record[0] is None and not record[1]):
+                continue  # Пустое состояние в базе не храним
+            rows.append({'key': storage_key, 'state': record[0], 'data': json.dumps(record[1], ensure_ascii=False),
+                         'touched': record[2]})
+        try:
+            async with self.session_pool() as session:
+                await session.execute(delete(FSMRecord).where(FSMRecord.key.in_(keys)))
+                if rows:
+                    await session.execute(insert(FSMRecord), rows)
+                await session.commit()
+        except Exception as e:
+            app_logger.error(f'Ошибка записи состояний FSM: {e}')
+            self._dirty |= keys  # Повторим при следующей записи
+
+    async def _flush_loop(self) -> None:
+        current_update.set(None)  # Задача запускается при первом изменении состояния, в обработчике апдейта
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+
+    async def sweep(self) -> int:
+        """
+        Удаляет диалоги, которые не менялись дольше ttl.
+
+        :return: Количество удаленных из памяти записей.
+        """
+        cutoff = time.time() - self.ttl
+        stale = [key for key, record in self._records.items() if record[2] < cutoff and key not in self._dirty]
+        for key in stale:
+            del self._records[key]
+        try:
+            async with self.session_pool() as session:
+                await session.execute(delete(FSMRecord).where(FSMRecord.touched < cutoff))
+                await session.commit()
+        except Exception as e:
+            app_logger.error(f'Ошибка очистки состояний FSM: {e}')
+        if stale:
+            app_logger.info(f'Удалено брошенных диалогов: {len(stale)}')
+        return len(stale)
+
+    async def _sweep_loop(self) -> None:
+        current_update.set(None)
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            await self.sweep()
+
+    async def close(self) -> None:
+        """
+        Останавливает фоновые задачи и записывает оставшиеся изменения.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
@@ -0,0 +1,156 @@
+# Реестр изображений: файлы из папки image загружаются в Telegram один раз, дальше фото отправляются по file_id
+import asyncio
+import hashlib
+import os
+from typing import Awaitable, Callable
+
+from aiogram.types import FSInputFile
+from sqlalchemy import or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from db.models import Media
+from db.write_queue import write_queue
+from logging_config import setup_logging
+
+# Настройка логгирования
+app_logger = setup_logging("media", "logs/orm.log")
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+CHUNK_SIZE = 1 << 16
+
+Upload = Callable[[str], Awaitable[str]]  # Путь к файлу -> file_id загруженного фото
+
+
+def hash_file(path: str) -> str:
+    """
+    :param path: Путь к файлу.
+    :return: SHA-256 содержимого файла (hex).
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_directory(directory: str) -> dict[str, str]:
+    """
+    Считает хеши изображений в папке (без вложенных папок).
+
+    :param directory: Путь к папке.
+    :return: Словарь {имя файла: хеш}, пустой, если папки нет.
+    """
+    if not os.path.isdir(directory):
+        return {}
+    return {name: hash_file(os.path.join(directory, name)) for name in sorted(os.listdir(directory))
+            if name.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(os.path.join(directory, name))}
+
+
+class MediaRegistry:
+    """
+    Реестр изображений из папки image.
+
+    При запуске (sync) считает хеши файлов и одним запросом находит в таблице media уже известные.
+    В Telegram загружаются только файлы с новым содержимым, их file_id сохраняется по хешу. Повторные
+    запуски и новые экземпляры бота с теми же файлами ничего не загружают, фото отправляются по file_id.
+    Измененный файл получает новый хеш и загружается заново; file_id его прежних версий собираются
+    в replaced, чтобы заменить их у баннеров (см. orm_fill_banner_images).
+
+    :param directory: Папка с изображениями.
+    """
+
+    def __init__(self, directory: str = 'image') -> None:
+        self.directory = directory
+        self.file_ids: dict[str, str] = {}  # Имя файла -> file_id
+        self.replaced: dict[str, list[str]] = {}  # Имя файла -> file_id прежних версий файла
+        self.uploaded = 0
+        self.reused = 0
+        self.missing = 0  # Файлы, которые не удалось загрузить
+
+    async def sync(self, session_pool: async_sessionmaker, upload: Upload | None) -> dict[str, str]:
+        """
+        Сверяет файлы папки с таблицей media и загружает в Telegram файлы с неизвестным хешем.
+
+        :param session_pool: Фабрика асинхронных сессий.
+        :param upload: Корутина загрузки файла, возвращающая file_id. Если None (некуда загружать),
+                       новые файлы пропускаются.
+        :return: Словарь {имя файла: file_id} для файлов, у которых есть file_id.
+        """
+        hashes = await asyncio.to_thread(hash_directory, self.directory)  # Чтение файлов не блокирует цикл событий
+        if not hashes:
+            return {}
+        async with session_pool() as session:
+            rows = (await session.execute(
+                select(Media.hash, Media.name, Media.file_id)
+                .where(or_(Media.hash.in_(set(hashes.values())), Media.name.in_(list(hashes))))
+            )).all()
+        known = {digest: file_id for digest, _, file_id in rows}
+        self.replaced = {}
+        for digest, name, file_id in rows:
+            if name in hashes and hashes[name] != digest:
+                self.replaced.setdefault(name, []).append(file_id)
+
+        new = []
+        for name, digest in hashes.items():
+            file_id = known.get(digest)
+            if file_id is not None:
+                self.reused += 1
+            elif upload is None:
+                self.missing += 1
+                continue
+            else:
+                try:
+                    file_id = await upload(os.path.join(self.directory, name))
+                except Exception as e:
+                    self.missing += 1
+                    app_logger.error(f'Не удалось загрузить {name}: {e}')
+                    continue
+                self.uploaded += 1
+                known[digest] = file_id  # Файл с тем же содержимым под другим именем не загружается
+                new.append(Media(hash=digest, name=name, file_id=file_id))
+            self.file_ids[name] = file_id
+
+        if new:
+            await self._save(new)
+        if self.missing:
+            app_logger.warning(f'Изображений без file_id: {self.missing} (не задан MEDIA_CHAT_ID или ошибка загрузки)')
+        app_logger.info(f'Изображения: загружено {self.uploaded}, из базы {self.reused}')
+        return dict(self.file_ids)
+
+    @staticmethod
+    async def _save(rows: list[Media]) -> None:
+        async def apply(session: AsyncSession):
+            for row in rows:
+                await session.merge(row)
+
+        try:
+            await write_queue.submit(apply)
+        except IntegrityError:  # Тот же файл одновременно загрузил другой экземпляр бота
+            app_logger.info('Изображения уже сохранены другим экземпляром бота')
+
+    def file_id(self, name: str) -> str | None:
+        """
+        :param name: Имя файла, например 'main.jpg'.
+        :return: file_id фото или None, если файл не загружен.
+        """
+        return self.file_ids.get(name)
+
+    def input_file(self, name: str) -> FSInputFile | None:
+        """
+        Запасной вариант, если у файла нет file_id: фото загружается при каждой отправке.
+
+        :param name: Имя файла.
+        :return: FSInputFile или None, если файла нет.
+        """
+        path = os.path.join(self.directory, name)
+        return FSInputFile(path) if os.path.isfile(path) else None
+
+    def stats(self) -> dict:
+        """
+        :return: Счетчики загруженных, взятых из базы и не загруженных файлов.
+        """
+        return {'uploaded': self.uploaded, 'reused': self.reused, 'missing': self.missing}
+
+
+media_registry = MediaRegistry(os.getenv('MEDIA_DIR', 'image'))
@@ -0,0 +1,263 @@
+# Версионированные миграции схемы базы данных
+import zlib
+
+from sqlalchemy import Connection, bindparam, delete, func, inspect, insert, select, text, update
+from sqlalchemy.exc import DBAPIError
+
+from common.phone import phone_keys
+from db.models import Base, Broadcast, BroadcastShard, Media, SchemaVersion, User, UserArchive
+from logging_config import setup_logging
+
+# Настройка логгирования
+app_logger = setup_logging("migrations", "logs/orm.log")
+
+
+def _table_index(table, name: str):
+    return next(index for index in table.indexes if index.name == name)
+
+
+def _column_names(conn: Connection, table: str) -> set:
+    return {column['name'] for column in inspect(conn).get_columns(table)}
+
+
+def _drop_orphan_appointments(conn: Connection) -> None:
+    """Удаляет таблицу appointments, оставшуюся от старой версии бота."""
+    conn.execute(text('DROP TABLE IF EXISTS appointments'))
+
+
+def _add_user_day(conn: Connection) -> None:
+    """Добавляет колонку user.day (дата без времени), заполняет ее и строит индекс (day, time)."""
+    if 'day' not in _column_names(conn, User.__tablename__):
+        table = conn.dialect.identifier_preparer.quote(User.__tablename__)
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN day DATE'))
+    conn.execute(update(User).where(User.day.is_(None)).values(day=func.date(User.date)))
+    _table_index(User.__table__, 'ix_user_day_time').create(conn, checkfirst=True)
+
+
+def _add_user_phone_index(conn: Connection) -> None:
+    """Строит индекс по user.phone для поиска заявок по телефону (заменен на ix_user_phone_key в миграции 6)."""
+    table = conn.dialect.identifier_preparer.quote(User.__tablename__)
+    conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_user_phone ON {table} (phone)'))
+
+
+def _add_user_reminders(conn: Connection) -> None:
+    """Добавляет колонки user.chat_id и user.reminded для напоминаний о записи."""
+    columns = _column_names(conn, User.__tablename__)
+    table = conn.dialect.identifier_preparer.quote(User.__tablename__)
+    if 'chat_id' not in columns:
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN chat_id BIGINT'))
+    if 'reminded' not in columns:
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN reminded INTEGER NOT NULL DEFAULT 0'))
+
+
+def _add_broadcast(conn: Connection) -> None:
+    """Создает таблицу broadcast (прогресс рассылок) и индекс по user.chat_id для обхода получателей."""
+    Broadcast.__table__.create(conn, checkfirst=True)
+    _table_index(User.__table__, 'ix_user_chat_id').create(conn, checkfirst=True)
+
+
+PHONE_BACKFILL_BATCH = 5000  # Строк user за один шаг заполнения phone_key
+
+
+def _add_user_phone_key(conn: Connection) -> None:
+    """
+    Добавляет колонку user.phone_key, заполняет ее пакетами (common.phone.phone_keys) и строит индекс
+    ix_user_phone_key. Индекс ix_user_phone больше не нужен: заявки ищутся по ключу.
+    """
+    if 'phone_key' not in _column_names(conn, User.__tablename__):
+        table = conn.dialect.identifier_preparer.quote(User.__tablename__)
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN phone_key BIGINT'))
+
+    user = User.__table__
+    fill = update(user).where(user.c.id == bindparam('row_id')).values(phone_key=bindparam('key'))
+    last_id, filled = 0, 0
+    while True:
+        rows = conn.execute(
+            select(user.c.id, user.c.phone)
+            .where(user.c.id > last_id, user.c.phone_key.is_(None), user.c.phone.is_not(None))
+            .order_by(user.c.id).limit(PHONE_BACKFILL_BATCH)
+        ).all()
+        if not rows:
+            break
+        params = [{'row_id': row_id, 'key': key}
+                  for (row_id, _), key in zip(rows, phone_keys(phone for _, phone in rows)) if key is not None]
+        if params:
+            conn.execute(fill, params)
+            filled += len(params)
+        last_id = rows[-1][0]
+    app_logger.info(f'Заполнено user.phone_key: {filled}')
+
+    _table_index(user, 'ix_user_phone_key').create(conn, checkfirst=True)
+    conn.execute(text('DROP INDEX IF EXISTS ix_user_phone'))
+
+
+def _add_schema_fingerprint(conn: Connection) -> None:
+    """Добавляет колонку schema_version.fingerprint для быстрой проверки схемы при запуске."""
+    if 'fingerprint' not in _column_names(conn, SchemaVersion.__tablename__):
+        conn.execute(text('ALTER TABLE schema_version ADD COLUMN fingerprint VARCHAR(64)'))
+
+
+def _add_media(conn: Connection) -> None:
+    """Создает таблицу media (file_id загруженных в Telegram файлов из папки image)."""
+    Media.__table__.create(conn, checkfirst=True)
+
+
+def _add_user_archive(conn: Connection) -> None:
+    """Создает таблицу user_archive (прошедшие записи, см. db.archive) с индексами."""
+    UserArchive.__table__.create(conn, checkfirst=True)
+
+
+def _add_user_archive_source_id(conn: Connection) -> None:
+    """
+    Пересоздает user_archive с собственным ключом id и колонкой source_id (id записи в таблице user):
+    id из user выдаются повторно после переноса последних записей, и архивация падала на уникальности ключа.
+    """
+    if 'source_id' in _column_names(conn, UserArchive.__tablename__):
+        return
+    conn.execute(text('ALTER TABLE user_archive RENAME TO user_archive_old'))
+    for index in UserArchive.__table__.indexes:  # Имена индексов остались за старой таблицей
+        conn.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+    UserArchive.__table__.create(conn)
+    columns = ', '.join(conn.dialect.identifier_preparer.quote(column.name) for column in UserArchive.__table__.columns
+                        if column.name not in ('id', 'source_id'))
+    conn.execute(text(f'INSERT INTO user_archive (source_id, {columns}) SELECT id, {columns} FROM user_archive_old'))
+    conn.execute(text('DROP TABLE user_archive_old'))
+
+
+def _add_broadcast_shard(conn: Connection) -> None:
+    """Создает таблицу broadcast_shard (прогресс рассылки в каждом процессе бота, см. cluster.py)."""
+    BroadcastShard.__table__.create(conn, checkfirst=True)
+
+
+# (версия, описание, функция миграции). Новые миграции добавляются только в конец списка.
+MIGRATIONS = [
+    (1, 'Удаление неиспользуемой таблицы appointments', _drop_orphan_appointments),
+    (2, 'Колонка user.day и индекс (day, time)', _add_user_day),
+    (3, 'Индекс user.phone', _add_user_phone_index),
+    (4, 'Колонки user.chat_id и user.reminded для напоминаний', _add_user_reminders),
+    (5, 'Таблица broadcast и индекс user.chat_id для рассылок', _add_broadcast),
+    (6, 'Колонка user.phone_key и индекс по ней для поиска заявок', _add_user_phone_key),
+    (7, 'Колонка schema_version.fingerprint', _add_schema_fingerprint),
+    (8, 'Таблица media для file_id изображений', _add_media),
+    (9, 'Таблица user_archive для прошедших записей', _add_user_archive),
+    (10, 'Собственный ключ user_archive.id и колонка source_id', _add_user_archive_source_id),
+    (11, 'Таблица broadcast_shard для рассылки несколькими процессами', _add_broadcast_shard),
+]
+
+SEED_VERSION = 1  # Версия начальных данных (описания баннеров): увеличивается при изменении заполнения
+
+# Запросы, планы которых выводятся в лог до и после миграций (только для SQLite)
+PLAN_QUERIES_BEFORE = {
+    'слоты на дату': ('SELECT time FROM user WHERE date(date) = ?', ('2000-01-01',)),
+    'заявки по телефону': ('SELECT * FROM user WHERE phone = ?', ('+7(000)000-00-00',)),
+}
+PLAN_QUERIES_AFTER = {
+    'слоты на дату': ('SELECT time FROM user WHERE day = ?', ('2000-01-01',)),
+    'заявки по телефону': ('SELECT * FROM user WHERE phone_key = ? ORDER BY id', (70000000000,)),
+}
+
+
+def query_plans(conn: Connection, queries: dict) -> dict:
+    """
+    Возвращает планы выполнения запросов (EXPLAIN QUERY PLAN).
+
+    :param conn: Синхронное соединение с базой данных SQLite.
+    :param queries: Словарь {название: (SQL, параметры)}.
+    :return: Словарь {название: план} для запросов, которые удалось разобрать.
+    """
+    plans = {}
+    for name, (sql, params) in queries.items():
+        try:
+            rows = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+        except Exception as e:
+            plans[name] = f'ошибка: {e}'
+            continue
+        plans[name] = '; '.join(str(row[-1]) for row in rows)
+    return plans
+
+
+def get_schema_version(conn: Connection) -> int:
+    """
+    Возвращает номер последней примененной миграции.
+
+    :param conn: Синхронное соединение с базой данных.
+    :return: Версия схемы или 0, если миграции еще не применялись.
+    """
+    SchemaVersion.__table__.create(conn, checkfirst=True)
+    return conn.execute(select(SchemaVersion.version)).scalar() or 0
+
+
+def schema_fingerprint() -> str:
+    """
+    Возвращает отпечаток схемы: номер последней миграции, версию начальных данных и контрольную сумму
+    таблиц, колонок и индексов моделей. Любое изменение моделей меняет отпечаток, и при следующем
+    запуске create_db выполняет полную проверку схемы.
+
+    :return: Строка вида '7.1.1a2b3c4d'.
+    """
+    items = []
+    for table in Base.metadata.sorted_tables:
+        items.extend(f'{table.name}.{column.name}:{column.type}:{column.nullable}' for column in table.columns)
+        items.extend(f'{table.name}#{index.name}' for index in table.indexes)
+    checksum = zlib.crc32('\n'.join(sorted(items)).encode())
+    return f'{MIGRATIONS[-1][0]}.{SEED_VERSION}.{checksum:08x}'
+
+
+def is_schema_current(conn: Connection) -> bool:
+    """
+    Проверяет одним запросом, что схема и начальные данные базы соответствуют текущей версии бота.
+
+    :param conn: Синхронное соединение с базой данных.
+    :return: True, если сохраненный отпечаток совпадает с schema_fingerprint().
+    """
+    try:
+        stored = conn.exec_driver_sql('SELECT fingerprint FROM schema_version').scalar()  # Без компиляции ORM-запроса
+    except DBAPIError:  # Новая база или таблица schema_version без колонки fingerprint
+        return False
+    return stored == schema_fingerprint()
+
+
+def save_schema_fingerprint(conn: Connection) -> None:
+    """
+    Сохраняет отпечаток схемы после миграций и заполнения начальных данных.
+
+    :param conn: Синхронное соединение с базой данных (внутри транзакции).
+    """
+    conn.execute(update(SchemaVersion).values(fingerprint=schema_fingerprint()))
+
+
+def run_migrations(conn: Connection) -> int:
+    """
+    Применяет к базе данных миграции, которые еще не были применены.
+
+    Каждая миграция идемпотентна: на свежей базе, созданной через create_all, она ничего не меняет,
+    а на старой базе (например, base_db) доводит схему до текущей. Номер последней миграции
+    сохраняется в таблице schema_version. Для SQLite в лог выводятся планы запросов слотов и поиска
+    по телефону до и после миграций.
+
+    Вызывается через `conn.run_sync(run_migrations)` из create_db.
+
+    :param conn: Синхронное соединение с базой данных (внутри транзакции).
+    :return: Версия схемы после миграций.
+    """
+    current = get_schema_version(conn)
+    pending = [migration for migration in MIGRATIONS if migration[0] > current]
+    if not pending:
+        return current
+
+    sqlite = conn.dialect.name == 'sqlite'
+    if sqlite:
+        app_logger.info(f'Планы запросов до миграций: {query_plans(conn, PLAN_QUERIES_BEFORE)}')
+
+    for version, description, migrate in pending:
+        app_logger.info(f'Миграция {version}: {description}')
+        migrate(conn)
+        current = version
+
+    conn.execute(delete(SchemaVersion))
+    conn.execute(insert(SchemaVersion).values(id=1, version=current))
+
+    if sqlite:
+        app_logger.info(f'Планы запросов после миграций: {query_plans(conn, PLAN_QUERIES_AFTER)}')
+    app_logger.info(f'Версия схемы базы данных: {current}')
+    return current
@@ -1,4 +1,5 @@
-from sqlalchemy import String, Text, DateTime, func, DECIMAL, BigInteger, UniqueConstraint
+from sqlalchemy import String, Text, DateTime, Date, func, DECIMAL, BigInteger, UniqueConstraint, Float, Index, Integer, \
+    Boolean
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 
@@ -47,22 +48,169 @@ class User(Base):
         Атрибуты:
             id (Mapped[int]): Уникальный идентификатор записи (первичный ключ).
             name (Mapped[str]): Имя пользователя, необязательное поле (до 150 символов).
-            phone (Mapped[str]): Номер телефона пользователя, необязательное поле (до 13 символов).
+            phone (Mapped[str]): Номер телефона пользователя в виде +7(XXX)XXX-XX-XX, необязательное поле.
+            phone_key (Mapped[int]): Нормализованный номер (E.164 без '+', см. common.phone), по нему ищутся заявки.
             date (Mapped[DateTime]): Дата записи, обязательное поле.
+            day (Mapped[Date]): Та же дата без времени. По ней идут запросы слотов (простое равенство по индексу).
             time (Mapped[str]): Время записи, обязательное поле (например, '10:00').
+            chat_id (Mapped[int]): Чат Telegram, из которого сделана запись (для напоминаний).
+            reminded (Mapped[int]): Отправленные напоминания, битовая маска (см. db.reminders).
 
         Ограничения:
             __table_args__: Уникальность записи по сочетанию полей `date` и `time`, чтобы гарантировать,
                             что на одну дату не может быть записано более одной записи в одно и то же время.
+                            Индексы по (`day`, `time`) для запросов слотов, по `phone_key` для поиска заявок
+                            и по `chat_id` для постраничного обхода получателей рассылки.
         """
 
     __tablename__ = 'user'
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)  # Уникальный идентификатор записи
     name: Mapped[str] = mapped_column(String(150), nullable=True)  # Не уникальное
-    phone: Mapped[str] = mapped_column(String(13), nullable=True)  # Не уникальное
+    phone: Mapped[str] = mapped_column(String(16), nullable=True)  # Не уникальное, '+7(XXX)XXX-XX-XX' - 16 символов
+    phone_key: Mapped[int] = mapped_column(BigInteger, nullable=True)  # Ключ номера для поиска (миграция 6)
     date: Mapped[DateTime] = mapped_column(DateTime, nullable=False)  # Дата записи
+    day: Mapped[Date] = mapped_column(Date, nullable=True)  # Дата записи без времени (заполняется миграцией 2)
     time: Mapped[str] = mapped_column(String(5), nullable=False)  # Время записи (например, '10:00')
+    chat_id: Mapped[int] = mapped_column(BigInteger, nullable=True)  # Чат для напоминаний (миграция 4)
+    reminded: Mapped[int] = mapped_column(Integer, default=0, server_default='0')  # Отправленные напоминания
     __table_args__ = (
         UniqueConstraint('date', 'time', name='uq_user_date_time'),
         # Уникальность по user_id, date и time
+        Index('ix_user_day_time', 'day', 'time'),
+        Index('ix_user_phone_key', 'phone_key'),
+        Index('ix_user_chat_id', 'chat_id'),
+    )
+
+
+class FSMRecord(Base):
+    """
+        Состояние FSM одного чата (см. db.fsm_storage.SQLiteStorage).
+
+        Атрибуты:
+            key (Mapped[str]): Ключ хранилища, собранный из StorageKey (первичный ключ).
+            state (Mapped[str]): Текущее состояние, например 'AddUser:phone'.
+            data (Mapped[str]): Данные состояния в формате JSON.
+            touched (Mapped[float]): Время последнего изменения (unix time), по нему удаляются брошенные диалоги.
+        """
+
+    __tablename__ = 'fsm_state'
+    key: Mapped[str] = mapped_column(String(100), primary_key=True)
+    state: Mapped[str] = mapped_column(String(100), nullable=True)
+    data: Mapped[str] = mapped_column(Text, nullable=True)
+    touched: Mapped[float] = mapped_column(Float, index=True)
+
+
+class SchemaVersion(Base):
+    """
+        Версия схемы базы данных (см. db.migrations).
+
+        Атрибуты:
+            id (Mapped[int]): Номер строки, в таблице всегда одна строка.
+            version (Mapped[int]): Номер последней примененной миграции.
+            fingerprint (Mapped[str]): Отпечаток схемы и начальных данных (db.migrations.schema_fingerprint),
+                при совпадении create_db не выполняет DDL и заполнение.
+        """
+
+    __tablename__ = 'schema_version'
+    id: Mapped[int] = mapped_column(primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, nullable=False)
+    fingerprint: Mapped[str] = mapped_column(String(64), nullable=True)
+
+
+MIN_CHAT_ID = -2 ** 63  # Меньше любого chat_id (у групп они отрицательные): начало обхода получателей рассылки
+
+
+class Broadcast(Base):
+    """
+        Рассылка администратора и ее прогресс (см. db.broadcast).
+
+        Атрибуты:
+            id (Mapped[int]): Уникальный идентификатор рассылки (первичный ключ).
+            admin_chat_id (Mapped[int]): Чат администратора, куда отправляются отчеты о ходе рассылки.
+            text (Mapped[str]): Текст сообщения или подпись к фото.
+            photo (Mapped[str]): file_id фото в Telegram или None.
+            last_chat_id (Mapped[int]): Чат, до которого (включительно) рассылка уже выполнена всеми процессами.
+            sent (Mapped[int]): Отправлено сообщений (всеми процессами).
+            failed (Mapped[int]): Ошибок отправки (например, пользователь заблокировал бота).
+            status (Mapped[str]): 'running', 'done' или 'stopped'.
+        """
+
+    __tablename__ = 'broadcast'
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    admin_chat_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    text: Mapped[str] = mapped_column(Text, nullable=True)
+    photo: Mapped[str] = mapped_column(String(150), nullable=True)
+    last_chat_id: Mapped[int] = mapped_column(BigInteger, default=MIN_CHAT_ID)
+    sent: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+    status: Mapped[str] = mapped_column(String(10), default='running', index=True)
+
+
+class BroadcastShard(Base):
+    """
+        Прогресс рассылки в одном процессе бота: процесс shard из shards отправляет рассылку чатам
+        abs(chat_id) % shards == shard (см. db.broadcast и cluster.py).
+
+        Атрибуты:
+            broadcast_id (Mapped[int]): ID рассылки (часть первичного ключа).
+            shard (Mapped[int]): Номер процесса (часть первичного ключа).
+            shards (Mapped[int]): Число процессов, при котором сохранен прогресс.
+            last_chat_id (Mapped[int]): Чат, до которого (включительно) процесс выполнил свою часть рассылки.
+            done (Mapped[bool]): Процесс отправил рассылку всем своим чатам.
+        """
+
+    __tablename__ = 'broadcast_shard'
+    broadcast_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    shard: Mapped[int] = mapped_column(Integer, primary_key=True)
+    shards: Mapped[int] = mapped_column(Integer, nullable=False)
+    last_chat_id: Mapped[int] = mapped_column(BigInteger, default=MIN_CHAT_ID)
+    done: Mapped[bool] = mapped_column(Boolean, default=False)
+
+
+class Media(Base):
+    """
+        Файл из папки image, загруженный в Telegram (см. db.media).
+
+        Атрибуты:
+            hash (Mapped[str]): SHA-256 содержимого файла (первичный ключ). Измененный файл загружается заново.
+            name (Mapped[str]): Имя файла, например 'main.jpg'.
+            file_id (Mapped[str]): file_id фото в Telegram, по нему фото отправляется без повторной загрузки.
+        """
+
+    __tablename__ = 'media'
+    hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    name: Mapped[str] = mapped_column(String(150), nullable=False, index=True)
+    file_id: Mapped[str] = mapped_column(String(150), nullable=False)
+
+
+class UserArchive(Base):
+    """
+        Архив прошедших записей (см. db.archive). Записи старше ARCHIVE_AFTER_DAYS переносятся сюда из таблицы
+        user, чтобы запросы слотов, поиск заявок и напоминания работали с небольшой таблицей и плотными индексами.
+
+        Атрибуты: те же, что у User, и archived - время переноса в архив. id - собственный ключ архива,
+        id записи в таблице user хранится в source_id: SQLite выдает id удаленных из user строк повторно,
+        поэтому в архиве один source_id может встретиться несколько раз.
+
+        Ограничения:
+            __table_args__: Индексы по `phone_key` (история заявок для администратора), по `day` (выгрузка
+                            за период) и по `chat_id` (получатели рассылки).
+        """
+
+    __tablename__ = 'user_archive'
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)  # Собственный ключ архива
+    source_id: Mapped[int] = mapped_column(Integer, nullable=False)  # id записи в таблице user
+    name: Mapped[str] = mapped_column(String(150), nullable=True)
+    phone: Mapped[str] = mapped_column(String(16), nullable=True)
+    phone_key: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    date: Mapped[DateTime] = mapped_column(DateTime, nullable=False)
+    day: Mapped[Date] = mapped_column(Date, nullable=True)
+    time: Mapped[str] = mapped_column(String(5), nullable=False)
+    chat_id: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    reminded: Mapped[int] = mapped_column(Integer, default=0, server_default='0')
+    archived: Mapped[DateTime] = mapped_column(DateTime, default=func.now())  # Время переноса в архив
+    __table_args__ = (
+        Index('ix_user_archive_phone_key', 'phone_key'),
+        Index('ix_user_archive_day', 'day'),
+        Index('ix_user_archive_chat_id', 'chat_id'),
     )
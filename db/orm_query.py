@@ -4,7 +4,13 @@ from datetime import datetime
 from sqlalchemy import select, update, delete
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from common.phone import phone_key
+from db.archive import appointments_union
+from db.banner_cache import banner_cache
 from db.models import Banner, User
+from db.reminders import late_reminders, reminders
+from db.slot_index import slot_index
+from db.write_queue import write_queue
 from logging_config import setup_logging
 
 # Настройка логгирования
@@ -35,115 +41,195 @@ async def orm_add_banner_description(session: AsyncSession, data: dict):
         return
     session.add_all([Banner(name=name, description=description) for name, description in data.items()])
     await session.commit()
+    banner_cache.invalidate()
 
 
-async def orm_change_banner_image(session: AsyncSession, name: str, image: str):
+async def orm_change_banner_image(name: str, image: str):
     """
        Обновляет изображение для указанного баннера.
 
        Эта функция находит баннер в базе данных по его имени и обновляет его изображение,
-       если баннер существует.
+       если баннер существует. Изменение выполняется через общую очередь записи (db.write_queue).
 
-       :param session: Асинхронная сессия базы данных для выполнения запросов.
        :param name: Имя баннера, для которого требуется обновить изображение.
        :param image: Новый URL-адрес изображения баннера.
 
        :return: Не возвращает значения. Обновляет запись в базе данных.
        """
-    query = update(Banner).where(Banner.name == name).values(image=image)
-    await session.execute(query)
-    await session.commit()
+    async def apply(session: AsyncSession):
+        await session.execute(update(Banner).where(Banner.name == name).values(image=image))
+
+    # Баннер перечитается из базы при следующем обращении
+    await write_queue.submit(apply, lambda _: banner_cache.invalidate(name))
+
+
+async def orm_fill_banner_images(images: dict[str, str], replaced: dict[str, list[str]] | None = None) -> list[str]:
+    """
+       Устанавливает баннерам изображения по умолчанию (file_id из db.media).
+
+       Изображение меняется только у баннеров без изображения или с прежней версией изображения
+       по умолчанию: фото, загруженные администратором, не затрагиваются. Изменение выполняется
+       через общую очередь записи (db.write_queue).
+
+       :param images: Словарь {имя страницы: file_id}.
+       :param replaced: Словарь {имя страницы: file_id прежних версий изображения по умолчанию}.
+
+       :return: Имена страниц, у которых изменилось изображение.
+       """
+    replaced = replaced or {}
+
+    async def apply(session: AsyncSession):
+        changed = []
+        for page, image in images.items():
+            condition = Banner.image.is_(None)
+            if replaced.get(page):
+                condition = condition | Banner.image.in_(replaced[page])
+            result = await session.execute(
+                update(Banner).where(Banner.name == page, condition).values(image=image)
+            )
+            if result.rowcount:
+                changed.append(page)
+        return changed
+
+    def invalidate(changed: list[str]) -> None:
+        for page in changed:
+            banner_cache.invalidate(page)
+
+    return await write_queue.submit(apply, invalidate)
 
 
 async def orm_get_banner(session: AsyncSession, page: str):
     """
        Получает баннер по имени страницы.
 
-       Эта функция выполняет запрос к базе данных для получения баннера, который соответствует
-       заданному имени страницы. Если баннер найден, возвращается его объект, иначе возвращается None.
+       Баннер берется из кэша banner_cache, к базе данных функция обращается только при промахе.
+       Если баннер найден, возвращается его снимок (BannerEntry), иначе возвращается None.
 
        :param session: Асинхронная сессия базы данных для выполнения запросов.
        :param page: Имя страницы, для которой требуется получить баннер.
 
        :return: Объект баннера, соответствующий имени страницы, или None, если баннер не найден.
        """
-    query = select(Banner).where(Banner.name == page)
-    result = await session.execute(query)
-    return result.scalar()
+    return await banner_cache.get(session, page)
 
 
 async def orm_get_info_pages(session: AsyncSession):
     """
        Получает список всех баннеров.
 
-       Эта функция выполняет запрос к базе данных и возвращает все записи баннеров,
-       которые есть в таблице. Возвращается список объектов баннеров.
+       Список берется из кэша banner_cache, к базе данных функция обращается только
+       после сброса кэша. Возвращается список снимков баннеров (BannerEntry).
 
        :param session: Асинхронная сессия базы данных для выполнения запросов.
 
        :return: Список объектов баннеров, найденных в базе данных. Если таблица пуста, возвращается пустой список.
        """
-    query = select(Banner)
-    result = await session.execute(query)
-    return result.scalars().all()
+    return await banner_cache.pages(session)
 
 
 # Добавляем юзера в БД
 
 async def orm_add_user(
-        session: AsyncSession,
         name: str | None = None,
         phone: str | None = None,
         date: datetime | None = None,
         time: str | None = None,  # Добавлено поле времени
+        chat_id: int | None = None,
 ):
     """
         Добавляет нового пользователя в базу данных.
 
         Эта функция создает экземпляр модели пользователя с указанными данными и добавляет его в
-        базу данных. После добавления изменений в базе данных выполняется коммит.
+        базу данных через общую очередь записи (db.write_queue): запись фиксируется вместе с другими
+        изменениями, пришедшими одновременно.
 
-        :param session: Асинхронная сессия базы данных для выполнения запросов.
         :param name: Имя нового пользователя. Может быть None.
         :param phone: Номер телефона нового пользователя. Может быть None.
         :param date: Дата записи пользователя. Может быть None.
         :param time: Время записи пользователя. Может быть None.
+        :param chat_id: Чат пользователя, в который отправляются напоминания (db.reminders). Может быть None.
 
         :return: Не возвращает значения. Добавляет запись в базу данных.
+        :raises IntegrityError: Если слот уже занят (ограничение uq_user_date_time).
         """
-    new_user = User(name=name, phone=phone, date=date, time=time)
-    session.add(new_user)
-    await session.commit()
+    day = date.date() if isinstance(date, datetime) else date
+    key = phone_key(phone)
+    late = late_reminders(day, time)  # Напоминания, срок которых уже прошел, не отправляются
+
+    async def apply(session: AsyncSession):
+        user = User(name=name, phone=phone, phone_key=key, date=date, day=day, time=time, chat_id=chat_id,
+                    reminded=late)
+        session.add(user)
+        await session.flush()  # Нарушение уникальности - здесь, внутри точки сохранения
+        return user.id
+
+    def on_commit(appointment_id):
+        slot_index.occupy(date, time)  # Слот занят - обновляем индекс
+        reminders.add(appointment_id, chat_id, day, time, late)
+
+    await write_queue.submit(apply, on_commit)
 
 
 async def orm_get_appointments_by_phone(session: AsyncSession, phone: str):
     """
     Получает список всех пользователей (заявок) по номеру телефона.
 
+    Поиск идет по нормализованному ключу user.phone_key (индекс ix_user_phone_key), поэтому номер
+    может быть записан в любом виде. Читается только горячая таблица user: прошедшие записи, перенесенные
+    в архив (db.archive), в просмотр заявок не попадают, их показывает orm_get_appointment_history.
+
     :param session: Асинхронная сессия базы данных для выполнения запросов.
     :param phone: Номер телефона для поиска заявок.
     :return: Список объектов User или пустой список, если нет заявок.
     """
-    query = select(User).where(User.phone == phone)  # Используем таблицу User
+    key = phone_key(phone)
+    if key is None:
+        return []
+    query = select(User).where(User.phone_key == key).order_by(User.id)  # Одно равенство по индексу
     result = await session.execute(query)
     return result.scalars().all()  # Возвращаем все записи
 
 
-async def orm_update_user_appointment(session: AsyncSession, phone: str, new_date: str, new_time: str):
+async def orm_get_appointment_history(session: AsyncSession, phone: str, limit: int = 50):
+    """
+    Получает историю записей по номеру телефона для администратора: горячие и архивные записи.
+
+    :param session: Асинхронная сессия базы данных для выполнения запросов.
+    :param phone: Номер телефона в любом виде.
+    :param limit: Максимальное число записей (самые поздние).
+    :return: Список строк (id, name, day, time, archived) по убыванию даты или пустой список.
+    """
+    key = phone_key(phone)
+    if key is None:
+        return []
+    rows = appointments_union(('id', 'name', 'day', 'time'), lambda model: model.phone_key == key)
+    query = select(rows).order_by(rows.c.day.desc(), rows.c.time.desc()).limit(limit)
+    result = await session.execute(query)
+    return result.all()
+
+
+async def orm_update_user_appointment(phone: str, new_date: str, new_time: str, appointment_id: int | None = None):
     """
-    Обновляет запись о назначении в базе данных.
+    Обновляет запись о назначении в базе данных (через общую очередь записи db.write_queue).
 
-    :param session: Асинхронная сессия базы данных.
-    :param appointment_id: ID записи для обновления.
+    :param phone: Номер телефона владельца записи.
     :param new_date: Новая дата назначения.
     :param new_time: Новое время назначения.
+    :param appointment_id: ID записи для обновления. Если не указан, обновляется первая запись по телефону.
+    :raises ValueError: Если запись не найдена.
+    :raises IntegrityError: Если новый слот уже занят.
     """
-    async with session.begin():  # Обязательно используйте контекст для транзакции
-        result = await session.execute(select(User).where(User.phone == phone))
+    query = select(User).where(User.phone_key == phone_key(phone))
+    if appointment_id is not None:
+        query = query.where(User.id == appointment_id)
+
+    async def apply(session: AsyncSession):
+        result = await session.execute(query)
         appointment = result.scalars().first()  # Получаем экземпляр записи
 
         if appointment:
             app_logger.info(f'Обновление записи {phone} на дату {new_date} и время {new_time}')
+            old_date, old_time = appointment.date, appointment.time
 
             # Конвертируем строку даты в объект date
             date_obj = datetime.strptime(new_date, "%d-%m-%Y").date()
@@ -152,12 +238,50 @@ async def orm_update_user_appointment(session: AsyncSession, phone: str, new_dat
             time_str = new_time
 
             appointment.date = date_obj  # Присваиваем объект date
+            appointment.day = date_obj
             appointment.time = time_str  # Присваиваем строку времени
+            # Напоминания для нового времени отправляются заново, кроме тех, срок которых уже прошел
+            appointment.reminded = late_reminders(date_obj, time_str)
 
             # Для корректного обновления данных
             session.add(appointment)  # добавляем изменения к сессии
+            await session.flush()
 
             app_logger.info(f'Запись успешно обновлена: {phone}, {date_obj}, {time_str}')
+            return (old_date, old_time, date_obj, time_str, appointment.id, appointment.chat_id,
+                    appointment.reminded)
         else:
             app_logger.error('Запись не найдена.')
             raise ValueError("Запись не найдена.")
+
+    def on_commit(moved):
+        # Транзакция зафиксирована - переносим слот в индексе
+        old_date, old_time, date_obj, time_str, moved_id, chat_id, reminded = moved
+        slot_index.release(old_date, old_time)
+        slot_index.occupy(date_obj, time_str)
+        reminders.move(moved_id, chat_id, date_obj, time_str, reminded)
+
+    await write_queue.submit(apply, on_commit)
+
+
+async def orm_delete_appointment(appointment_id: int):
+    """
+    Удаляет запись о назначении из базы данных (через общую очередь записи db.write_queue)
+    и освобождает ее слот.
+
+    :param appointment_id: ID записи для удаления.
+    :return: True, если запись была удалена, иначе False.
+    """
+    async def apply(session: AsyncSession):
+        appointment = await session.get(User, appointment_id)
+        if appointment is None:
+            return None
+        await session.delete(appointment)
+        return appointment.date, appointment.time
+
+    def on_commit(slot):
+        if slot is not None:
+            slot_index.release(*slot)
+            reminders.remove(appointment_id)
+
+    return await write_queue.submit(apply, on_commit) is not None
@@ -0,0 +1,159 @@
+# Профилирование SQL-запросов: журнал медленных запросов, сводка по отпечаткам и планы худших запросов
+import re
+import time
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from db.migrations import query_plans
+from logging_config import setup_logging
+
+# Медленные запросы пишутся в тот же файл, что и SQL-запросы (sqlalchemy.engine)
+app_logger = setup_logging("slow_query", "logs/sql.log")
+
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACES = re.compile(r'\s+')
+MAX_STATEMENTS = 2000  # Размер кэша "текст запроса -> отпечаток"
+
+
+def fingerprint(statement: str) -> str:
+    """
+    Нормализует SQL-запрос в отпечаток: строки и числа заменяются на ?, списки IN (?, ?, ...) - на (?+),
+    пробелы схлопываются. Запросы, отличающиеся только значениями, дают один отпечаток.
+
+    :param statement: Текст SQL-запроса.
+    :return: Отпечаток запроса.
+    """
+    statement = _STRINGS.sub('?', statement)
+    statement = _NUMBERS.sub('?', statement)
+    statement = _SPACES.sub(' ', statement).strip()
+    return _IN_LISTS.sub('(?+)', statement)
+
+
+class QueryStats:
+    """Сводка по одному отпечатку: число выполнений, суммарное и максимальное время, самый медленный пример."""
+
+    __slots__ = ('count', 'total', 'max', 'statement', 'parameters')
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.statement: str | None = None
+        self.parameters = None
+
+
+class QueryProfiler:
+    """
+    Профилировщик запросов на событиях движка before/after_cursor_execute.
+
+    Каждый запрос приводится к отпечатку (fingerprint, с кэшем по тексту запроса), по отпечатку копятся
+    число выполнений и время. В журнал (logs/sql.log) попадают только запросы дольше threshold_ms.
+    Для каждого отпечатка хранится текст и параметры самого медленного выполнения: по ним explain()
+    по запросу администратора получает EXPLAIN QUERY PLAN худших запросов.
+
+    Время запроса с асинхронным драйвером включает ожидание цикла событий: под нагрузкой даже поиск
+    по первичному ключу может выглядеть медленным. Поэтому важна сводка по отпечаткам (сравнение
+    запросов между собой и между версиями), а не отдельные записи журнала.
+
+    :param threshold_ms: Порог медленного запроса, мс.
+    """
+
+    def __init__(self, threshold_ms: float = 100) -> None:
+        self.threshold_ms = threshold_ms
+        self.stats: dict[str, QueryStats] = {}
+        self.slow = 0
+        self._fingerprints: dict[str, str] = {}
+
+    def install(self, engine: AsyncEngine) -> None:
+        """
+        Подключает профилировщик к движку.
+
+        :param engine: Асинхронный движок.
+        """
+        sync_engine = engine.sync_engine
+
+        @event.listens_for(sync_engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+        @event.listens_for(sync_engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            self.record(statement, parameters, time.perf_counter() - conn.info['profile_started'].pop(),
+                        executemany)
+
+        @event.listens_for(sync_engine, 'handle_error')
+        def handle_error(context):
+            started = context.connection.info.get('profile_started') if context.connection is not None else None
+            if started:
+                started.pop()
+
+    def record(self, statement: str, parameters, seconds: float, executemany: bool = False) -> None:
+        """
+        Учитывает выполненный запрос.
+
+        :param statement: Текст запроса.
+        :param parameters: Параметры запроса (для executemany - список наборов).
+        :param seconds: Время выполнения, с.
+        :param executemany: Выполнялся ли запрос для нескольких наборов параметров.
+        """
+        key = self._fingerprints.get(statement)
+        if key is None:
+            if statement.startswith('EXPLAIN'):
+                return  # Планы, которые получает explain(), не учитываются
+            if len(self._fingerprints) >= MAX_STATEMENTS:
+                self._fingerprints.clear()
+            key = self._fingerprints[statement] = fingerprint(statement)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = QueryStats()
+        stats.count += 1
+        stats.total += seconds
+        if seconds > stats.max:
+            stats.max = seconds
+            stats.statement = statement
+            if executemany:
+                parameters = parameters[0] if parameters else ()
+            stats.parameters = tuple(parameters) if isinstance(parameters, (list, tuple)) else parameters
+        if seconds * 1000 >= self.threshold_ms:
+            self.slow += 1
+            app_logger.warning(f'Медленный запрос {seconds * 1000:.1f} мс: {key} {str(parameters)[:200]}')
+
+    def top(self, limit: int = 10) -> list[tuple[str, QueryStats]]:
+        """
+        :return: Отпечатки с наибольшим суммарным временем (отпечаток, сводка).
+        """
+        return sorted(self.stats.items(), key=lambda item: item[1].total, reverse=True)[:limit]
+
+    async def explain(self, engine: AsyncEngine, limit: int = 3) -> dict[str, str]:
+        """
+        Получает EXPLAIN QUERY PLAN для отпечатков с наибольшим суммарным временем (только SQLite).
+        Запрос плана выполняется с параметрами самого медленного выполнения.
+
+        :param engine: Асинхронный движок.
+        :param limit: Сколько худших отпечатков разобрать.
+        :return: Словарь {отпечаток: план}.
+        """
+        if engine.dialect.name != 'sqlite':
+            return {}
+        queries = {key: (stats.statement, stats.parameters or ()) for key, stats in self.top(limit)
+                   if stats.statement and stats.statement.lstrip()[:6].upper() in ('SELECT', 'UPDATE', 'DELETE',
+                                                                                   'INSERT')}
+        if not queries:
+            return {}
+        async with engine.connect() as conn:
+            plans = await conn.run_sync(query_plans, queries)
+        plans = {key: plan for key, plan in plans.items() if plan}  # У простого INSERT плана нет
+        for key, plan in plans.items():
+            app_logger.info(f'План запроса {key}: {plan}')
+        return plans
+
+    def reset(self) -> None:
+        """Сбрасывает накопленную сводку."""
+        self.stats.clear()
+        self.slow = 0
+
+
+query_profiler = QueryProfiler()
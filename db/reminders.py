@@ -0,0 +1,280 @@
+# Напоминания о записи за 24 и за 2 часа: окно ближайших записей в памяти и куча таймеров
+import asyncio
+import heapq
+from datetime import date, datetime, timedelta
+from typing import Awaitable, Callable
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from common.metrics import current_update
+from db.models import User
+from db.write_queue import write_queue
+from logging_config import setup_logging
+
+# Настройка логгирования
+app_logger = setup_logging("reminders", "logs/orm.log")
+
+# (бит в user.reminded, за сколько до записи, текст)
+REMINDERS = (
+    (1, timedelta(hours=24), "Напоминаем: у вас запись на {date} в {time}."),
+    (2, timedelta(hours=2), "Напоминаем: сегодня в {time} у вас запись. Ждем вас!"),
+)
+LEADS = {bit: lead for bit, lead, _ in REMINDERS}
+ALL_SENT = sum(LEADS)
+LEAD = max(LEADS.values())
+
+Send = Callable[[int, str], Awaitable[None]]
+
+
+def appointment_time(day: date | datetime, time: str) -> datetime:
+    """
+    Возвращает дату и время записи.
+
+    :param day: Дата записи.
+    :param time: Время записи, например '10:00'.
+    :return: Объект datetime.
+    """
+    day = day.date() if isinstance(day, datetime) else day
+    hours, minutes = map(int, time.split(':'))
+    return datetime(day.year, day.month, day.day, hours, minutes)
+
+
+def late_reminders(day: date | datetime, time: str | None, now: datetime | None = None) -> int:
+    """
+    Возвращает напоминания, срок которых уже наступил к моменту записи: запись на завтрашнее утро,
+    сделанная вечером, не получает напоминание "за 24 часа" сразу после записи.
+
+    :param day: Дата записи.
+    :param time: Время записи.
+    :param now: Момент записи (по умолчанию - текущее время).
+    :return: Биты напоминаний для user.reminded (как будто они уже отправлены).
+    """
+    if day is None or time is None:
+        return 0
+    when = appointment_time(day, time)
+    now = now or datetime.now()
+    return sum(bit for bit, lead in LEADS.items() if when - lead <= now)
+
+
+class ReminderScheduler:
+    """
+    Планировщик напоминаний без отдельной задачи на каждую запись.
+
+    В памяти держатся только записи, напоминания по которым наступят в ближайшие window_days дней:
+    окно загружается запросами по диапазону user.day (индекс ix_user_day_time) и сдвигается по дням.
+    Время каждого напоминания лежит в одной min-куче, одна фоновая задача спит до ближайшего.
+    Изменения записей приходят из orm_add_user, orm_update_user_appointment и orm_delete_appointment
+    (add/move/remove) - таблица заново не читается. Устаревшие элементы кучи не удаляются, а
+    пропускаются при извлечении (сверяются с текущим временем записи); когда их становится слишком много,
+    куча перестраивается.
+
+    Отправленные напоминания отмечаются битами в user.reminded до отправки, поэтому после перезапуска
+    они не повторяются. Напоминания, срок которых наступил раньше самой записи (late_reminders), отмечаются
+    при записи и не отправляются.
+
+    Пока читается следующий день окна, add принимает записи и этого дня, а перенесенные и удаленные
+    за время запроса записи не берутся из его результата: снимок базы мог их не увидеть или увидеть
+    в прежнем виде.
+
+    При запуске в нескольких процессах (cluster.py) задается shard = (номер процесса, число процессов):
+    процесс загружает только записи своих чатов (abs(chat_id) % число == номер), остальные напомнят другие.
+
+    :param window_days: На сколько дней вперед (сверх 24 часов) загружаются записи.
+    """
+
+    def __init__(self, window_days: int = 1) -> None:
+        self.window_days = window_days
+        self.session_pool: async_sessionmaker | None = None
+        self.send: Send | None = None
+        self.sent = 0
+        self.shard: tuple[int, int] | None = None
+
+        self._entries: dict[int, list] = {}  # id записи -> [chat_id, время записи, отправленные биты]
+        self._heap: list = []  # (время напоминания, id записи, бит, время записи)
+        self._loaded_day: date | None = None  # Записи по эту дату включительно загружены
+        self._loading_day: date | None = None  # Записи по эту дату читаются запросом окна
+        self._changed: set[int] | None = None  # Записи, перенесенные или удаленные во время запроса окна
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self, session_pool: async_sessionmaker, send: Send) -> None:
+        """
+        Запускает фоновую задачу. Вызывается из on_startup.
+
+        :param session_pool: Фабрика асинхронных сессий.
+        :param send: Корутина send(chat_id, text), которая отправляет напоминание.
+        """
+        self.session_pool = session_pool
+        self.send = send
+        self._loaded_day = date.today() - timedelta(days=1)
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """
+        Останавливает фоновую задачу. Вызывается из on_shutdown: неотправленные напоминания
+        не отмечены в user.reminded и будут отправлены после запуска.
+        """
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def _push(self, appointment_id: int, chat_id: int, when: datetime, reminded: int) -> None:
+        self._entries[appointment_id] = [chat_id, when, reminded]
+        for bit, lead, _ in REMINDERS:
+            if not reminded & bit:
+                heapq.heappush(self._heap, (when - lead, appointment_id, bit, when))
+        if self._wakeup is not None:
+            self._wakeup.set()  # Новое напоминание может оказаться ближайшим
+
+    def add(self, appointment_id: int, chat_id: int | None, day: date | datetime, time: str,
+            reminded: int = 0) -> None:
+        """
+        Учитывает новую запись (вызывается после фиксации orm_add_user).
+
+        :param appointment_id: ID записи.
+        :param chat_id: Чат пользователя. Без него напоминание отправить некуда.
+        :param day: Дата записи.
+        :param time: Время записи.
+        :param reminded: Уже отправленные напоминания (биты).
+        """
+        if chat_id is None or self._loaded_day is None or reminded & ALL_SENT == ALL_SENT:
+            return
+        day = day.date() if isinstance(day, datetime) else day
+        if day <= (self._loading_day or self._loaded_day):  # Более поздние даты загрузятся вместе с окном
+            self._push(appointment_id, chat_id, appointment_time(day, time), reminded)
+
+    def move(self, appointment_id: int, chat_id: int | None, day: date | datetime, time: str,
+             reminded: int = 0) -> None:
+        """
+        Учитывает перенос записи: напоминания для нового времени отправляются заново
+        (кроме тех, срок которых уже прошел, - reminded).
+        """
+        if self._changed is not None:
+            self._changed.add(appointment_id)
+        self._entries.pop(appointment_id, None)
+        self.add(appointment_id, chat_id, day, time, reminded)
+
+    def remove(self, appointment_id: int) -> None:
+        """
+        Учитывает удаление записи.
+        """
+        if self._changed is not None:
+            self._changed.add(appointment_id)
+        self._entries.pop(appointment_id, None)
+
+    async def _load_window(self, session: AsyncSession) -> None:
+        """Загружает записи следующих дат, чтобы окно покрывало window_days дней после ближайших 24 часов."""
+        target = (datetime.now() + LEAD).date() + timedelta(days=self.window_days)
+        if self._loaded_day >= target:
+            return
+        query = (
+            select(User.id, User.chat_id, User.day, User.time, User.reminded)
+            .where(User.day > self._loaded_day, User.day <= target, User.chat_id.is_not(None),
+                   User.reminded < ALL_SENT)
+        )
+        if self.shard is not None:
+            index, count = self.shard
+            query = query.where(func.abs(User.chat_id) % count == index)
+        self._loading_day, self._changed = target, set()
+        try:
+            result = await session.execute(query)
+            changed = self._changed
+        finally:
+            self._loading_day = self._changed = None
+        now = datetime.now()
+        loaded = 0
+        for appointment_id, chat_id, day, time, reminded in result:
+            when = appointment_time(day, time)
+            # Новые записи уже добавлены через add, перенесенные и удаленные - учтены через move/remove
+            if when > now and appointment_id not in self._entries and appointment_id not in changed:
+                self._push(appointment_id, chat_id, when, reminded or 0)
+                loaded += 1
+        app_logger.info(f'Окно напоминаний: {self._loaded_day} -> {target}, загружено записей: {loaded}')
+        self._loaded_day = target
+
+    async def _fire(self, appointment_id: int, bit: int, when: datetime) -> None:
+        """Отмечает напоминание отправленным в базе данных и отправляет его."""
+        entry = self._entries[appointment_id]
+        chat_id = entry[0]
+        # Более ранние напоминания, которые не успели отправить (например, бот был остановлен), уже не нужны
+        skip = sum(other for other, lead in LEADS.items() if lead > LEADS[bit] and not entry[2] & other)
+        entry[2] |= bit | skip
+
+        async def apply(session: AsyncSession):
+            await session.execute(update(User).where(User.id == appointment_id)
+                                  .values(reminded=User.reminded.op('|')(bit | skip)))
+
+        await write_queue.submit(apply)
+        if entry[2] & ALL_SENT == ALL_SENT:
+            self._entries.pop(appointment_id, None)
+
+        text = next(text for b, _, text in REMINDERS if b == bit)
+        await self.send(chat_id, text.format(date=when.strftime('%d-%m-%Y'), time=when.strftime('%H:%M')))
+        self.sent += 1
+
+    def _compact(self) -> None:
+        """Перестраивает кучу без устаревших элементов (после частых переносов и удалений записей)."""
+        self._heap = [item for item in self._heap
+                      if (entry := self._entries.get(item[1])) is not None and entry[1] == item[3]
+                      and not entry[2] & item[2]]
+        heapq.heapify(self._heap)
+
+    async def _run(self) -> None:
+        current_update.set(None)  # Задача могла быть запущена в обработчике апдейта
+        while True:
+            try:
+                async with self.session_pool() as session:
+                    await self._load_window(session)
+            except Exception as e:
+                app_logger.error(f'Ошибка загрузки окна напоминаний: {e}')
+
+            now = datetime.now()
+            due = {}  # (id записи, бит) -> время записи; повторный перенос на то же время дает дубль в куче
+            while self._heap and self._heap[0][0] <= now:
+                _, appointment_id, bit, when = heapq.heappop(self._heap)
+                entry = self._entries.get(appointment_id)
+                if entry is None or entry[1] != when or entry[2] & bit or (appointment_id, bit) in due:
+                    continue  # Запись удалена, перенесена или напоминание уже отправлено
+                if when <= now:
+                    self._entries.pop(appointment_id, None)  # Запись уже прошла
+                    continue
+                if any(lead < LEADS[bit] and not entry[2] & other and when - lead <= now
+                       for other, lead in LEADS.items()):
+                    continue  # Уже пора отправлять более позднее напоминание - это пропускаем
+                due[appointment_id, bit] = when
+
+            # Одновременные напоминания отмечаются одной транзакцией очереди записи
+            results = await asyncio.gather(*(self._fire(appointment_id, bit, when)
+                                             for (appointment_id, bit), when in due.items()), return_exceptions=True)
+            for (appointment_id, _), result in zip(due, results):
+                if isinstance(result, Exception):
+                    app_logger.error(f'Ошибка отправки напоминания по записи {appointment_id}: {result}')
+
+            if len(self._heap) > 2 * len(REMINDERS) * len(self._entries) + 1024:
+                self._compact()
+
+            # Спим до ближайшего напоминания, но не дольше часа - окно сдвигается по времени
+            timeout = 3600.0
+            if self._heap:
+                timeout = min(timeout, max((self._heap[0][0] - datetime.now()).total_seconds(), 0.0))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        """
+        Возвращает размер окна напоминаний.
+
+        :return: Словарь: записей в окне, элементов в куче, последняя загруженная дата, отправлено.
+        """
+        return {'entries': len(self._entries), 'heap': len(self._heap), 'loaded_day': self._loaded_day,
+                'sent': self.sent}
+
+
+reminders = ReminderScheduler()
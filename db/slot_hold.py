@@ -0,0 +1,147 @@
+# Краткосрочные брони слотов: слот, выбранный пользователем, скрыт от других до подтверждения записи
+import asyncio
+import time
+from datetime import date, datetime
+from typing import Callable
+
+from db.slot_index import SLOT_ORDINALS, to_date
+
+
+class SlotHolds:
+    """
+    Брони слотов в памяти с ограниченным временем жизни.
+
+    Когда пользователь выбирает время, слот бронируется за его чатом на ttl секунд. Пока бронь
+    действует, слот не показывается другим пользователям в get_free_slots и не может быть ими выбран.
+    На "да" бронь превращается в запись в базе данных, на "нет", /cancel или по истечении ttl - снимается.
+    У одного чата может быть только одна бронь.
+
+    Если задан on_change, о каждой брони и ее снятии сообщается другим процессам бота (см. cluster.py),
+    они применяют изменение через apply_change. Если два процесса одновременно забронировали один слот
+    за разными чатами, в каждом процессе остается бронь чата с меньшим ID: второй пользователь получит
+    отказ при подтверждении записи, когда повторная бронь не пройдет.
+
+    :param ttl: Время жизни брони в секундах.
+    """
+
+    def __init__(self, ttl: float = 300) -> None:
+        self.ttl = ttl
+        self._by_day: dict[date, dict[int, tuple[int, float]]] = {}  # дата -> {номер слота: (чат, истекает)}
+        self._by_holder: dict[int, tuple[date, int]] = {}  # чат -> (дата, номер слота)
+        self.on_change: Callable[[str, int, date | None, str | None], None] | None = None  # (операция, чат, дата, время)
+
+    def _drop(self, day: date, ordinal: int) -> None:
+        slots = self._by_day.get(day)
+        if slots is None:
+            return
+        holder, _ = slots.pop(ordinal, (None, 0))
+        if not slots:
+            del self._by_day[day]
+        if holder is not None and self._by_holder.get(holder) == (day, ordinal):
+            del self._by_holder[holder]
+
+    def held_mask(self, day: date | datetime | str, exclude_holder: int | None = None) -> int:
+        """
+        Возвращает маску слотов даты, забронированных другими чатами.
+
+        :param day: Дата записи.
+        :param exclude_holder: Чат, собственная бронь которого не учитывается.
+        :return: Битовая маска забронированных слотов (биты как в db.slot_index).
+        """
+        slots = self._by_day.get(to_date(day))
+        if not slots:
+            return 0
+        now = time.monotonic()
+        mask = 0
+        for ordinal, (holder, expires) in slots.items():
+            if expires > now and holder != exclude_holder:
+                mask |= 1 << ordinal
+        return mask
+
+    def acquire(self, day: date | datetime | str, slot: str, holder: int) -> bool:
+        """
+        Бронирует слот за чатом. Предыдущая бронь этого чата снимается.
+
+        :param day: Дата записи.
+        :param slot: Время записи, например '10:00'.
+        :param holder: ID чата.
+        :return: True, если слот забронирован (или уже был забронирован этим чатом), False, если его держит другой чат.
+        """
+        day = to_date(day)
+        ordinal = SLOT_ORDINALS[slot]
+        now = time.monotonic()
+        current = self._by_day.get(day, {}).get(ordinal)
+        if current is not None and current[0] != holder and current[1] > now:
+            return False
+
+        self._hold(day, ordinal, holder, now + self.ttl)
+        if self.on_change is not None:
+            self.on_change('hold', holder, day, slot)
+        return True
+
+    def _hold(self, day: date, ordinal: int, holder: int, expires: float) -> None:
+        self._release(holder)
+        self._drop(day, ordinal)  # Чужая бронь истекла (или уступила при одновременной брони)
+        self._by_day.setdefault(day, {})[ordinal] = (holder, expires)
+        self._by_holder[holder] = (day, ordinal)
+
+    def release(self, holder: int) -> None:
+        """
+        Снимает бронь чата, если она есть.
+
+        :param holder: ID чата.
+        """
+        if self._release(holder) and self.on_change is not None:
+            self.on_change('release', holder, None, None)
+
+    def _release(self, holder: int) -> bool:
+        held = self._by_holder.get(holder)
+        if held is None:
+            return False
+        self._drop(*held)
+        return True
+
+    def apply_change(self, operation: str, holder: int, day: date | None = None, slot: str | None = None) -> None:
+        """
+        Применяет бронь или ее снятие, пришедшие из другого процесса, не сообщая о них дальше.
+
+        :param operation: 'hold' или 'release'.
+        :param holder: ID чата.
+        :param day: Дата брони для 'hold'.
+        :param slot: Время брони для 'hold'.
+        """
+        if operation == 'release':
+            self._release(holder)
+            return
+        ordinal = SLOT_ORDINALS[slot]
+        now = time.monotonic()
+        current = self._by_day.get(day, {}).get(ordinal)
+        if current is not None and current[1] > now and current[0] != holder and current[0] < holder:
+            return  # Одновременная бронь одного слота: остается бронь чата с меньшим ID
+        self._hold(day, ordinal, holder, now + self.ttl)
+
+    def sweep(self) -> int:
+        """
+        Удаляет истекшие брони.
+
+        :return: Количество удаленных броней.
+        """
+        now = time.monotonic()
+        expired = [(day, ordinal) for day, slots in self._by_day.items()
+                   for ordinal, (_, expires) in slots.items() if expires <= now]
+        for day, ordinal in expired:
+            self._drop(day, ordinal)
+        return len(expired)
+
+    async def run_periodic_sweep(self, interval: float = 60) -> None:
+        """
+        Периодически удаляет истекшие брони, чтобы они не занимали память.
+
+        :param interval: Интервал между проверками в секундах.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+
+slot_holds = SlotHolds()
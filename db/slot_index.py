@@ -0,0 +1,319 @@
+# Индекс занятости временных слотов по датам (битовая маска на каждую дату)
+import asyncio
+from datetime import date, datetime
+from typing import Callable
+
+from sqlalchemy import distinct, func, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from db.models import User
+from logging_config import setup_logging
+
+# Настройка логгирования
+app_logger = setup_logging("slot_index", "logs/orm.log")
+
+# Все возможные временные слоты. Порядковый номер слота - номер бита в маске.
+ALL_SLOTS = ('09:00', '10:00', '11:00', '12:00', '13:00', '14:00', '15:00', '16:00', '17:00', '18:00', '19:00')
+SLOT_ORDINALS = {slot: ordinal for ordinal, slot in enumerate(ALL_SLOTS)}
+FULL_MASK = (1 << len(ALL_SLOTS)) - 1
+
+
+def to_date(value: date | datetime | str) -> date:
+    """
+    Приводит дату к объекту date.
+
+    :param value: Дата в виде date, datetime или строки 'ДД-ММ-ГГГГ'.
+    :return: Объект date.
+    :raises ValueError: Если строка даты имеет неверный формат.
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value, "%d-%m-%Y").date()
+
+
+def mask_to_slots(mask: int) -> list:
+    """
+    Преобразует битовую маску в список временных слотов.
+
+    :param mask: Битовая маска занятых (или свободных) слотов.
+    :return: Список слотов, биты которых выставлены в маске.
+    """
+    return [slot for ordinal, slot in enumerate(ALL_SLOTS) if mask >> ordinal & 1]
+
+
+class SlotIndex:
+    """
+    Индекс занятости слотов в памяти.
+
+    Для каждой даты хранится битовая маска занятых слотов (бит N - слот ALL_SLOTS[N]).
+    Маска загружается из базы данных лениво, при первом обращении к дате, а дальше
+    поддерживается инкрементально функциями orm_add_user, orm_update_user_appointment
+    и orm_delete_appointment. Операции занятия/освобождения идемпотентны, поэтому изменения,
+    пришедшие во время загрузки даты, просто повторяются после нее.
+
+    Для календаря хранится множество полностью занятых дат каждого месяца. Оно загружается одним
+    запросом с GROUP BY на месяц и дальше уточняется по маскам дат, которые меняются в индексе.
+
+    Если задан on_change, о каждом занятии, освобождении и сбросе даты сообщается другим процессам
+    бота (см. cluster.py), они применяют изменение через apply_change.
+    """
+
+    def __init__(self) -> None:
+        self._masks: dict[date, int] = {}
+        self._loading: dict[date, asyncio.Future] = {}
+        self._pending: dict[date, list[tuple[int, bool]]] = {}
+        self._months: dict[tuple[int, int], set[date]] = {}  # (год, месяц) -> полностью занятые даты
+        self._month_changes: dict[tuple[int, int], int] = {}  # Счетчик изменений месяца (для загрузки)
+        self.on_change: Callable[[str, date | None, str | None], None] | None = None  # (операция, дата, время)
+
+    async def _load(self, session: AsyncSession, day: date) -> int:
+        """
+        Загружает из базы данных маску занятых слотов на дату.
+
+        :param session: Асинхронная сессия базы данных.
+        :param day: Дата, для которой строится маска.
+        :return: Битовая маска занятых слотов.
+        """
+        result = await session.execute(select(User.time).where(User.day == day))  # Равенство по индексу (day, time)
+        mask = 0
+        for (time,) in result:
+            ordinal = SLOT_ORDINALS.get(time)
+            if ordinal is not None:
+                mask |= 1 << ordinal
+        return mask
+
+    async def busy_mask(self, session: AsyncSession, day: date | datetime | str) -> int:
+        """
+        Возвращает маску занятых слотов на дату, при необходимости загружая ее из базы данных.
+
+        :param session: Асинхронная сессия базы данных.
+        :param day: Дата записи.
+        :return: Битовая маска занятых слотов.
+        """
+        day = to_date(day)
+        mask = self._masks.get(day)
+        if mask is not None:
+            return mask
+
+        loading = self._loading.get(day)
+        if loading is not None:  # Дату уже загружает другой обработчик
+            return await asyncio.shield(loading)
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[day] = future
+        self._pending[day] = []
+        try:
+            mask = await self._load(session, day)
+            for ordinal, busy in self._pending[day]:  # Изменения, пришедшие во время загрузки
+                mask = mask | 1 << ordinal if busy else mask & ~(1 << ordinal)
+            self._masks[day] = mask
+            self._update_month(day, mask)
+            future.set_result(mask)
+            return mask
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Чтобы исключение не считалось необработанным
+            raise
+        finally:
+            del self._loading[day]
+            del self._pending[day]
+
+    async def get_free_slots(self, session: AsyncSession, day: date | datetime | str) -> list:
+        """
+        Возвращает список свободных слотов на дату.
+
+        :param session: Асинхронная сессия базы данных.
+        :param day: Дата записи.
+        :return: Список свободных временных слотов в порядке следования.
+        """
+        return mask_to_slots(~await self.busy_mask(session, day) & FULL_MASK)
+
+    async def get_busy_slots(self, session: AsyncSession, day: date | datetime | str) -> list:
+        """
+        Возвращает список занятых слотов на дату.
+
+        :param session: Асинхронная сессия базы данных.
+        :param day: Дата записи.
+        :return: Список занятых временных слотов.
+        """
+        return mask_to_slots(await self.busy_mask(session, day))
+
+    async def full_days(self, session: AsyncSession, year: int, month: int) -> set[date]:
+        """
+        Возвращает даты месяца, на которые заняты все слоты.
+
+        При первом обращении к месяцу выполняется один запрос с GROUP BY по user.day,
+        результат кэшируется до сброса индекса.
+
+        :param session: Асинхронная сессия базы данных.
+        :param year: Год.
+        :param month: Месяц (1-12).
+        :return: Множество полностью занятых дат.
+        """
+        key = (year, month)
+        full = self._months.get(key)
+        if full is not None:
+            return full
+
+        changes = self._month_changes.get(key, 0)
+        first = date(year, month, 1)
+        following = date(year + month // 12, month % 12 + 1, 1)
+        result = await session.execute(
+            select(User.day)
+            .where(User.day >= first, User.day < following)  # Диапазон по индексу (day, time)
+            .group_by(User.day)
+            .having(func.count(distinct(User.time)) >= len(ALL_SLOTS))
+        )
+        full = {day for (day,) in result}
+        for day, mask in self._masks.items():  # Загруженные маски точнее снимка из базы
+            if (day.year, day.month) == key:
+                full.discard(day)
+                if mask == FULL_MASK:
+                    full.add(day)
+        if self._month_changes.get(key, 0) == changes:  # Месяц не менялся во время запроса
+            self._months[key] = full
+        return full
+
+    def _update_month(self, day: date, mask: int | None) -> None:
+        """Уточняет множество занятых дат месяца после изменения маски даты."""
+        key = (day.year, day.month)
+        self._month_changes[key] = self._month_changes.get(key, 0) + 1
+        full = self._months.get(key)
+        if full is None:
+            return
+        if mask is None:  # Маска даты неизвестна - месяц будет перечитан из базы
+            del self._months[key]
+        elif mask == FULL_MASK:
+            full.add(day)
+        else:
+            full.discard(day)
+
+    def _mark(self, day: date | datetime | str, time: str, busy: bool) -> None:
+        day = to_date(day)
+        ordinal = SLOT_ORDINALS.get(time)
+        if ordinal is None:
+            return
+        if day in self._loading:
+            self._pending[day].append((ordinal, busy))
+            self._update_month(day, None if busy else 0)
+            return
+        mask = self._masks.get(day)
+        if mask is None:  # Дата еще не загружена - ее прочитают из базы при первом обращении
+            self._update_month(day, None if busy else 0)  # Освобожденная дата точно не занята целиком
+            return
+        self._masks[day] = mask | 1 << ordinal if busy else mask & ~(1 << ordinal)
+        self._update_month(day, self._masks[day])
+
+    def occupy(self, day: date | datetime | str, time: str) -> None:
+        """
+        Отмечает слот как занятый.
+
+        :param day: Дата записи.
+        :param time: Время записи, например '10:00'.
+        """
+        self._mark(day, time, True)
+        self._notify('occupy', day, time)
+
+    def release(self, day: date | datetime | str, time: str) -> None:
+        """
+        Отмечает слот как свободный.
+
+        :param day: Дата записи.
+        :param time: Время записи, например '10:00'.
+        """
+        self._mark(day, time, False)
+        self._notify('release', day, time)
+
+    def invalidate(self, day: date | datetime | str | None = None) -> None:
+        """
+        Сбрасывает маску даты (или всего индекса), чтобы она была перечитана из базы данных.
+
+        :param day: Дата для сброса. Если не указана, сбрасывается весь индекс.
+        """
+        self._invalidate(day)
+        self._notify('invalidate', day)
+
+    def _invalidate(self, day: date | datetime | str | None) -> None:
+        if day is None:
+            self._masks.clear()
+            self._months.clear()
+        else:
+            day = to_date(day)
+            self._masks.pop(day, None)
+            self._update_month(day, None)
+
+    def _notify(self, operation: str, day: date | datetime | str | None, time: str | None = None) -> None:
+        if self.on_change is not None:
+            self.on_change(operation, None if day is None else to_date(day), time)
+
+    def apply_change(self, operation: str, day: date | None, time: str | None = None) -> None:
+        """
+        Применяет изменение, пришедшее из другого процесса, не сообщая о нем дальше.
+
+        :param operation: 'occupy', 'release' или 'invalidate'.
+        :param day: Дата (None для сброса всего индекса).
+        :param time: Время слота для 'occupy' и 'release'.
+        """
+        if operation == 'invalidate':
+            self._invalidate(day)
+        else:
+            self._mark(day, time, operation == 'occupy')
+
+    def prune(self, before: date | None = None) -> int:
+        """
+        Удаляет из индекса прошедшие даты.
+
+        :param before: Даты раньше этой удаляются. По умолчанию - сегодняшняя дата.
+        :return: Количество удаленных дат.
+        """
+        before = before or date.today()
+        stale = [day for day in self._masks if day < before]
+        for day in stale:
+            del self._masks[day]
+        for key in [key for key in self._months if key < (before.year, before.month)]:
+            del self._months[key]
+            self._month_changes.pop(key, None)
+        return len(stale)
+
+    async def check_consistency(self, session: AsyncSession, repair: bool = True) -> dict:
+        """
+        Сверяет загруженные маски с базой данных.
+
+        :param session: Асинхронная сессия базы данных.
+        :param repair: Если True, расхождения исправляются значениями из базы данных.
+        :return: Словарь {дата: (маска в индексе, маска в базе)} для дат с расхождениями.
+        """
+        mismatches = {}
+        for day, mask in list(self._masks.items()):
+            actual = await self._load(session, day)
+            if self._masks.get(day) != mask:  # Маска изменилась во время проверки - сверим в следующий раз
+                continue
+            if actual != mask:
+                mismatches[day] = (mask, actual)
+                if repair:
+                    self._masks[day] = actual
+                    self._update_month(day, actual)
+        if mismatches:
+            app_logger.warning(f'Индекс слотов расходится с базой данных: {mismatches}')
+        return mismatches
+
+    async def run_periodic_check(self, session_pool: async_sessionmaker, interval: float) -> None:
+        """
+        Периодически удаляет прошедшие даты и сверяет индекс с базой данных.
+
+        :param session_pool: Фабрика асинхронных сессий.
+        :param interval: Интервал между проверками в секундах.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self.prune()
+            try:
+                async with session_pool() as session:
+                    await self.check_consistency(session)
+            except Exception as e:
+                app_logger.error(f'Ошибка проверки индекса слотов: {e}')
+
+
+slot_index = SlotIndex()
@@ -0,0 +1,176 @@
+# Очередь записи в базу данных: изменения из разных обработчиков фиксируются одной транзакцией
+import asyncio
+from typing import Any, Awaitable, Callable
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from common.metrics import UpdateRecord, current_update
+from logging_config import setup_logging
+
+# Настройка логгирования
+app_logger = setup_logging("write_queue", "logs/orm.log")
+
+Apply = Callable[[AsyncSession], Awaitable[Any]]
+OnCommit = Callable[[Any], None]
+
+
+class WriteQueue:
+    """
+    Единственный писатель в базу данных с групповой фиксацией (group commit).
+
+    Обработчики не открывают собственные транзакции на запись, а передают в очередь намерение -
+    корутину apply(session), и ждут результат. Фоновая задача собирает намерения, пришедшие
+    за max_delay секунд (или до max_batch штук), и выполняет их в одной транзакции. Если какое-то
+    намерение завершилось ошибкой (например, нарушение уникальности uq_user_date_time), пачка
+    выполняется заново, каждое намерение - в своей точке сохранения (SAVEPOINT): ошибка откатывает
+    только его и передается вызвавшему его обработчику, остальные фиксируются вместе. Поэтому apply
+    должна быть повторяемой: каждый раз заново читать и создавать объекты в переданной сессии.
+    На SQLite это одна синхронизация с диском на пачку вместо одной на каждую запись.
+
+    После фиксации для каждого успешного намерения вызывается on_commit(результат) - здесь
+    обновляются индексы и кэши в памяти.
+
+    Фоновая задача не относится ни к одному апдейту (common.metrics.current_update), а запросы
+    каждого намерения засчитываются апдейту, из обработчика которого оно поставлено.
+
+    :param session_pool: Фабрика асинхронных сессий (задается в db.engine).
+    :param max_delay: Сколько секунд ждать попутные намерения перед записью пачки.
+    :param max_batch: Максимальное количество намерений в одной транзакции.
+    """
+
+    def __init__(self, session_pool: async_sessionmaker | None = None, max_delay: float = 0.005,
+                 max_batch: int = 64) -> None:
+        self.session_pool = session_pool
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.batches = 0  # Зафиксированных транзакций
+        self.items = 0  # Выполненных намерений
+        self.failed = 0  # Намерений, завершившихся ошибкой
+
+        self._pending: list[tuple[Apply, OnCommit | None, asyncio.Future, UpdateRecord | None]] = []
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._writing = False
+
+    def start(self) -> None:
+        """
+        Запускает фоновую задачу записи. Вызывается автоматически при первом намерении.
+        """
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, apply: Apply, on_commit: OnCommit | None = None) -> Any:
+        """
+        Ставит намерение в очередь и ждет, пока его транзакция будет зафиксирована.
+
+        :param apply: Корутина, которая выполняет изменения в переданной сессии и возвращает результат.
+        :param on_commit: Функция, вызываемая с результатом apply после фиксации транзакции.
+        :return: Результат apply.
+        :raises Exception: Исключение, возникшее в apply или при фиксации транзакции.
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((apply, on_commit, future, current_update.get()))
+        self._wakeup.set()
+        return await future
+
+    async def _run(self) -> None:
+        current_update.set(None)  # Задача могла быть запущена в обработчике апдейта
+        while True:
+            await self._wakeup.wait()
+            if len(self._pending) < self.max_batch:
+                await asyncio.sleep(self.max_delay)  # Собираем попутные намерения
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            if not self._pending:
+                self._wakeup.clear()
+            self._writing = True
+            try:
+                await self._write(batch)
+            except Exception as e:
+                app_logger.error(f'Ошибка записи пачки из {len(batch)} изменений: {e}')
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                self._writing = False
+
+    async def _write(self, batch: list) -> None:
+        """Выполняет пачку намерений в одной транзакции и передает каждому вызывающему его результат."""
+        try:
+            results = await self._apply_batch(batch, savepoints=False)
+        except Exception:
+            # Какое-то намерение не выполнилось - повторяем пачку, изолируя каждое в точке сохранения
+            results = await self._apply_batch(batch, savepoints=True)
+
+        self.batches += 1
+        for (_, on_commit, future, _), (ok, result) in zip(batch, results):
+            if ok:
+                self.items += 1
+                if on_commit is not None:
+                    try:
+                        on_commit(result)
+                    except Exception as e:  # Изменение уже зафиксировано: вызывающий получает результат
+                        app_logger.error(f'Ошибка в on_commit после фиксации: {e}')
+                if not future.done():
+                    future.set_result(result)
+            else:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(result)
+
+    async def _apply_batch(self, batch: list, savepoints: bool) -> list:
+        """
+        Выполняет намерения пачки в одной транзакции.
+
+        Без точек сохранения первая же ошибка откатывает всю транзакцию и пробрасывается дальше.
+        С точками сохранения ошибка откатывает только свое намерение и попадает в результаты.
+
+        :return: Список пар (успех, результат или исключение) в порядке намерений.
+        """
+        results = []
+        async with self.session_pool() as session:
+            async with session.begin():
+                if session.bind.dialect.name == 'sqlite':
+                    # Драйвер sqlite3 не открывает транзакцию перед SAVEPOINT, и RELEASE первой точки
+                    # сохранения зафиксировал бы ее отдельно. IMMEDIATE сразу берет блокировку на запись.
+                    await (await session.connection()).exec_driver_sql('BEGIN IMMEDIATE')
+                for apply, _, _, record in batch:
+                    token = current_update.set(record)  # Запросы намерения - апдейту, который его поставил
+                    try:
+                        if not savepoints:
+                            results.append((True, await apply(session)))
+                            continue
+                        try:
+                            async with session.begin_nested():
+                                result = await apply(session)
+                        except Exception as e:  # Откатывается только это намерение
+                            results.append((False, e))
+                        else:
+                            results.append((True, result))
+                    finally:
+                        current_update.reset(token)
+        return results
+
+    def stats(self) -> dict:
+        """
+        Возвращает счетчики очереди.
+
+        :return: Словарь с числом транзакций, выполненных и неудачных намерений.
+        """
+        return {'batches': self.batches, 'items': self.items, 'failed': self.failed}
+
+    async def close(self) -> None:
+        """
+        Дожидается записи оставшихся намерений и останавливает фоновую задачу.
+        """
+        while self._pending or self._writing:
+            await asyncio.sleep(self.max_delay)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+write_queue = WriteQueue()
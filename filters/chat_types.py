@@ -0,0 +1,11 @@
+from aiogram import Bot, types
+from aiogram.filters import Filter
+
+
+class IsAdmin(Filter):
+    """
+       Пропускает только сообщения администраторов бота (список bot.a_admins_list задается в main.py).
+       """
+
+    async def __call__(self, message: types.Message, bot: Bot) -> bool:
+        return message.from_user is not None and message.from_user.id in getattr(bot, 'a_admins_list', [])
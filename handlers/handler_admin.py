@@ -1,25 +1,148 @@
+import html
+import os
+from datetime import date, datetime, timedelta
+
 from aiogram import F, Router, types
-from aiogram.filters import Command, StateFilter, or_f
+from aiogram.filters import Command, CommandObject, StateFilter, or_f
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from db.orm_query import orm_get_info_pages, orm_change_banner_image
+from common.metrics import metrics
+from common.outbound import outbound
+from db.banner_cache import banner_cache
+from db.broadcast import broadcaster, count_recipients
+from db.export import EXPORT_FORMATS, export_appointments
+from db.orm_query import orm_get_info_pages, orm_change_banner_image, orm_get_appointment_history
+from db.query_profile import query_profiler
+from db.reminders import reminders
+from db.write_queue import write_queue
+from filters.chat_types import IsAdmin
 from kbrd.reply import get_keyboard
+from middlewares.db import DataBaseSession
 
 handler_admin_router = Router()
 
 
 ADMIN_KB = get_keyboard(
     "Добавить/Изменить баннер",
+    "Статистика кэша",
+    "Рассылка",
+    "Остановить рассылку",
     placeholder="Выберите действие",
     sizes=(2,),
 )
 
 
-@handler_admin_router.message(Command("admin"))
+@handler_admin_router.message(Command("admin"), IsAdmin(), flags={'db': False})
 async def admin_features(message: types.Message):
-    await message.answer("Вы вошли в админ-панель", reply_markup=ADMIN_KB)
+    await outbound.send(message.answer("Вы вошли в админ-панель", reply_markup=ADMIN_KB))
+
+
+@handler_admin_router.message(StateFilter(None), F.text == 'Статистика кэша', IsAdmin(), flags={'db': False})
+async def cache_stats(message: types.Message, db_middleware: DataBaseSession | None = None):
+    """
+       Отправляет администратору счетчики попаданий и промахов кэша баннеров, число событий,
+       обработанных без обращения к базе данных, счетчики очереди записи и очереди исходящих сообщений.
+
+       Параметры:
+           message (types.Message): Сообщение, содержащее текст, который инициировал команду.
+           db_middleware (DataBaseSession): Мидлвар сессий базы данных (из workflow_data диспетчера).
+       """
+    stats = banner_cache.stats()
+    text = (f"Кэш баннеров:\nПопадания: {stats['hits']}\nПромахи: {stats['misses']}"
+            f"\nСтраниц в кэше: {stats['pages']}")
+    if db_middleware is not None:
+        db_stats = db_middleware.stats()
+        text += f"\n\nСобытий обработано: {db_stats['served']}\nИз них без обращения к БД: {db_stats['zero_db']}"
+    write_stats = write_queue.stats()
+    text += (f"\n\nТранзакций записи: {write_stats['batches']}\nИзменений записано: {write_stats['items']}"
+             f"\nОтклонено (конфликты и ошибки): {write_stats['failed']}")
+    send_stats = outbound.stats()
+    text += (f"\n\nИсходящих в очереди: {send_stats['queued']} (ответы {send_stats['interactive']}, меню "
+             f"{send_stats['menu']}, напоминания {send_stats['reminder']}, рассылки {send_stats['bulk']})\nОтправлено: {send_stats['sent']}, ошибок: "
+             f"{send_stats['failed']}, пауз 429: {send_stats['retries']}\nВремя отправки p50/p95: "
+             f"{send_stats['latency_p50_ms']}/{send_stats['latency_p95_ms']} мс")
+    reminder_stats = reminders.stats()
+    text += (f"\n\nНапоминаний в окне: {reminder_stats['entries']} (по {reminder_stats['loaded_day']}), "
+             f"отправлено: {reminder_stats['sent']}")
+    await outbound.send(message.answer(text))
+
+
+@handler_admin_router.message(StateFilter(None), Command("stats"), IsAdmin(), flags={'db': False})
+async def metrics_stats(message: types.Message):
+    """
+       Отправляет администратору сводку метрик: время обработки по обработчикам и запросы к базе данных.
+
+       Параметры:
+           message (types.Message): Сообщение с командой /stats.
+       """
+    rows = metrics.handlers()
+    if not rows:
+        await outbound.send(message.answer("Метрик пока нет: события еще не обрабатывались или METRICS=0."))
+        return
+    lines = ["Обработчик: вызовов, p50/p95/p99 мс, запросов к БД и мс БД на вызов"]
+    lines += [f"{row['handler']}: {row['count']}, {row['p50_ms']}/{row['p95_ms']}/{row['p99_ms']}, "
+              f"{row['queries']}, {row['db_ms']}" for row in rows[:15]]
+    queries = metrics.query_seconds
+    per_update = metrics.queries_per_update
+    lines.append(f"\nSQL-запросов: {metrics.queries}, p50/p95/p99: {queries.quantile(0.5) * 1000:.2f}/"
+                 f"{queries.quantile(0.95) * 1000:.2f}/{queries.quantile(0.99) * 1000:.2f} мс")
+    lines.append(f"Запросов на событие: в среднем {per_update.sum / max(per_update.count, 1):.2f}, "
+                 f"p95 {per_update.quantile(0.95):.1f}")
+    await outbound.send(message.answer('\n'.join(lines)))
+
+
+@handler_admin_router.message(StateFilter(None), Command("queries"), IsAdmin())
+async def queries_stats(message: types.Message, session: AsyncSession):
+    """
+       Отправляет администратору самые затратные SQL-запросы (по суммарному времени) и их планы.
+
+       Планы (EXPLAIN QUERY PLAN) трех худших запросов получаются только по этой команде и пишутся
+       также в logs/sql.log. "/queries reset" сбрасывает накопленную сводку.
+
+       Параметры:
+           message (types.Message): Сообщение с командой /queries.
+           session (AsyncSession): Асинхронная сессия SQLAlchemy (нужен движок для планов).
+       """
+    if (message.text or '').split()[1:2] == ['reset']:
+        query_profiler.reset()
+        await outbound.send(message.answer("Сводка запросов сброшена."))
+        return
+    top = query_profiler.top(10)
+    if not top:
+        await outbound.send(message.answer("Запросов пока не было или профилирование отключено (QUERY_PROFILE=0)."))
+        return
+    plans = await query_profiler.explain(session.bind)
+    lines = [f"Медленных запросов (дольше {query_profiler.threshold_ms:g} мс): {query_profiler.slow}",
+             "Вызовов, всего/среднее/максимум мс:"]
+    for key, stats in top:
+        lines.append(f"\n{stats.count}, {stats.total * 1000:.1f}/{stats.total / stats.count * 1000:.2f}/"
+                     f"{stats.max * 1000:.1f}: <code>{html.escape(key[:200])}</code>")
+        if key in plans:
+            lines.append(f"План: {html.escape(plans[key])}")
+    await outbound.send(message.answer('\n'.join(lines)))
+
+
+@handler_admin_router.message(StateFilter(None), Command("history"), IsAdmin())
+async def history_command(message: types.Message, command: CommandObject, session: AsyncSession):
+    """
+       Отправляет администратору историю записей по номеру телефона, включая архивные (см. db.archive).
+
+       Параметры:
+           message (types.Message): Сообщение с командой, например "/history 89001234567".
+           command (CommandObject): Разобранная команда с аргументами.
+           session (AsyncSession): Асинхронная сессия SQLAlchemy для взаимодействия с базой данных.
+       """
+    phone = (command.args or '').strip()
+    rows = await orm_get_appointment_history(session, phone) if phone else []
+    if not rows:
+        await outbound.send(message.answer("Записей не найдено. Формат команды: /history номер телефона"))
+        return
+    lines = [f"История записей {html.escape(phone)} (последние {len(rows)}):"]
+    lines += [f"{row.day:%d-%m-%Y} {row.time} - {html.escape(row.name or '')}{' (архив)' if row.archived else ''}"
+              for row in rows]
+    await outbound.send(message.answer('\n'.join(lines)))
 
 
 # FSM для загрузки/изменения баннеров
@@ -28,8 +151,15 @@ class AddBanner(StatesGroup):
     image = State()
 
 
+# FSM для рассылки
+
+class AddBroadcast(StatesGroup):
+    content = State()
+    confirm = State()
+
+
 # Отправляем перечень информационных страниц бота и становимся в состояние отправки photo
-@handler_admin_router.message(StateFilter(None), F.text == 'Добавить/Изменить баннер')
+@handler_admin_router.message(StateFilter(None), F.text == 'Добавить/Изменить баннер', IsAdmin())
 async def add_image2(message: types.Message, state: FSMContext, session: AsyncSession):
     """
        Обрабатывает отправку сообщения для добавления или изменения баннера.
@@ -50,13 +180,14 @@ async def add_image2(message: types.Message, state: FSMContext, session: AsyncSe
            3. Устанавливает состояние бота в `AddBanner.image`, чтобы ожидать получения изображения.
        """
     pages_names = [page.name for page in await orm_get_info_pages(session)]
-    await message.answer(f"Отправьте фото баннера.\nВ описании укажите для какой страницы:\
-                         \n{', '.join(pages_names)}")
+    await outbound.send(message.answer(f"Отправьте фото баннера.\nВ описании укажите для какой страницы:\
+                         \n{', '.join(pages_names)}"))
     await state.set_state(AddBanner.image)
 
 
 # Команда отмены
-@handler_admin_router.message(StateFilter(AddBanner.image), Command("отмена"))
+@handler_admin_router.message(StateFilter(AddBanner.image, AddBroadcast.content, AddBroadcast.confirm),
+                              Command("отмена"), flags={'db': False})
 async def cancel_process(message: types.Message, state: FSMContext):
     """
         Обрабатывает команду отмены, когда пользователь находится в процессе добавления изображения баннера.
@@ -75,7 +206,7 @@ async def cancel_process(message: types.Message, state: FSMContext):
                вернуться к администраторским командам.
         """
     await state.clear()  # Сбрасываем состояние
-    await message.answer("Операция отменена. Вы можете вернуться к администраторским командам.")
+    await outbound.send(message.answer("Операция отменена. Вы можете вернуться к администраторским командам."))
 
 
 # Добавляем/изменяем изображение в таблице
@@ -105,16 +236,16 @@ async def add_banner(message: types.Message, state: FSMContext, session: AsyncSe
     for_page = message.caption.strip()
     pages_names = [page.name for page in await orm_get_info_pages(session)]
     if for_page not in pages_names:
-        await message.answer(f"Введите нормальное название страницы, например:\
-                         \n{', '.join(pages_names)}")
+        await outbound.send(message.answer(f"Введите нормальное название страницы, например:\
+                         \n{', '.join(pages_names)}"))
         return
-    await orm_change_banner_image(session, for_page, image_id, )
-    await message.answer("Баннер добавлен/изменен.")
+    await orm_change_banner_image(for_page, image_id)
+    await outbound.send(message.answer("Баннер добавлен/изменен."))
     await state.clear()
 
 
 # ловим некоррекный ввод
-@handler_admin_router.message(AddBanner.image)
+@handler_admin_router.message(AddBanner.image, flags={'db': False})
 async def add_banner2(message: types.Message, state: FSMContext):
     """
        Обрабатывает некорректный ввод, когда пользователь отправляет не изображение.
@@ -126,4 +257,123 @@ async def add_banner2(message: types.Message, state: FSMContext):
        Процесс:
            1. Отправляет сообщение пользователю с просьбой отправить фото баннера или команду на отмену.
        """
-    await message.answer("Отправьте фото баннера или отмена")
+    await outbound.send(message.answer("Отправьте фото баннера или отмена"))
+
+
+# Рассылка всем, кто когда-либо записывался
+@handler_admin_router.message(StateFilter(None), F.text == 'Рассылка', IsAdmin(), flags={'db': False})
+async def broadcast_start(message: types.Message, state: FSMContext):
+    """
+       Запрашивает у администратора содержимое рассылки.
+
+       Параметры:
+           message (types.Message): Сообщение, содержащее текст, который инициировал команду.
+           state (FSMContext): Контекст состояния для управления текущим состоянием в состоянии машины.
+       """
+    if broadcaster.running:
+        await outbound.send(message.answer("Рассылка уже выполняется. Дождитесь ее окончания или остановите."))
+        return
+    await outbound.send(message.answer("Отправьте текст рассылки или фото с подписью. Чтобы разослать баннер, "
+                                       "отправьте название его страницы. Отмена - /отмена"))
+    await state.set_state(AddBroadcast.content)
+
+
+@handler_admin_router.message(AddBroadcast.content, or_f(F.photo, F.text), IsAdmin())
+async def broadcast_content(message: types.Message, state: FSMContext, session: AsyncSession):
+    """
+       Сохраняет содержимое рассылки и спрашивает подтверждение, сообщив число получателей.
+
+       Параметры:
+           message (types.Message): Текст, фото с подписью или название страницы баннера.
+           state (FSMContext): Контекст состояния для управления текущим состоянием в состоянии машины.
+           session (AsyncSession): Асинхронная сессия SQLAlchemy для взаимодействия с базой данных.
+       """
+    if message.photo:
+        text, photo = message.caption, message.photo[-1].file_id
+    else:
+        banner = await banner_cache.get(session, message.text.strip())
+        if banner is not None:  # Рассылаем баннер страницы
+            text, photo = banner.description, banner.image
+        else:
+            text, photo = message.html_text, None
+    await state.update_data(text=text, photo=photo)
+    recipients = await count_recipients(session)
+    await outbound.send(message.answer(f"Получателей: {recipients}. Начать рассылку? (да/нет)"))
+    await state.set_state(AddBroadcast.confirm)
+
+
+@handler_admin_router.message(AddBroadcast.confirm, IsAdmin(), flags={'db': False})
+async def broadcast_confirm(message: types.Message, state: FSMContext):
+    """
+       Запускает рассылку после подтверждения. Ход рассылки приходит отдельными отчетами.
+
+       Параметры:
+           message (types.Message): Ответ администратора ("да" или "нет").
+           state (FSMContext): Контекст состояния для управления текущим состоянием в состоянии машины.
+       """
+    if (message.text or '').strip().lower() != 'да':
+        await state.clear()
+        await outbound.send(message.answer("Рассылка отменена.", reply_markup=ADMIN_KB))
+        return
+    data = await state.get_data()
+    await state.clear()
+    broadcast_id = await broadcaster.create(message.chat.id, data.get('text'), data.get('photo'))
+    await outbound.send(message.answer(f"Рассылка #{broadcast_id} запущена.", reply_markup=ADMIN_KB))
+
+
+@handler_admin_router.message(StateFilter(None), F.text == 'Остановить рассылку', IsAdmin(), flags={'db': False})
+async def broadcast_stop(message: types.Message):
+    """
+       Останавливает выполняющуюся рассылку.
+
+       Параметры:
+           message (types.Message): Сообщение, содержащее текст, который инициировал команду.
+       """
+    stopped = await broadcaster.stop()
+    if stopped:
+        await outbound.send(message.answer(f"Рассылка #{', #'.join(map(str, stopped))} остановлена."))
+    else:
+        await outbound.send(message.answer("Сейчас нет выполняющихся рассылок."))
+
+
+EXPORT_USAGE = "Формат команды: /export [ДД-ММ-ГГГГ ДД-ММ-ГГГГ] [csv|jsonl]"
+
+
+# Выгрузка записей за период
+@handler_admin_router.message(StateFilter(None), Command("export"), IsAdmin())
+async def export_command(message: types.Message, command: CommandObject, session: AsyncSession):
+    """
+       Отправляет администратору файл с записями за период.
+
+       Без дат выгружаются записи на год вперед от сегодняшнего дня, формат по умолчанию - CSV.
+       Строки читаются из базы данных потоком и пишутся во временный файл частями (см. db.export),
+       поэтому выгрузка за год не задерживает ответы другим чатам.
+
+       Параметры:
+           message (types.Message): Сообщение с командой, например "/export 01-01-2025 31-12-2025 jsonl".
+           command (CommandObject): Разобранная команда с аргументами.
+           session (AsyncSession): Асинхронная сессия SQLAlchemy для взаимодействия с базой данных.
+       """
+    args = (command.args or '').split()
+    fmt = 'csv'
+    if args and args[-1].lower() in EXPORT_FORMATS:
+        fmt = args.pop().lower()
+    try:
+        if not args:
+            start = date.today()
+            end = start + timedelta(days=365)
+        elif len(args) == 2:
+            start, end = (datetime.strptime(arg, "%d-%m-%Y").date() for arg in args)
+        else:
+            raise ValueError
+    except ValueError:
+        await outbound.send(message.answer(EXPORT_USAGE))
+        return
+
+    path, count = await export_appointments(session, start, end, fmt)
+    try:
+        filename = f"appointments_{start:%d-%m-%Y}_{end:%d-%m-%Y}.{fmt}"
+        await outbound.send(message.answer_document(types.FSInputFile(path, filename=filename),
+                                                    caption=f"Записей: {count}"), wait=True)
+    finally:
+        os.unlink(path)  # Файл удаляется после отправки
@@ -1,18 +1,23 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 from aiogram import F, Router, types
-from aiogram.filters import CommandStart, StateFilter
+from aiogram.filters import Command, CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InputMediaPhoto
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
-
-from db.models import User
 
+from common.outbound import MENU, outbound
+from common.phone import format_phone, phone_key
+from common.text_for import images_for_info_pages
+from db.media import media_registry
 from db.orm_query import orm_get_banner, orm_add_user, orm_get_appointments_by_phone, \
-    orm_update_user_appointment  # orm_add_appointment
-from kbrd.inline import get_user_main_btns, MenuCallBack
+    orm_update_user_appointment, orm_delete_appointment  # orm_add_appointment
+from db.slot_hold import slot_holds
+from db.slot_index import FULL_MASK, SLOT_ORDINALS, mask_to_slots, slot_index
+from kbrd.inline import calendar_month_allowed, get_calendar_btns, USER_MAIN_KB, CalendarCallBack, MenuCallBack
+from kbrd.registry import keyboards
 from logging_config import setup_logging
 
 handler_user_router = Router()
@@ -44,11 +49,13 @@ async def get_banner_menu(session: AsyncSession, menu_name: str):
     :return: Главный баннер и кнопки меню.
     """
     banner = await orm_get_banner(session, menu_name)
-    image = InputMediaPhoto(media=banner.image, caption=banner.description)
-
-    kbds = get_user_main_btns()
+    media = banner.image
+    if media is None:  # file_id еще нет (не задан MEDIA_CHAT_ID) - отправляем файл из папки image
+        name = images_for_info_pages.get(menu_name)
+        media = name and media_registry.input_file(name)
+    image = InputMediaPhoto(media=media, caption=banner.description)
 
-    return image, kbds
+    return image, USER_MAIN_KB  # Готовая клавиатура из реестра, без сборки на каждый апдейт
 
 
 async def get_menu_content(session: AsyncSession, menu_name: str):
@@ -72,10 +79,10 @@ async def start_cmd(message: types.Message, session: AsyncSession):
       :param session: Асинхронная сессия базы данных.
       """
     media, reply_markup = await get_menu_content(session, menu_name="main")
-    await message.answer_photo(media.media, caption=media.caption, reply_markup=reply_markup)
+    await outbound.send(message.answer_photo(media.media, caption=media.caption, reply_markup=reply_markup))
 
 
-@handler_user_router.callback_query(MenuCallBack.filter())
+@handler_user_router.callback_query(keyboards.filter(MenuCallBack))
 async def user_menu(callback: types.CallbackQuery, callback_data: MenuCallBack, session: AsyncSession,
                     state: FSMContext):
     """
@@ -94,8 +101,8 @@ async def user_menu(callback: types.CallbackQuery, callback_data: MenuCallBack,
         return
     media, reply_markup = await get_menu_content(session, menu_name=callback_data.menu_name)
 
-    await callback.message.edit_media(media=media, reply_markup=reply_markup)
-    await callback.answer()
+    await outbound.send(callback.message.edit_media(media=media, reply_markup=reply_markup))
+    await outbound.send(callback.answer())
 
 
 ######################################################
@@ -110,7 +117,22 @@ class AddUser(StatesGroup):
     time = State()  # Состояние для выбора времени
 
 
-@handler_user_router.callback_query(F.data == "make an appoint")
+@handler_user_router.message(StateFilter('*'), Command('cancel'))
+async def cancel_process(message: types.Message, session: AsyncSession, state: FSMContext):
+    """
+       Отменяет текущий процесс записи и снимает бронь выбранного слота.
+
+       :param message: Сообщение от пользователя.
+       :param session: Асинхронная сессия базы данных.
+       :param state: Состояние машины состояний FSM.
+       """
+    slot_holds.release(message.chat.id)
+    await state.clear()
+    await outbound.send(message.answer("Действие отменено."))
+    await send_start_menu(message, session)
+
+
+@handler_user_router.callback_query(F.data == "make an appoint", flags={'db': False})
 async def register_user(callback: types.CallbackQuery, state: FSMContext):
     """
        Начинает процесс регистрации нового пользователя.
@@ -118,13 +140,13 @@ async def register_user(callback: types.CallbackQuery, state: FSMContext):
        :param callback: Объект callback от пользователя.
        :param state: Состояние машины состояний FSM.
        """
-    await callback.answer()  # Убираем индикатор загрузки
-    await callback.message.answer("Пожалуйста, введите ваше имя:", reply_markup=types.ReplyKeyboardRemove())
+    await outbound.send(callback.answer())  # Убираем индикатор загрузки
+    await outbound.send(callback.message.answer("Пожалуйста, введите ваше имя:", reply_markup=types.ReplyKeyboardRemove()))
     await state.set_state(AddUser.name)
 
 
 #################################################
-@handler_user_router.message(StateFilter(AddUser.name))
+@handler_user_router.message(StateFilter(AddUser.name), flags={'db': False})
 async def process_name(message: types.Message, state: FSMContext):
     """
         Обрабатывает ввод имени пользователя и переходит к следующему этапу ввода данных.
@@ -133,7 +155,7 @@ async def process_name(message: types.Message, state: FSMContext):
         :param state: Состояние машины состояний FSM, хранящее данные пользователя.
     """
     await state.update_data(name=message.text)  # Сохраняем имя
-    await message.answer("Пожалуйста, введите ваш телефон:")
+    await outbound.send(message.answer("Пожалуйста, введите ваш телефон:"))
     await state.set_state(AddUser.phone)
 
 
@@ -150,40 +172,33 @@ def format_phone_number(phone: str) -> str:
         :param phone: Исходный номер телефона.
         :return: Отформатированный номер телефона.
         """
-    # Удаление нежелательных символов (например, пробелов, скобок и дефисов)
-    phone_digits = ''.join(filter(str.isdigit, phone))
-
-    # Проверка количества цифр
-    if len(phone_digits) < 10:
+    # Ключ номера: последние 10 цифр с кодом +7 (см. common.phone)
+    key = phone_key(phone)
+    if key is None:
         return "Неверный номер телефона."  # Слишком короткий номер
 
-    # Оставляем только последние 10 цифр для формата
-    phone_digits = phone_digits[-10:]
-
-    # Форматирование нужным образом
-    formatted_phone = f"+7({phone_digits[:3]}){phone_digits[3:6]}-{phone_digits[6:8]}-{phone_digits[8:10]}"
-
-    return formatted_phone
+    return format_phone(key)
 
 
 #########################################################
 
 
 @handler_user_router.message(AddUser.phone)
-async def process_phone(message: types.Message, state: FSMContext):
+async def process_phone(message: types.Message, state: FSMContext, session: AsyncSession):
     """
     Обрабатывает введенный пользователем номер телефона и проверяет его корректность.
     На основе введенного номера телефона запрашивает дату для записи.
 
     :param message: Объект сообщения от пользователя, содержащий введенный номер телефона.
     :param state: Состояние машины состояний FSM, хранящее данные пользователя.
+    :param session: Асинхронная сессия базы данных (для календаря свободных дат).
     """
     phone_number = message.text
     formatted_phone = format_phone_number(phone_number)  # Форматируем номер
 
     # Проверяем корректность номера телефона
     if formatted_phone == "Неверный номер телефона.":
-        await message.answer(formatted_phone)  # Если номер неверный, уведомляем пользователя
+        await outbound.send(message.answer(formatted_phone))  # Если номер неверный, уведомляем пользователя
         return
 
     # Сохраняем отформатированный номер телефона
@@ -193,24 +208,42 @@ async def process_phone(message: types.Message, state: FSMContext):
     operation_type = (await state.get_data()).get('operation_type', 'add')
     await state.update_data(operation_type=operation_type)
 
-    await message.answer("Пожалуйста, введите желаемую дату в формате 'ДД-ММ-ГГГГ':")
+    await send_calendar(message, session)
     await state.set_state(AddUser.date)
 
 
 ##########################################################################
-''' Проверка даты на корректность '''
+''' Выбор даты: календарь или ввод в формате ДД-ММ-ГГГГ '''
 
+DATE_PROMPT = "Пожалуйста, выберите дату в календаре или введите ее в формате 'ДД-ММ-ГГГГ':"
 
-@handler_user_router.message(AddUser.date)
-async def process_date(message: types.Message, state: FSMContext, session: AsyncSession):
+
+async def send_calendar(message: types.Message, session: AsyncSession, text: str = DATE_PROMPT,
+                        year: int | None = None, month: int | None = None):
     """
-       Обрабатывает сообщение с датой, введенной пользователем.
+       Отправляет сообщение с календарем на месяц, в котором отмечены полностью занятые даты.
 
-       :param message: Сообщение от пользователя, содержащее дату.
+       :param message: Сообщение, в чат которого отправляется календарь.
+       :param session: Асинхронная сессия базы данных.
+       :param text: Текст сообщения.
+       :param year: Год (по умолчанию текущий).
+       :param month: Месяц (по умолчанию текущий).
+       """
+    today = datetime.now().date()
+    year, month = year or today.year, month or today.month
+    full_days = await slot_index.full_days(session, year, month)  # Один запрос на месяц, дальше из кэша
+    await outbound.send(message.answer(text, reply_markup=get_calendar_btns(year, month, full_days=full_days, today=today)))
+
+
+async def offer_slots(message: types.Message, state: FSMContext, session: AsyncSession, selected_date: str):
+    """
+       Проверяет выбранную дату и предлагает свободные слоты на нее.
+
+       :param message: Сообщение, в чат которого отправляется ответ.
        :param state: Контекст состояния, используемый для хранения данных состояния FSM.
        :param session: Асинхронная сессия базы данных для работы с записями.
+       :param selected_date: Дата в формате 'ДД-ММ-ГГГГ'.
        """
-    selected_date = message.text
     await state.update_data(selected_date=selected_date)  # Здесь сохраняем текст даты в состоянии
 
     # Проверка текущей даты
@@ -222,54 +255,97 @@ async def process_date(message: types.Message, state: FSMContext, session: Async
 
         # Проверка, что дата - не вчерашняя или более ранняя
         if selected_date_obj < today:
-            await message.answer("Пожалуйста, введите корректное число (не ранее сегодняшнего дня).")
+            await outbound.send(message.answer("Пожалуйста, введите корректное число (не ранее сегодняшнего дня)."))
             await state.set_state(AddUser.date)
             return
 
     except ValueError:
-        await message.answer("Неверный формат даты. Пожалуйста, используйте формат 'ДД-ММ-ГГГГ'.")
+        await outbound.send(message.answer("Неверный формат даты. Пожалуйста, используйте формат 'ДД-ММ-ГГГГ'."))
         await state.set_state(AddUser.date)
         return
 
-    # Получаем свободные слоты
-    free_slots = await get_free_slots(session, selected_date)
+    # Получаем свободные слоты (без слотов, забронированных другими пользователями)
+    free_slots = await get_free_slots(session, selected_date, holder=message.chat.id)
 
     if free_slots:
         slots_text = "\n".join(f"{i + 1}. {slot}" for i, slot in enumerate(free_slots))
-        await message.answer("Выберите время:\n" + slots_text)
+        await outbound.send(message.answer("Выберите время:\n" + slots_text))
+        await state.update_data(offered_slots=free_slots)  # Номер, введенный пользователем, относится к этому списку
         await state.set_state(AddUser.time)
     else:
-        await message.answer("К сожалению, на выбранную дату записи нет. Попробуйте другую дату.")
+        await send_calendar(message, session, "К сожалению, на выбранную дату записи нет. Попробуйте другую дату.",
+                            selected_date_obj.year, selected_date_obj.month)
         await state.set_state(AddUser.date)
 
 
+@handler_user_router.message(AddUser.date)
+async def process_date(message: types.Message, state: FSMContext, session: AsyncSession):
+    """
+       Обрабатывает сообщение с датой, введенной пользователем.
+
+       :param message: Сообщение от пользователя, содержащее дату.
+       :param state: Контекст состояния, используемый для хранения данных состояния FSM.
+       :param session: Асинхронная сессия базы данных для работы с записями.
+       """
+    await offer_slots(message, state, session, message.text)
+
+
+@handler_user_router.callback_query(keyboards.filter(CalendarCallBack))
+async def process_calendar(callback: types.CallbackQuery, callback_data: CalendarCallBack, state: FSMContext,
+                           session: AsyncSession):
+    """
+       Обрабатывает нажатие кнопки календаря: переход к другому месяцу или выбор даты.
+
+       :param callback: Объект CallbackQuery, содержащий данные о нажатой кнопке.
+       :param callback_data: Данные кнопки календаря.
+       :param state: Контекст состояния, используемый для хранения данных состояния FSM.
+       :param session: Асинхронная сессия базы данных для работы с записями.
+       """
+    if callback_data.action == 'ignore':
+        await outbound.send(callback.answer())
+        return
+    today = datetime.now().date()
+    # callback_data приходит от клиента: месяц вне окна календаря (или несуществующий) не должен
+    # доходить до date(), индекса слотов и кэша клавиатур
+    if callback_data.action not in ('nav', 'day') or await state.get_state() != AddUser.date.state or \
+            not calendar_month_allowed(callback_data.year, callback_data.month, today):
+        await outbound.send(callback.answer("Этот календарь уже неактуален."))
+        return
+
+    if callback_data.action == 'nav':
+        full_days = await slot_index.full_days(session, callback_data.year, callback_data.month)
+        await outbound.send(callback.message.edit_reply_markup(reply_markup=get_calendar_btns(
+            callback_data.year, callback_data.month, full_days=full_days, today=today)))
+        await outbound.send(callback.answer())
+        return
+
+    try:
+        selected = date(callback_data.year, callback_data.month, callback_data.day)
+    except ValueError:  # Дня нет в месяце или действие без дня
+        await outbound.send(callback.answer("Этот календарь уже неактуален."))
+        return
+    await outbound.send(callback.answer())
+    await offer_slots(callback.message, state, session, selected.strftime("%d-%m-%Y"))
+
+
 ######################################################################
-async def get_free_slots(session: AsyncSession, selected_date: str) -> list:
+async def get_free_slots(session: AsyncSession, selected_date: str, holder: int | None = None) -> list:
     """
        Получает список свободных временных слотов на указанную дату.
 
        Эта функция проверяет, какие временные слоты доступны для записи, исключая занятые слоты,
-       которые уже забронированы пользователями на указанную дату.
+       которые уже записаны на указанную дату, и слоты, временно забронированные другими пользователями.
 
        :param session: Асинхронная сессия базы данных для выполнения запросов.
        :param selected_date: Дата, по которой нужно получить доступные слоты, в формате 'ДД-ММ-ГГГГ'.
+       :param holder: ID чата, собственная бронь которого не скрывается.
        :return: Список свободных временных слотов.
        """
     try:
-        date_obj = datetime.strptime(selected_date, "%d-%m-%Y")
+        busy = await slot_index.busy_mask(session, selected_date)  # Маска занятости из индекса
     except ValueError:
         return []  # Возвращаем пустой список в случае ошибки формата даты
-
-    # Выполняем запрос с правильным типом данных
-    result = await session.execute(select(User.time).where(func.date(User.date) == date_obj.date()))
-    busy_slots = [row[0] for row in result]  # Получаем первый элемент строки, который представляет собой время
-
-    # Все возможные временные слоты
-    all_slots = ['09:00', '10:00', '11:00', '12:00', '13:00', '14:00', '15:00', '16:00', '17:00', '18:00', '19:00']
-    # Только свободные слоты
-    free_slots = [slot for slot in all_slots if slot not in busy_slots]
-
-    return free_slots
+    return mask_to_slots(~(busy | slot_holds.held_mask(selected_date, exclude_holder=holder)) & FULL_MASK)
 
 
 ##############################################################
@@ -287,6 +363,10 @@ async def process_time(message: types.Message, state: FSMContext, session: Async
         :param state: Состояние машины состояний FSM, хранящее данные пользователя.
         :param session: Асинхронная сессия базы данных для выполнения запросов.
 
+        Номер времени относится к списку слотов, показанному пользователю на предыдущем шаге (offered_slots),
+        поэтому повторно запрашивать свободные слоты не нужно. Выбранный слот бронируется за чатом
+        (см. db.slot_hold): до подтверждения или отмены другие пользователи его не видят.
+
         :raises ValueError: Если введенный номер некорректен или время занято.
         """
     user_data = await state.get_data()  # Получаем данные пользователя из состояния
@@ -294,14 +374,14 @@ async def process_time(message: types.Message, state: FSMContext, session: Async
     phone_number = user_data.get('phone')  # Номер телефона
     selected_date_str = user_data.get('selected_date')  # Выбранная дата
     selected_number = message.text.strip()  # Номер от пользователя
+    free_slots = user_data.get('offered_slots', [])  # Слоты, которые видел пользователь
 
     # Проверяем корректность ввода
-    selected_index = int(selected_number) - 1  # Уменьшаем на 1 для получения индекса
-    free_slots = await get_free_slots(session, selected_date_str)  # Получаем список свободных слотов
+    selected_index = int(selected_number) - 1 if selected_number.isdigit() else -1  # Индекс в списке слотов
 
     # Убедитесь, что индекс находится в пределах доступных слотов
     if selected_index < 0 or selected_index >= len(free_slots):
-        await message.answer("Некорректный номер. Пожалуйста, введите номер, соответствующий времени.")
+        await outbound.send(message.answer("Некорректный номер. Пожалуйста, введите номер, соответствующий времени."))
         return
 
     # Получаем соответствующее время из списка свободных слотов
@@ -311,52 +391,30 @@ async def process_time(message: types.Message, state: FSMContext, session: Async
     selected_datetime = datetime.strptime(f"{selected_date_str} {selected_time}", "%d-%m-%Y %H:%M")
     now = datetime.now()
     if selected_datetime < (now + timedelta(hours=1)):
-        await message.answer("Выберите время, которое будет не менее чем через 1 час от текущего времени.")
+        await outbound.send(message.answer("Выберите время, которое будет не менее чем через 1 час от текущего времени."))
         return
 
-    # Проверяем, занято ли время
-    existing_appointments = await get_existing_appointments(session, selected_date_str)
-    if selected_time in existing_appointments:
-        await message.answer("К сожалению, на это время записи нет. Пожалуйста, выберите другое время.")
+    # Проверяем, что время не занято и не забронировано другим пользователем, и бронируем его
+    busy = await slot_index.busy_mask(session, selected_date_str)
+    if busy >> SLOT_ORDINALS[selected_time] & 1 or \
+            not slot_holds.acquire(selected_date_str, selected_time, holder=message.chat.id):
+        free_slots = await get_free_slots(session, selected_date_str, holder=message.chat.id)
+        await state.update_data(offered_slots=free_slots)
+        slots_text = "\n".join(f"{i + 1}. {slot}" for i, slot in enumerate(free_slots))
+        await outbound.send(message.answer("К сожалению, на это время записи нет. Пожалуйста, выберите другое время:\n"
+                                           + slots_text))
         return
 
     await state.update_data(selected_time=selected_time)  # Сохраняем выбранное время
 
     # Теперь выводим все данные
-    await message.answer(
+    await outbound.send(message.answer(
         f"Проверьте правильность введенных данных:\nИмя: {name}\nТелефон: {phone_number}\n"
         f"\nДата и время записи {selected_date_str} в {selected_time}.\n"
-        "Если данные правильные, напишите 'да', если нет - 'нет'.")
+        "Если данные правильные, напишите 'да', если нет - 'нет'."))
     await state.set_state(AddUser.confirm)
 
 
-##################################################################
-async def get_existing_appointments(session: AsyncSession, selected_date: str) -> list:
-    """
-        Получает все занятые временные слоты по указанной дате.
-
-        Эта функция выполняет запрос к базе данных, чтобы найти все записи о записях на
-        выбранную дату и вернуть список занятых времен.
-
-        :param session: Асинхронная сессия базы данных для выполнения запросов.
-        :param selected_date: Дата, по которой нужно получить записи, в формате 'ДД-ММ-ГГГГ'.
-        :return: Список занятых временных слотов на указанную дату. Если формат даты некорректен,
-                 возвращается пустой список.
-
-        :raises ValueError: Если преобразование строки даты в объект datetime не удалось.
-        """
-    try:
-        date_obj = datetime.strptime(selected_date, "%d-%m-%Y")
-    except ValueError:
-        return []  # Возвращаем пустой список в случае ошибки формата даты
-
-    # Выполняем запрос и получаем занятые слоты по выбранной дате
-    result = await session.execute(select(User.time).where(func.date(User.date) == date_obj))
-    busy_slots = [row[0] for row in result]  # Получаем все времена для данной даты
-
-    return busy_slots
-
-
 #####################################################################
 @handler_user_router.message(AddUser.confirm)
 async def process_confirm(message: types.Message, state: FSMContext, session: AsyncSession):
@@ -386,36 +444,59 @@ async def process_confirm(message: types.Message, state: FSMContext, session: As
     if message.text.lower() == 'да':
         app_logger.info("Пользователь подтвердил действие.")
 
-        if operation_type == 'add':
-            due_date = datetime.strptime(selected_date_str, "%d-%m-%Y")
-            await orm_add_user(session, name=name, phone=phone, date=due_date, time=selected_time)
-            await message.answer(f"Ваша заявка принята на {due_date.strftime('%d-%m-%Y')} в {selected_time}.")
+        # Бронь могла истечь - подтверждаем ее еще раз, пока слот никто не занял
+        if not slot_holds.acquire(selected_date_str, selected_time, holder=message.chat.id):
+            await send_calendar(message, session, "К сожалению, это время уже занято. Пожалуйста, выберите другую "
+                                                  "дату:")
+            await state.set_state(AddUser.date)
+            return
 
-        elif operation_type == 'update':
-            app_logger.info("Попытка обновления записи.")
-            try:
-                await orm_update_user_appointment(session, phone, selected_date_str, selected_time)
-                await message.answer(f"Ваша запись была изменена на {selected_date_str} в {selected_time}.")
-            except Exception as e:
-                app_logger.error(f"Ошибка при обновлении записи: {e}")
-                await message.answer("Произошла ошибка при изменении вашей записи.")
+        try:
+            if operation_type == 'add':
+                due_date = datetime.strptime(selected_date_str, "%d-%m-%Y")
+                try:
+                    await orm_add_user(name=name, phone=phone, date=due_date, time=selected_time,
+                                       chat_id=message.chat.id)
+                except IntegrityError:  # Слот занят в обход брони (например, другим процессом)
+                    slot_index.invalidate(due_date)
+                    await send_calendar(message, session, "К сожалению, это время уже занято. Пожалуйста, "
+                                                          "выберите другую дату:")
+                    await state.set_state(AddUser.date)
+                    return
+                await outbound.send(message.answer(f"Ваша заявка принята на {due_date.strftime('%d-%m-%Y')} в {selected_time}."))
+
+            elif operation_type == 'update':
+                app_logger.info("Попытка обновления записи.")
+                try:
+                    await orm_update_user_appointment(phone, selected_date_str, selected_time,
+                                                      appointment_id=user_data.get('appointment_id'))
+                    await outbound.send(message.answer(f"Ваша запись была изменена на {selected_date_str} в {selected_time}."))
+                except IntegrityError:
+                    slot_index.invalidate(selected_date_str)
+                    await outbound.send(message.answer("К сожалению, это время уже занято. Запись не изменена."))
+                except Exception as e:
+                    app_logger.error(f"Ошибка при обновлении записи: {e}")
+                    await outbound.send(message.answer("Произошла ошибка при изменении вашей записи."))
+        finally:
+            slot_holds.release(message.chat.id)  # Слот записан в базу (или запись не удалась) - бронь не нужна
 
         await state.clear()  # Лучше оставить это после того, как операция завершена
         await send_start_menu(message, session)
 
     elif message.text.lower() == 'нет':
+        slot_holds.release(message.chat.id)
         await state.clear()
-        await message.answer("Операция отменена. Вы можете ввести данные заново.")
+        await outbound.send(message.answer("Операция отменена. Вы можете ввести данные заново."))
         await send_start_menu(message, session)
 
     else:
-        await message.answer("Пожалуйста, ответьте 'да' или 'нет'.")
+        await outbound.send(message.answer("Пожалуйста, ответьте 'да' или 'нет'."))
         ####### ###########
 
 
 async def send_start_menu(message: types.Message, session: AsyncSession):
     media, reply_markup = await get_menu_content(session, menu_name="main")
-    await message.answer_photo(media.media, caption=media.caption, reply_markup=reply_markup)
+    await outbound.send(message.answer_photo(media.media, caption=media.caption, reply_markup=reply_markup), priority=MENU)
 
     #########################Получение заявок##########################
 
@@ -428,7 +509,7 @@ class ViewApp(StatesGroup):
     delete_appointment = State()  # Состояние для удаления заявки
 
 
-@handler_user_router.callback_query(F.data == 'view_app')
+@handler_user_router.callback_query(F.data == 'view_app', flags={'db': False})
 async def add_view(callback: types.CallbackQuery, state: FSMContext):
     """
        Начинает процесс получения списка заявок пользователя.
@@ -436,8 +517,8 @@ async def add_view(callback: types.CallbackQuery, state: FSMContext):
        :param callback: Объект callback от пользователя.
        :param state: Состояние машины состояний FSM.
        """
-    await callback.answer()  # Убираем индикатор загрузки
-    await callback.message.answer("Пожалуйста, введите ваш номер телефона:", reply_markup=types.ReplyKeyboardRemove())
+    await outbound.send(callback.answer())  # Убираем индикатор загрузки
+    await outbound.send(callback.message.answer("Пожалуйста, введите ваш номер телефона:", reply_markup=types.ReplyKeyboardRemove()))
     await state.set_state(ViewApp.phone)  # Устанавливаем состояние для ввода телефона
 
 
@@ -456,7 +537,7 @@ async def process_view_app_phone(message: types.Message, state: FSMContext, sess
 
     # Проверяем корректность номера телефона
     if formatted_phone == "Неверный номер телефона.":
-        await message.answer(formatted_phone)
+        await outbound.send(message.answer(formatted_phone))
         return
 
     appointments = await orm_get_appointments_by_phone(session, formatted_phone)
@@ -470,14 +551,16 @@ async def process_view_app_phone(message: types.Message, state: FSMContext, sess
         appointments_text = "\n".join(
             f"{i + 1}. Запись на {appt.date.strftime('%d-%m-%Y')} в {appt.time}." for i, appt in
             enumerate(appointments))
-        await message.answer(
+        await outbound.send(message.answer(
             f"Ваши заявки:\n{appointments_text}\n\nВыберите действие:"
             f"\n1. Изменить заявку\n2. Удалить заявку\n3. Оставить как есть",
-            reply_markup=types.ReplyKeyboardRemove())
-        await state.update_data(appointments=appointments)
+            reply_markup=types.ReplyKeyboardRemove()))
+        # В состоянии храним только ID и дату/время заявок, а не объекты ORM
+        await state.update_data(appointments=[
+            {'id': appt.id, 'date': appt.date.strftime('%d-%m-%Y'), 'time': appt.time} for appt in appointments])
         await state.set_state(ViewApp.action)
     else:
-        await message.answer("У вас нет активных заявок.")
+        await outbound.send(message.answer("У вас нет активных заявок."))
 
         await state.clear()
         await send_start_menu(message, session)
@@ -497,7 +580,7 @@ async def process_action(message: types.Message, state: FSMContext, session: Asy
     appointments = user_data.get('appointments', [])
 
     if not appointments:
-        await message.answer("У вас нет активных заявок")
+        await outbound.send(message.answer("У вас нет активных заявок"))
         await state.clear()
         await send_start_menu(message, session)
         return
@@ -505,11 +588,11 @@ async def process_action(message: types.Message, state: FSMContext, session: Asy
     action = message.text.strip()
     if action == "1":  # Изменить время
         await state.update_data(operation_type='update')
-        await message.answer("Пожалуйста, введите номер заявки, которую хотите изменить:")
+        await outbound.send(message.answer("Пожалуйста, введите номер заявки, которую хотите изменить:"))
         await state.set_state(ViewApp.change_data)
 
     elif action == "2":  # Удалить заявку
-        await message.answer("Пожалуйста, введите номер заявки, которую хотите удалить:")
+        await outbound.send(message.answer("Пожалуйста, введите номер заявки, которую хотите удалить:"))
         await state.set_state(ViewApp.delete_appointment)
 
     elif action == "3":  # Оставить
@@ -517,9 +600,9 @@ async def process_action(message: types.Message, state: FSMContext, session: Asy
         await send_start_menu(message, session)
 
     else:
-        await message.answer(
+        await outbound.send(message.answer(
             "Некорректный ввод. Пожалуйста, выберите 1 для изменения даты и времени, "
-            "2 для удаления заявки или 3, если заявку не надо менять.")
+            "2 для удаления заявки или 3, если заявку не надо менять."))
 
 
 ###########бработчик для выбора новой даты
@@ -536,19 +619,20 @@ async def process_change_date(message: types.Message, state: FSMContext, session
     appointments = user_data.get('appointments', [])
 
     if not appointments:
-        await message.answer("У вас нет активных заявок.")
+        await outbound.send(message.answer("У вас нет активных заявок."))
         await state.clear()
         await send_start_menu(message, session)
         return
 
     selected_index = int(message.text.strip()) - 1  # Получаем индекс выбранной заявки
     if selected_index < 0 or selected_index >= len(appointments):
-        await message.answer("Некорректный номер заявки.")
+        await outbound.send(message.answer("Некорректный номер заявки."))
         return
 
     appointment = appointments[selected_index]
-    await state.update_data(appointment_id=appointment.id)  # Сохраняем ID заявки
-    await message.answer("Пожалуйста, введите новую дату в формате 'ДД-ММ-ГГГГ':")
+    await state.update_data(appointment_id=appointment['id'])  # Сохраняем ID заявки
+    await send_calendar(message, session, "Пожалуйста, выберите новую дату в календаре или введите ее в формате "
+                                          "'ДД-ММ-ГГГГ':")
     await state.set_state(AddUser.date)  # Переходим к состоянию выбора новой даты
 
 
@@ -566,7 +650,7 @@ async def process_change_time(message: types.Message, state: FSMContext, session
     appointments = user_data.get('appointments', [])
 
     if not appointments:
-        await message.answer("У вас нет активных заявок.")
+        await outbound.send(message.answer("У вас нет активных заявок."))
         await state.clear()
         await send_start_menu(message, session)
         return
@@ -574,22 +658,23 @@ async def process_change_time(message: types.Message, state: FSMContext, session
     try:
         selected_index = int(message.text.strip()) - 1  # Получаем индекс выбранной заявки
         if selected_index < 0 or selected_index >= len(appointments):
-            await message.answer("Некорректный номер заявки.")
+            await outbound.send(message.answer("Некорректный номер заявки."))
             return
 
         appointment = appointments[selected_index]
-        await state.update_data(appointment_id=appointment.id)  # Сохраняем ID заявки
-        await message.answer("Выберите новое время для вашей заявки:")
-        free_slots = await get_free_slots(session, appointment.date.strftime('%d-%m-%Y'))
+        await state.update_data(appointment_id=appointment['id'])  # Сохраняем ID заявки
+        await outbound.send(message.answer("Выберите новое время для вашей заявки:"))
+        free_slots = await get_free_slots(session, appointment['date'], holder=message.chat.id)
 
         if free_slots:
             slots_text = "\n".join(f"{i + 1}. {slot}" for i, slot in enumerate(free_slots))
-            await message.answer(f"Доступные слоты:\n{slots_text}")
+            await outbound.send(message.answer(f"Доступные слоты:\n{slots_text}"))
+            await state.update_data(selected_date=appointment['date'], offered_slots=free_slots)
             await state.set_state(AddUser.time)  # Переход к состоянию выбора нового времени
         else:
-            await message.answer("К сожалению, в данный момент нет доступного времени для изменения заявки.")
+            await outbound.send(message.answer("К сожалению, в данный момент нет доступного времени для изменения заявки."))
     except ValueError:
-        await message.answer("Пожалуйста, введите корректный номер заявки.")
+        await outbound.send(message.answer("Пожалуйста, введите корректный номер заявки."))
 
 
 ########
@@ -607,7 +692,7 @@ async def process_delete_appointment(message: types.Message, state: FSMContext,
     appointments = user_data.get('appointments', [])
 
     if not appointments:
-        await message.answer("У вас нет активных заявок.")
+        await outbound.send(message.answer("У вас нет активных заявок."))
         await state.clear()
         await send_start_menu(message, session)
         return
@@ -615,18 +700,17 @@ async def process_delete_appointment(message: types.Message, state: FSMContext,
     try:
         selected_index = int(message.text.strip()) - 1  # Получаем индекс выбранной заявки
         if selected_index < 0 or selected_index >= len(appointments):
-            await message.answer("Некорректный номер заявки.")
+            await outbound.send(message.answer("Некорректный номер заявки."))
             return
 
         appointment = appointments[selected_index]
-        await session.delete(appointment)  # Удаляем заявку из базы данных
-        await session.commit()  # Сохраняем изменения
+        await orm_delete_appointment(appointment['id'])  # Удаляем заявку и освобождаем слот
 
-        await message.answer("Ваша заявка была удалена.")
+        await outbound.send(message.answer("Ваша заявка была удалена."))
         await state.clear()
         await send_start_menu(message, session)
     except ValueError:
-        await message.answer("Пожалуйста, введите корректный номер заявки.")
+        await outbound.send(message.answer("Пожалуйста, введите корректный номер заявки."))
 
 
 #################################################
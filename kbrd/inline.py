@@ -1,9 +1,15 @@
+import calendar
+import os
+from datetime import date
+from functools import lru_cache
 from typing import Optional, Dict
 
 from aiogram.filters.callback_data import CallbackData
 from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+from kbrd.registry import keyboards
+
 
 ### Настраиваем инлай-клавиатуру" #############
 class MenuCallBack(CallbackData, prefix='menu'):
@@ -23,7 +29,9 @@ def get_user_main_btns(
 
         sizes: tuple[int] = (2, 1)):
     """
-       Создает и возвращает клавиатуру с основными кнопками для пользователя.
+       Возвращает клавиатуру с основными кнопками для пользователя.
+
+       Клавиатура берется из реестра (kbrd.registry): собирается один раз на набор кнопок и раскладку.
 
        :param btns: Словарь кнопок, где ключ - текст кнопки, а значение - данные обратного вызова.
                     Если не передан, используется набор стандартных кнопок.
@@ -38,9 +46,101 @@ def get_user_main_btns(
 
         }
 
+    return keyboards.inline(tuple((text, MenuCallBack(menu_name=menu_name)) for text, menu_name in btns.items()),
+                            tuple(sizes))
+
+
+USER_MAIN_KB = get_user_main_btns()  # Главное меню - одна готовая клавиатура для всех баннеров
+
+
+### Календарь для выбора даты записи #############
+class CalendarCallBack(CallbackData, prefix='cal'):
+    """
+       Класс для представления данных обратного вызова календаря.
+
+       :param action: Действие: 'day' - выбор даты, 'nav' - переход к месяцу, 'ignore' - неактивная кнопка.
+       :param year: Год.
+       :param month: Месяц (1-12).
+       :param day: День месяца (для действия 'day').
+       """
+    action: str
+    year: int
+    month: int
+    day: int = 0
+
+
+MONTH_NAMES = ('Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь', 'Июль', 'Август', 'Сентябрь', 'Октябрь',
+               'Ноябрь', 'Декабрь')
+WEEKDAY_NAMES = ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс')
+CALENDAR_MONTHS_AHEAD = int(os.getenv('CALENDAR_MONTHS_AHEAD', 12))  # На сколько месяцев вперед можно листать календарь
+
+
+def shift_month(year: int, month: int, delta: int) -> tuple[int, int]:
+    """
+       Сдвигает месяц на delta месяцев.
+
+       :return: Кортеж (год, месяц).
+       """
+    index = year * 12 + month - 1 + delta
+    return index // 12, index % 12 + 1
+
+
+def calendar_month_allowed(year: int, month: int, today: date) -> bool:
+    """
+       Проверяет, что месяц существует и входит в окно календаря: от текущего месяца
+       на CALENDAR_MONTHS_AHEAD месяцев вперед.
+
+       :return: True, если месяц можно показать или выбрать в нем дату.
+       """
+    return 1 <= month <= 12 and (today.year, today.month) <= (year, month) <= shift_month(
+        today.year, today.month, CALENDAR_MONTHS_AHEAD)
+
+
+def get_calendar_btns(year: int, month: int, *, full_days: set[date], today: date):
+    """
+       Создает клавиатуру-календарь на месяц.
+
+       Прошедшие даты показываются пустыми кнопками, полностью занятые - знаком ✖,
+       на остальные даты можно нажать.
+
+       :param year: Год.
+       :param month: Месяц (1-12).
+       :param full_days: Даты, на которые заняты все слоты.
+       :param today: Сегодняшняя дата.
+       :return: Объект клавиатуры с календарем.
+       """
+    return _build_calendar(year, month, frozenset(full_days), today)
+
+
+@lru_cache(maxsize=64)
+def _build_calendar(year: int, month: int, full_days: frozenset, today: date):
+    """Строит клавиатуру-календарь. Одинаковые месяцы отдаются из кэша: сборка ~50 кнопок заметна по CPU."""
+    ignore = keyboards.pack(CalendarCallBack(action='ignore', year=year, month=month))
     keyboard = InlineKeyboardBuilder()
+    keyboard.row(InlineKeyboardButton(text=f'{MONTH_NAMES[month - 1]} {year}', callback_data=ignore))
+    keyboard.row(*(InlineKeyboardButton(text=name, callback_data=ignore) for name in WEEKDAY_NAMES))
+
+    for week in calendar.monthcalendar(year, month):
+        buttons = []
+        for day in week:
+            if day == 0 or date(year, month, day) < today:
+                buttons.append(InlineKeyboardButton(text=' ', callback_data=ignore))
+            elif date(year, month, day) in full_days:
+                buttons.append(InlineKeyboardButton(text='✖', callback_data=ignore))
+            else:
+                buttons.append(InlineKeyboardButton(
+                    text=str(day), callback_data=keyboards.pack(CalendarCallBack(action='day', year=year,
+                                                                                 month=month, day=day))))
+        keyboard.row(*buttons)
 
-    for text, menu_name in btns.items():
-        keyboard.add(InlineKeyboardButton(text=text, callback_data=MenuCallBack(menu_name=menu_name).pack()))
+    navigation = []
+    for text, delta in (('◀', -1), ('▶', 1)):
+        target = shift_month(year, month, delta)
+        if calendar_month_allowed(*target, today):
+            callback_data = keyboards.pack(CalendarCallBack(action='nav', year=target[0], month=target[1]))
+        else:
+            text, callback_data = ' ', ignore
+        navigation.append(InlineKeyboardButton(text=text, callback_data=callback_data))
+    keyboard.row(*navigation)
 
-    return keyboard.adjust(*sizes).as_markup()
+    return keyboard.as_markup()
@@ -0,0 +1,127 @@
+# Реестр клавиатур: готовые разметки и упакованные callback_data строятся один раз
+from typing import Any, Dict, Literal, Type, Union
+
+from aiogram.filters import Filter
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import (CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton,
+                           ReplyKeyboardMarkup)
+from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
+
+
+class KeyboardRegistry:
+    """
+    Кэш клавиатур и обратный словарь callback_data.
+
+    Разметка клавиатуры собирается при первом запросе (обычно при импорте модуля клавиатур) и дальше
+    отдается по ключу - набору кнопок и раскладке - без InlineKeyboardBuilder и упаковки CallbackData.
+    Разметки общие для всех чатов, изменять их нельзя.
+
+    Каждая упакованная через реестр строка callback_data запоминается вместе с объектом CallbackData,
+    поэтому фильтр registry.filter(MenuCallBack) находит данные нажатой кнопки одним поиском в словаре
+    вместо разбора строки (CallbackData.unpack). Строки, которых нет в реестре (например, кнопки
+    сообщений, отправленных до перезапуска с другим набором кнопок), разбираются как обычно.
+    """
+
+    def __init__(self) -> None:
+        self._markups: dict[tuple, Union[InlineKeyboardMarkup, ReplyKeyboardMarkup]] = {}
+        self._callbacks: dict[str, CallbackData] = {}  # Упакованная строка -> объект CallbackData
+
+    def pack(self, callback_data: CallbackData) -> str:
+        """
+        Упаковывает данные кнопки и запоминает их для обратного поиска.
+
+        :param callback_data: Объект CallbackData.
+        :return: Строка callback_data.
+        """
+        packed = callback_data.pack()
+        self._callbacks.setdefault(packed, callback_data)
+        return packed
+
+    def lookup(self, data: str) -> CallbackData | None:
+        """
+        Возвращает объект CallbackData по строке callback_data, если она упакована через реестр.
+        """
+        return self._callbacks.get(data)
+
+    def inline(self, btns: tuple[tuple[str, CallbackData], ...],
+               sizes: tuple[int, ...] = (2,)) -> InlineKeyboardMarkup:
+        """
+        Возвращает инлайн-клавиатуру.
+
+        :param btns: Кнопки: пары (текст, данные обратного вызова).
+        :param sizes: Число кнопок в строках.
+        :return: Общая (неизменяемая) разметка клавиатуры.
+        """
+        packed = tuple((text, self.pack(callback_data)) for text, callback_data in btns)
+        key = ('inline', packed, sizes)
+        markup = self._markups.get(key)
+        if markup is None:
+            keyboard = InlineKeyboardBuilder()
+            for text, callback_data in packed:
+                keyboard.add(InlineKeyboardButton(text=text, callback_data=callback_data))
+            markup = self._markups[key] = keyboard.adjust(*sizes).as_markup()
+        return markup
+
+    def reply(self, btns: tuple[str, ...], placeholder: str | None = None, request_contact: int | None = None,
+              request_location: int | None = None, sizes: tuple[int, ...] = (2,)) -> ReplyKeyboardMarkup:
+        """
+        Возвращает обычную клавиатуру (см. kbrd.reply.get_keyboard).
+
+        :return: Общая (неизменяемая) разметка клавиатуры.
+        """
+        key = ('reply', btns, placeholder, request_contact, request_location, sizes)
+        markup = self._markups.get(key)
+        if markup is None:
+            keyboard = ReplyKeyboardBuilder()
+            for index, text in enumerate(btns):  # Индекс каждой кнопки
+                if request_contact and request_contact == index:
+                    keyboard.add(KeyboardButton(text=text, request_contact=True))
+                elif request_location and request_location == index:
+                    keyboard.add(KeyboardButton(text=text, request_location=True))
+                else:
+                    keyboard.add(KeyboardButton(text=text))
+            markup = self._markups[key] = keyboard.adjust(*sizes).as_markup(
+                resize_keyboard=True, input_field_placeholder=placeholder)
+        return markup
+
+    def filter(self, callback_data: Type[CallbackData]) -> 'RegistryCallbackFilter':
+        """
+        Возвращает фильтр колбэков, аналогичный callback_data.filter(), с поиском по реестру.
+        """
+        return RegistryCallbackFilter(self, callback_data)
+
+    def stats(self) -> dict:
+        """
+        :return: Словарь: число клавиатур и упакованных строк callback_data в реестре.
+        """
+        return {'markups': len(self._markups), 'callbacks': len(self._callbacks)}
+
+
+class RegistryCallbackFilter(Filter):
+    """
+    Фильтр колбэков по классу CallbackData: сначала поиск строки в реестре, затем обычный разбор.
+
+    Как и CallbackData.filter(), передает в обработчик аргумент callback_data.
+    """
+
+    __slots__ = ('registry', 'callback_data', 'prefix')
+
+    def __init__(self, registry: KeyboardRegistry, callback_data: Type[CallbackData]) -> None:
+        self.registry = registry
+        self.callback_data = callback_data
+        self.prefix = callback_data.__prefix__ + callback_data.__separator__
+
+    async def __call__(self, query: CallbackQuery) -> Union[Literal[False], Dict[str, Any]]:
+        data = query.data
+        if not data or not data.startswith(self.prefix):
+            return False
+        unpacked = self.registry.lookup(data)
+        if unpacked is None:
+            try:
+                unpacked = self.callback_data.unpack(data)
+            except (TypeError, ValueError):
+                return False
+        return {'callback_data': unpacked}
+
+
+keyboards = KeyboardRegistry()
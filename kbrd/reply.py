@@ -1,5 +1,4 @@
-from aiogram.types import KeyboardButton
-from aiogram.utils.keyboard import ReplyKeyboardBuilder
+from kbrd.registry import keyboards
 
 
 def get_keyboard(  #Создаем одну функцию, которая будет генерировать кнопки в хендлере
@@ -9,18 +8,6 @@ def get_keyboard(  #Создаем одну функцию, которая бу
         request_location: int = None,
         sizes: tuple = (2,),
 ):
-
-    keyboard = ReplyKeyboardBuilder()
-
-    for index, text in enumerate(btns, start=0):  #Индекс каждой кнопки
-
-        if request_contact and request_contact == index:
-            keyboard.add(KeyboardButton(text=text, request_contact=True))
-
-        elif request_location and request_location == index:
-            keyboard.add(KeyboardButton(text=text, request_location=True))
-        else:
-            keyboard.add(KeyboardButton(text=text))
-
-    return keyboard.adjust(*sizes).as_markup(
-        resize_keyboard=True, input_field_placeholder=placeholder)
\ No newline at end of file
+    # Клавиатура собирается один раз на набор кнопок и раскладку, дальше берется из реестра (kbrd.registry)
+    return keyboards.reply(btns, placeholder=placeholder, request_contact=request_contact,
+                           request_location=request_location, sizes=tuple(sizes))
@@ -1,28 +1,150 @@
+import atexit
 import logging
 import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Все логгеры пишут записи в одну очередь, а в файлы и консоль их выводит фоновый поток QueueListener.
+# Так обработчики бота не ждут записи на диск.
+#
+# Настройки из окружения:
+#   LOG_LEVEL - уровень по умолчанию (INFO);
+#   LOG_LEVELS - уровни по компонентам, например "handler_user=DEBUG,orm_query=WARNING,sqlalchemy.engine=INFO";
+#   LOG_DEBUG_SAMPLE - доля DEBUG-записей, которые попадут в лог: "10" (каждая 10-я) или по компонентам
+#                      "orm_query=100,*=10";
+#   LOG_MAX_BYTES, LOG_BACKUP_COUNT - размер файла лога до ротации и число хранимых архивов;
+#   LOG_FILE_SUFFIX - суффикс имен файлов логов процесса: "worker1" дает logs/main.worker1.log
+#                     (процессы cluster.py не делят файлы, иначе ротация одного ломала бы запись других).
+
+_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+_DEFAULT_LEVELS = {'sqlalchemy': 'WARNING'}  # SQL-запросы логируются только по явной настройке
+
+_queue: queue.SimpleQueue = queue.SimpleQueue()
+_listener: QueueListener | None = None
+_router: '_RoutingHandler | None' = None
+
+
+def _parse_spec(value: str | None) -> dict:
+    """Разбирает строку вида "name=value,name2=value2" (значение без имени относится к '*')."""
+    spec = {}
+    for item in (value or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, setting = item.rpartition('=')
+        spec[name.strip() or '*'] = setting.strip()
+    return spec
+
+
+def _lookup(spec: dict, name: str):
+    """Ищет настройку для логгера и его родителей: 'a.b.c' -> 'a.b' -> 'a' -> '*'."""
+    while name:
+        if name in spec:
+            return spec[name]
+        name = name.rpartition('.')[0]
+    return spec.get('*')
+
+
+class _RoutingHandler(logging.Handler):
+    """
+    Обработчик на стороне фонового потока: пишет запись в консоль и в файл ее логгера.
+    Файлы с одинаковым путем разделяются между логгерами.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.formatter = logging.Formatter(_FORMAT)
+        self.console = logging.StreamHandler()
+        self.console.setFormatter(self.formatter)
+        self.files: dict[str, RotatingFileHandler] = {}
+        self.routes: dict[str, RotatingFileHandler] = {}
+
+    def add_route(self, name: str, log_file: str) -> None:
+        file_handler = self.files.get(log_file)
+        if file_handler is None:
+            file_handler = RotatingFileHandler(log_file, maxBytes=int(os.getenv('LOG_MAX_BYTES', 5 * 1024 * 1024)),
+                                               backupCount=int(os.getenv('LOG_BACKUP_COUNT', 5)), encoding='utf-8',
+                                               delay=True)
+            file_handler.setFormatter(self.formatter)
+            self.files[log_file] = file_handler
+        self.routes[name] = file_handler
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.console.handle(record)
+        file_handler = _lookup(self.routes, record.name)  # Дочерние логгеры пишут в файл родителя
+        if file_handler is not None:
+            file_handler.handle(record)
+
+    def close(self) -> None:
+        for file_handler in self.files.values():
+            file_handler.close()
+        super().close()
+
+
+class _DebugSampler(logging.Filter):
+    """Пропускает только каждую N-ю DEBUG-запись логгера. Остальные уровни проходят всегда."""
+
+    def __init__(self, every: int) -> None:
+        super().__init__()
+        self.every = every
+        self.counter = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        self.counter += 1
+        return self.counter % self.every == 0
+
+
+def _start_listener() -> _RoutingHandler:
+    global _listener, _router
+    if _router is None:
+        _router = _RoutingHandler()
+        _listener = QueueListener(_queue, _router, respect_handler_level=False)
+        _listener.start()
+        atexit.register(shutdown_logging)
+    return _router
+
+
+def shutdown_logging() -> None:
+    """
+    Останавливает фоновый поток логирования, дописав все записи из очереди.
+    """
+    global _listener, _router
+    if _listener is not None:
+        _listener.stop()
+        _router.close()
+        _listener = None
+        _router = None
 
 
 def setup_logging(name: str, log_file: str):
+    suffix = os.getenv('LOG_FILE_SUFFIX')
+    if suffix:
+        root, ext = os.path.splitext(log_file)
+        log_file = f'{root}.{suffix}{ext}'
+
     # Создаем директорию для логов, если ее нет
     os.makedirs(os.path.dirname(log_file), exist_ok=True)
 
     # Создаем логгер
     logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)  # Уровень логирования
-
-    # Создаем форматters
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-    # Создаем обработчик для записи логов в файл
-    file_handler = logging.FileHandler(log_file)
-    file_handler.setFormatter(formatter)
+    router = _start_listener()
+    router.add_route(name, log_file)
+    if any(isinstance(handler, QueueHandler) for handler in logger.handlers):
+        return logger  # Логгер уже настроен, повторный вызов не добавляет обработчики
 
-    # Создаем обработчик для вывода логов в консоль
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
+    # Уровень логирования компонента
+    level = _lookup(_parse_spec(os.getenv('LOG_LEVELS')), name) or _lookup(_DEFAULT_LEVELS, name) \
+        or os.getenv('LOG_LEVEL', 'INFO')
+    logger.setLevel(level.upper())
+    logger.propagate = False
 
-    # Добавляем обработчики к логгеру
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    # Обработчик только кладет запись в очередь, форматирование и запись - в фоновом потоке
+    queue_handler = QueueHandler(_queue)
+    sample = _lookup(_parse_spec(os.getenv('LOG_DEBUG_SAMPLE')), name)
+    if sample and int(sample) > 1:
+        queue_handler.addFilter(_DebugSampler(int(sample)))
+    logger.addHandler(queue_handler)
 
     return logger
@@ -1,43 +1,209 @@
+import time
+
+_started = time.perf_counter()  # Отсчет времени запуска: импорт модулей тоже входит в отчет
+
 import os
 import asyncio
-from aiogram import Bot, Dispatcher, types
-from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
 
 from dotenv import load_dotenv, find_dotenv
 
-from handlers.handler_admin import handler_admin_router
-from handlers.handler_user import handler_user_router
-from logging_config import setup_logging
-
-# Загружаем переменные окружения
+# Переменные окружения загружаются до импорта модулей бота: при импорте они настраивают логгеры
+# (LOG_LEVEL, LOG_LEVELS) и движок базы данных (DB_LITE)
 load_dotenv(find_dotenv())
 
-from db.engine import create_db, session_maker
+from aiogram import Bot, Dispatcher, types
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
+from aiogram.types import FSInputFile
+
+from common.metrics import install_engine_hooks, metrics, serve_metrics
+from common.outbound import BULK, REMINDER, outbound
+from common.startup import StartupTimer
+from common.text_for import images_for_info_pages
+from db.archive import archiver
+from db.banner_cache import banner_cache
+from db.broadcast import broadcaster
+from db.engine import create_db, engine, engine_profile, session_maker
+from db.engine_profile import report_settings, run_periodic_optimize
+from db.fsm_storage import SQLiteStorage
+from db.media import media_registry
+from db.orm_query import orm_fill_banner_images
+from db.reminders import reminders
+from db.slot_hold import slot_holds
+from db.slot_index import slot_index
+from db.write_queue import write_queue
+from logging_config import setup_logging
+from kbrd.registry import keyboards
 from middlewares.db import DataBaseSession
+from middlewares.metrics import MetricsMiddleware
+from middlewares.throttling import ThrottlingMiddleware
 
 # Настройка логгирования
 app_logger = setup_logging("main", "logs/main.log")
 
 bot = Bot(token=os.getenv('TOKEN'), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-bot.a_admins_list = []  # Вносим id администратора/ов,
+# Вносим id администратора/ов (переменная ADMINS, через запятую)
+bot.a_admins_list = [int(admin_id) for admin_id in os.getenv('ADMINS', '').split(',') if admin_id.strip()]
 
-dp = Dispatcher()
+# Состояния FSM хранятся в базе данных и переживают перезапуск бота
+dp = Dispatcher(storage=SQLiteStorage(session_maker, ttl=float(os.getenv('FSM_TTL', 3600))))
 
-dp.include_router(handler_user_router)
-dp.include_router(handler_admin_router)
+startup = StartupTimer(_started)
+startup.phases['imports'] = startup.elapsed()
+metrics_server = None  # HTTP-сервер метрик (если задан METRICS_PORT)
+background_tasks: list[asyncio.Task] = []  # Периодические задачи, отменяются в on_shutdown
 
 
 async def on_startup(bot):
     app_logger.info("Starting the bot...")
     # await drop_db() # Убираем старые таблицы, надо заккоментировать
-    await create_db()
+    with startup.phase('schema'):
+        await create_db()  # Схема не менялась - один запрос вместо create_all и проверки баннеров
+    # Независимые прогревы - одновременно: соединение с базой и PRAGMA, кэш баннеров (меню работает
+    # без запросов к БД), getMe (результат кэшируется в bot, start_polling его не повторяет),
+    # file_id изображений из папки image (загружаются только новые файлы)
+    await startup.gather(db=report_settings(engine, engine_profile), banners=warm_banners(), get_me=bot.me(),
+                         media=sync_media())
+    with startup.phase('services'):
+        background_tasks.append(asyncio.create_task(run_periodic_optimize(engine, engine_profile)))
+        # Периодическая сверка индекса свободных слотов с базой данных
+        background_tasks.append(asyncio.create_task(
+            slot_index.run_periodic_check(session_maker, float(os.getenv('SLOT_INDEX_CHECK_INTERVAL', 600)))))
+        slot_holds.ttl = float(os.getenv('SLOT_HOLD_TTL', 300))  # Сколько секунд слот держится за пользователем
+        background_tasks.append(asyncio.create_task(slot_holds.run_periodic_sweep()))
+        # Исходящие сообщения - через очередь с лимитами Telegram, обработчики не ждут отправки
+        outbound.rate = float(os.getenv('OUTBOUND_RATE', 30))
+        outbound.chat_rate = float(os.getenv('OUTBOUND_CHAT_RATE', 1))
+        outbound.chat_burst = int(os.getenv('OUTBOUND_CHAT_BURST', 3))
+        outbound.start()
+        # Напоминания о записи: в памяти только записи ближайших дней
+        reminders.window_days = int(os.getenv('REMINDER_WINDOW_DAYS', 1))
+        reminders.start(session_maker, send_reminder)
+        # Рассылки: незавершенные продолжаются с последней сохраненной страницы получателей
+        broadcaster.batch_size = int(os.getenv('BROADCAST_BATCH', 500))
+        broadcaster.workers = int(os.getenv('BROADCAST_WORKERS', 8))
+        await broadcaster.start(session_maker, send_broadcast, send_report)
+        # Архивация: записи старше ARCHIVE_AFTER_DAYS дней переносятся пакетами в user_archive (ARCHIVE=0 отключает)
+        if os.getenv('ARCHIVE', '1') != '0':
+            archiver.after_days = int(os.getenv('ARCHIVE_AFTER_DAYS', 30))
+            archiver.batch_size = int(os.getenv('ARCHIVE_BATCH', 1000))
+            archiver.interval = float(os.getenv('ARCHIVE_INTERVAL', 6 * 3600))
+            archiver.start()
+        # Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics
+        if os.getenv('METRICS_PORT'):
+            global metrics_server
+            metrics_server = await serve_metrics(os.getenv('METRICS_HOST', '127.0.0.1'), int(os.getenv('METRICS_PORT')))
+    app_logger.info(startup.report())
+
+
+async def warm_banners() -> None:
+    async with session_maker() as session:
+        await banner_cache.warm(session)
+
+
+async def sync_media() -> None:
+    '''Загружает в Telegram новые изображения из папки image (в чат MEDIA_CHAT_ID, по умолчанию - первому
+    администратору) и ставит их баннерам без изображения (см. db.media).'''
+    chat_id = os.getenv('MEDIA_CHAT_ID') or next(iter(bot.a_admins_list), None)
+
+    async def upload(path: str) -> str:
+        message = await bot.send_photo(chat_id=chat_id, photo=FSInputFile(path), disable_notification=True)
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=message.message_id)  # file_id остается действительным
+        except Exception as e:
+            app_logger.warning(f'Не удалось удалить служебное фото: {e}')
+        return message.photo[-1].file_id
+
+    file_ids = await media_registry.sync(session_maker, upload if chat_id else None)
+    images = {page: file_ids[name] for page, name in images_for_info_pages.items() if name in file_ids}
+    if images:
+        replaced = {page: media_registry.replaced[name] for page, name in images_for_info_pages.items()
+                    if name in media_registry.replaced}
+        await orm_fill_banner_images(images, replaced)
+
+
+async def send_reminder(chat_id: int, text: str) -> None:
+    await outbound.send(bot.send_message(chat_id=chat_id, text=text), priority=REMINDER)
+
+
+async def send_broadcast(chat_id: int, text: str | None, photo: str | None) -> None:
+    if photo:
+        method = bot.send_photo(chat_id=chat_id, photo=photo, caption=text)
+    else:
+        method = bot.send_message(chat_id=chat_id, text=text)
+    await outbound.submit(method, priority=BULK)  # Ждем ответа Telegram, чтобы учесть ошибку
+
+
+async def send_report(chat_id: int, text: str) -> None:
+    await outbound.send(bot.send_message(chat_id=chat_id, text=text))
 
 
 async def on_shutdown(bot):
+    if metrics_server is not None:
+        await metrics_server.cleanup()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await broadcaster.close()  # Рассылка продолжится после перезапуска
+    await reminders.close()  # Неотправленные напоминания будут отправлены после запуска
+    await archiver.close()  # Ничего не делает, если архивация отключена (ARCHIVE=0)
+    await outbound.close()  # Отправляем то, что еще стоит в очереди
+    await write_queue.close()  # Дописываем изменения, которые еще стоят в очереди
+    await dp.storage.close()  # Записываем состояния FSM, ожидающие пакетной записи
     app_logger.info('Бот остановлен')
 
 
+def include_routers(dp: Dispatcher) -> None:
+    '''Подключает роутеры обработчиков. Модули обработчиков импортируются здесь, а не при импорте main:
+    их загружают только процессы, которые обрабатывают или распределяют апдейты. Повторный вызов ничего не меняет.'''
+    from handlers.handler_admin import handler_admin_router
+    from handlers.handler_user import handler_user_router
+
+    if handler_user_router.parent_router is None:
+        dp.include_router(handler_user_router)
+        dp.include_router(handler_admin_router)
+
+
+def register_middlewares(dp: Dispatcher) -> None:
+    '''Регистрирует мидлвари диспетчера. Вызывается из main() и из нагрузочного теста (bench/load_test.py).'''
+    metrics_middleware = None
+    if os.getenv('METRICS', '1') != '0':
+        # Время обработки по обработчикам и состояниям FSM и запросы к БД на апдейт (METRICS=0 отключает).
+        # Внешний мидлвар регистрируется первым, чтобы учитывать и отсеянные ограничением частоты события.
+        metrics_middleware = MetricsMiddleware(metrics)
+        dp.message.outer_middleware(metrics_middleware)
+        dp.callback_query.outer_middleware(metrics_middleware)
+        install_engine_hooks(engine, metrics)
+    if os.getenv('THROTTLE', '1') != '0':
+        # Ограничение частоты событий от одного чата. Внешний мидлвар: лишние события отсекаются
+        # до фильтров, обработчиков и DataBaseSession.
+        throttling = ThrottlingMiddleware(
+            message_rate=float(os.getenv('THROTTLE_MESSAGE_RATE', 1)),
+            message_burst=int(os.getenv('THROTTLE_MESSAGE_BURST', 5)),
+            callback_rate=float(os.getenv('THROTTLE_CALLBACK_RATE', 2)),
+            callback_burst=int(os.getenv('THROTTLE_CALLBACK_BURST', 8)))
+        dp.message.outer_middleware(throttling)
+        dp.callback_query.outer_middleware(throttling)
+        dp['throttling'] = throttling
+    db_middleware = DataBaseSession(session_pool=session_maker)  # Добавление мидлвара DataBaseSession
+    # на сообщения и колбэки для обеспечения ленивых сессий с базой данных, используя session_pool и session_maker.
+    # Мидлвар внутренний, чтобы видеть флаги обработчиков (flags={'db': False}).
+    if metrics_middleware is not None:
+        dp.message.middleware(metrics_middleware.label)  # Имя обработчика для метрик
+        dp.callback_query.middleware(metrics_middleware.label)
+    dp.message.middleware(db_middleware)
+    dp.callback_query.middleware(db_middleware)
+    dp['db_middleware'] = db_middleware  # Счетчики доступны админ-панели
+    # Счетчики компонентов в выгрузке метрик (читаются только при запросе /metrics)
+    for name, stats in (('db', db_middleware.stats), ('banner_cache', banner_cache.stats), ('write_queue', write_queue.stats),
+                        ('outbound', outbound.stats), ('reminders', reminders.stats), ('keyboards', keyboards.stats),
+                        ('media', media_registry.stats), ('archive', archiver.stats)):
+        metrics.register_stats(name, stats)
+    if 'throttling' in dp.workflow_data:
+        metrics.register_stats('throttling', dp['throttling'].stats)
+
+
 async def main():
     '''Функция main() является основной точкой запуска для бота, использующего библиотеку aiogram.
     Она отвечает за настройку логирования, регистрацию обработчиков событий старта и остановки бота,
@@ -48,8 +214,13 @@ async def main():
 Регистрация обработчиков событий:
 Регистрация функции on_startup для обработки старта бота через dp.startup.register(on_startup).
 Регистрация функции on_shutdown для обработки остановки бота через dp.shutdown.register(on_shutdown).
-Мидлвар для работы с базой данных: Добавление мидлвара DataBaseSession в обработчик обновлений для обеспечения сессий с базой данных, используя session_pool и session_maker.
-Удаление вебхуков: Функция удаляет вебхук с помощью метода bot.delete_webhook(drop_pending_updates=True), что гарантирует, что бот больше не будет получать обновления через вебхук.
+Роутеры обработчиков: include_routers(dp) импортирует модули обработчиков и подключает их роутеры.
+Метрики: MetricsMiddleware (внешний мидлвар, регистрируется первым, отключается METRICS=0) замеряет время обработки по обработчикам и состояниям FSM, обработчики событий движка считают запросы к БД; выгрузка - GET /metrics на METRICS_PORT и команда /stats.
+Ограничение частоты: ThrottlingMiddleware (внешний мидлвар на сообщения и колбэки, отключается THROTTLE=0) отсекает лишние события от одного чата до мидлвара базы данных.
+Мидлвар для работы с базой данных: Добавление мидлвара DataBaseSession на сообщения и колбэки для обеспечения ленивых сессий с базой данных, используя session_pool и session_maker.
+Режим работы: Выбирается переменной окружения BOT_MODE ('polling' по умолчанию или 'webhook').
+Вебхук: В режиме 'webhook' запускается локальный aiohttp-сервер (см. webhook_server.run_webhook), апдейты обрабатываются в фоне с ограничением MAX_CONCURRENT_UPDATES.
+Удаление вебхуков: В режиме 'polling' функция удаляет вебхук с помощью метода bot.delete_webhook(). Накопившиеся апдейты сохраняются, если не задано DROP_PENDING_UPDATES=1.
 Запуск получения обновлений: Используется метод dp.start_polling(), который начинает опрос бота для получения новых обновлений. Параметр allowed_updates фильтрует типы обновлений, которые бот будет обрабатывать, автоматически подбирая используемые типы через dp.resolve_used_update_types().
 Обработка исключений: В случае возникновения ошибки в процессе выполнения основной логики, ошибка записывается в лог с уровнем error.'''
     try:
@@ -57,10 +228,15 @@ async def main():
         dp.startup.register(on_startup)
         dp.shutdown.register(on_shutdown)
 
-        dp.update.middleware(DataBaseSession(session_pool=session_maker)) #Добавление мидлвара DataBaseSession
-        # в обработчик обновлений для обеспечения сессий с базой данных, используя session_pool и session_maker.
+        include_routers(dp)
+        register_middlewares(dp)
+
+        if os.getenv('BOT_MODE', 'polling') == 'webhook':
+            from webhook_server import run_webhook  # aiohttp-сервер нужен только в режиме вебхука
+            await run_webhook(dp, bot)
+            return
 
-        await bot.delete_webhook(drop_pending_updates=True)
+        await bot.delete_webhook(drop_pending_updates=os.getenv('DROP_PENDING_UPDATES', '0') == '1')
         # await bot.delete_my_commands(scope=types.BotCommandScopeAllPrivateChats()) #Закомментировать (создан для удаления)
         await dp.start_polling(bot,
                                allowed_updates=dp.resolve_used_update_types())  # Подтягиваются автоматом все апдейты
@@ -1,7 +1,40 @@
 from typing import Any, Awaitable, Callable, Dict
 from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
 from aiogram.types import Message, TelegramObject
-from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+
+class LazySession:
+    """
+       Ленивая обертка над AsyncSession.
+
+       Сессия создается (и соединение берется из пула) только при первом обращении к любому
+       ее атрибуту, например `session.execute(...)`. Если обработчик не обращался к базе данных,
+       сессия так и не создается.
+
+       :param session_pool: Асинхронный пул сессий для работы с базой данных.
+       """
+    __slots__ = ('_session_pool', '_session')
+
+    def __init__(self, session_pool: async_sessionmaker) -> None:
+        self._session_pool = session_pool
+        self._session: AsyncSession | None = None
+
+    @property
+    def used(self) -> bool:
+        """Была ли создана настоящая сессия."""
+        return self._session is not None
+
+    def __getattr__(self, name: str) -> Any:
+        if self._session is None:
+            self._session = self._session_pool()
+        return getattr(self._session, name)
+
+    async def close(self) -> None:
+        """Закрывает сессию, если она была создана."""
+        if self._session is not None:
+            await self._session.close()
 
 
 class DataBaseSession(BaseMiddleware):
@@ -9,8 +42,12 @@ class DataBaseSession(BaseMiddleware):
        Middleware для управления сессиями базы данных.
 
        Этот класс обеспечивает доступ к асинхронной сессии базы данных из всех обработчиков.
-       Он открывает сессию перед вызовом обработчика и закрывает ее после выполнения,
-       тем самым гарантируя правильное управление ресурсами.
+       В обработчик передается ленивая сессия (LazySession), которая берет соединение из пула только
+       при первом запросе, и закрывается после выполнения обработчика. Обработчики, которым база
+       данных не нужна, помечаются флагом `flags={'db': False}` и не получают сессию вовсе.
+
+       Регистрируется как внутренний мидлвар на событиях message и callback_query, чтобы флаги
+       обработчика были доступны.
 
        :param session_pool: Асинхронный пул сессий для работы с базой данных.
        """
@@ -21,6 +58,8 @@ class DataBaseSession(BaseMiddleware):
                :param session_pool: Асинхронный пул сессий, используемый для взаимодействия с базой данных.
                """
         self.session_pool = session_pool
+        self.served = 0  # Всего обработанных событий
+        self.zero_db = 0  # Событий, обработанных без обращения к базе данных
 
     async def __call__(
             self,
@@ -29,11 +68,11 @@ class DataBaseSession(BaseMiddleware):
             data: Dict[str, Any]
     ) -> Any:
         """
-                Вызывает обработчик с открытой сессией базы данных.
+                Вызывает обработчик с ленивой сессией базы данных.
 
-                Эта функция открывает новую сессию и добавляет ее в параметр `data`,
-                который будет доступен в каждом обработчике. После выполнения обработчика
-                сессия автоматически закрывается.
+                Эта функция добавляет ленивую сессию в параметр `data`, который будет доступен
+                в каждом обработчике. После выполнения обработчика сессия закрывается, если она
+                была открыта.
 
                 :param handler: Обработчик, который будет вызван с параметрами события и данных.
                 :param event: Объект события, передаваемый в обработчик.
@@ -41,6 +80,25 @@ class DataBaseSession(BaseMiddleware):
 
                 :return: Возвращает результат выполнения обработчика.
                 """
-        async with self.session_pool() as session:
-            data['session'] = session  #По параметру сессия в каждом хендлере будет доступна сессия
+        self.served += 1
+        if get_flag(data, 'db', default=True) is False:  # Обработчик отказался от базы данных
+            self.zero_db += 1
+            return await handler(event, data)
+
+        session = LazySession(self.session_pool)
+        data['session'] = session  #По параметру сессия в каждом хендлере будет доступна сессия
+        try:
             return await handler(event, data)
+        finally:
+            if session.used:
+                await session.close()
+            else:
+                self.zero_db += 1
+
+    def stats(self) -> dict:
+        """
+                Возвращает счетчики обработанных событий.
+
+                :return: Словарь с общим числом событий и числом событий без обращения к базе данных.
+                """
+        return {'served': self.served, 'zero_db': self.zero_db}
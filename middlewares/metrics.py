@@ -0,0 +1,64 @@
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.types import TelegramObject
+
+from common.metrics import Metrics, UpdateRecord, current_update, metrics
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+       Middleware для замера времени обработки событий.
+
+       Внешний мидлвар (регистрируется первым): замеряет полное время события - ограничение частоты,
+       фильтры, внутренние мидлвари и обработчик - и записывает его в гистограмму по обработчику, роутеру
+       и состоянию FSM (AddUser:name, ViewApp:phone, ...). Имя обработчика известно только после фильтров,
+       его сообщает метод label, зарегистрированный внутренним мидлваром. Событие без подходящего
+       обработчика учитывается как 'unhandled', отсеянное ограничением частоты - как 'dropped'.
+
+       Запросы к базе данных, выполненные во время обработки (common.metrics.install_engine_hooks),
+       относятся к событию через contextvar current_update.
+
+       :param registry: Реестр метрик, по умолчанию общий metrics.
+       """
+
+    def __init__(self, registry: Metrics | None = None) -> None:
+        self.registry = registry or metrics
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        record = UpdateRecord()
+        token = current_update.set(record)
+        started = time.perf_counter()
+        result = UNHANDLED
+        try:
+            result = await handler(event, data)
+            return result
+        finally:
+            elapsed = time.perf_counter() - started
+            current_update.reset(token)
+            if record.handler is None:
+                record.handler = 'unhandled' if result is UNHANDLED else 'dropped'
+            self.registry.observe_update(record, data.get('raw_state') or 'none', elapsed)
+
+    async def label(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        """
+                Внутренний мидлвар: записывает в замеры события имя обработчика и его роутер (модуль).
+                """
+        record = current_update.get()
+        if record is not None:
+            callback = data['handler'].callback
+            record.handler = callback.__name__
+            record.router = callback.__module__.rpartition('.')[2]
+        return await handler(event, data)
@@ -0,0 +1,125 @@
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+THROTTLE_TEXT = "Слишком много запросов. Пожалуйста, подождите несколько секунд."
+
+
+class TokenBucket:
+    """
+       Ограничитель частоты запросов по алгоритму GCRA (вариант token bucket).
+
+       Для каждого чата хранится одно число - теоретическое время следующего запроса (TAT).
+       Запрос пропускается, если TAT опережает текущее время не больше чем на (burst - 1) интервалов.
+
+       Записи хранятся в двух поколениях: текущем и предыдущем. Раз в rotate_interval секунд
+       предыдущее поколение отбрасывается целиком, а текущее становится предыдущим. Интервал больше
+       времени восстановления полного запаса, поэтому отброшенные чаты уже простаивали с полным
+       запасом и ничего не теряют. Память занимают только чаты, писавшие за последние два интервала,
+       очистка не требует обхода записей.
+
+       :param rate: Сколько запросов в секунду восстанавливается.
+       :param burst: Сколько запросов подряд можно сделать с полным запасом.
+       """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.interval = 1 / rate
+        self.tolerance = self.interval * (burst - 1)
+        self.rotate_interval = max(60.0, 2 * (self.tolerance + self.interval))
+        self._current: dict[int, float] = {}
+        self._previous: dict[int, float] = {}
+        self._rotate_at = time.monotonic() + self.rotate_interval
+
+    def __len__(self) -> int:
+        return len(self._current) + len(self._previous)
+
+    def _rotate(self, now: float) -> None:
+        if now - self._rotate_at >= self.rotate_interval:  # Простой дольше двух интервалов - все записи устарели
+            self._previous = {}
+        else:
+            self._previous = self._current
+        self._current = {}
+        self._rotate_at = now + self.rotate_interval
+
+    def allow(self, key: int, now: float | None = None) -> bool:
+        """
+           Проверяет запрос чата и, если он разрешен, расходует одну единицу запаса.
+
+           :param key: ID чата.
+           :param now: Текущее время (time.monotonic()).
+           :return: True, если запрос разрешен.
+           """
+        now = time.monotonic() if now is None else now
+        if now >= self._rotate_at:
+            self._rotate(now)
+
+        tat = self._current.get(key)
+        if tat is None:
+            tat = self._previous.pop(key, now)
+        tat = max(tat, now)
+        if tat - now > self.tolerance:
+            self._current[key] = tat
+            return False
+        self._current[key] = tat + self.interval
+        return True
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+       Middleware для ограничения частоты сообщений и нажатий кнопок от одного чата.
+
+       Для сообщений и колбэков используются отдельные ограничители (TokenBucket). Лишние события
+       не доходят до фильтров, обработчиков и базы данных: на колбэк отвечается всплывающим текстом
+       (иначе кнопка "зависнет"), а на сообщения предупреждение отправляется один раз, пока чат
+       не вернется в пределы лимита.
+
+       Регистрируется как внешний мидлвар на событиях message и callback_query, до DataBaseSession.
+
+       :param message_rate: Сообщений в секунду.
+       :param message_burst: Сообщений подряд.
+       :param callback_rate: Нажатий кнопок в секунду.
+       :param callback_burst: Нажатий кнопок подряд.
+       """
+
+    def __init__(self, message_rate: float = 1.0, message_burst: int = 5,
+                 callback_rate: float = 2.0, callback_burst: int = 8) -> None:
+        self.messages = TokenBucket(message_rate, message_burst)
+        self.callbacks = TokenBucket(callback_rate, callback_burst)
+        self._warned: set[int] = set()  # Чаты, которым уже отправлено предупреждение
+        self.throttled = 0
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        chat = data.get('event_chat') or data.get('event_from_user')
+        if chat is None:
+            return await handler(event, data)
+
+        bucket = self.callbacks if isinstance(event, CallbackQuery) else self.messages
+        if bucket.allow(chat.id):
+            self._warned.discard(chat.id)
+            return await handler(event, data)
+
+        self.throttled += 1
+        if isinstance(event, CallbackQuery):
+            await event.answer(THROTTLE_TEXT)
+        elif isinstance(event, Message) and chat.id not in self._warned:
+            if len(self._warned) > 100_000:  # Не даем множеству расти без ограничений
+                self._warned.clear()
+            self._warned.add(chat.id)
+            await event.answer(THROTTLE_TEXT)
+        return None
+
+    def stats(self) -> dict:
+        """
+           Возвращает число отклоненных событий и число чатов в ограничителях.
+
+           :return: Словарь со счетчиками.
+           """
+        return {'throttled': self.throttled, 'message_chats': len(self.messages),
+                'callback_chats': len(self.callbacks)}
@@ -0,0 +1,49 @@
+# Архивация записей (db.archive): повторная архивация после того, как SQLite снова выдал освободившиеся id
+import asyncio
+import os
+import tempfile
+from datetime import date, datetime, timedelta
+
+os.environ['DB_LITE'] = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(prefix='test_archive_'), 'test.db')}"
+
+from sqlalchemy import func, insert, select  # noqa: E402
+
+from db.archive import archiver  # noqa: E402
+from db.engine import create_db, session_maker  # noqa: E402
+from db.models import User, UserArchive  # noqa: E402
+from db.orm_query import orm_get_appointment_history  # noqa: E402
+from db.write_queue import write_queue  # noqa: E402
+
+PHONE_KEY = 79001234567
+
+
+async def book(day: date, time: str) -> int:
+    async with session_maker() as session:
+        result = await session.execute(insert(User).values(
+            name='test', phone='+7(900)123-45-67', phone_key=PHONE_KEY, date=datetime(day.year, day.month, day.day),
+            day=day, time=time, chat_id=1))
+        await session.commit()
+        return result.inserted_primary_key[0]
+
+
+async def scenario() -> None:
+    await create_db()
+    past = date.today() - timedelta(days=60)
+    first = [await book(past, '10:00'), await book(past, '11:00')]
+    assert await archiver.archive(date.today()) == 2
+
+    reused = await book(past + timedelta(days=1), '10:00')
+    assert reused in first  # Таблица user пуста - SQLite снова выдает id 1
+    assert await archiver.archive(date.today()) == 1
+
+    async with session_maker() as session:
+        assert (await session.execute(select(func.count()).select_from(User))).scalar() == 0
+        sources = (await session.execute(select(UserArchive.source_id).order_by(UserArchive.id))).scalars().all()
+        assert sources == first + [reused]
+        history = await orm_get_appointment_history(session, '89001234567')
+        assert [row.id for row in history] == [reused] + first[::-1] and all(row.archived for row in history)
+    await write_queue.close()
+
+
+def test_archive_after_id_reuse():
+    asyncio.run(scenario())
@@ -0,0 +1,50 @@
+# Получатели рассылки (db.broadcast): keyset-обход обеих таблиц, включая отрицательные chat_id групп
+import asyncio
+import os
+import tempfile
+from datetime import date, datetime
+
+os.environ.setdefault('DB_LITE', f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(prefix='test_bc_'), 'test.db')}")
+
+from sqlalchemy import delete, insert  # noqa: E402
+
+from db.broadcast import recipients_page  # noqa: E402
+from db.engine import create_db, engine, session_maker  # noqa: E402
+from db.models import MIN_CHAT_ID, User, UserArchive  # noqa: E402
+
+DAY = date(2031, 8, 8)
+CHATS = [-1001234567890, -42, 7, 15, 1234567890]
+
+
+async def recipients(session, limit: int, shard: tuple[int, int] | None = None) -> list[int]:
+    """Обходит получателей постранично, как Broadcaster; чаты других тестов отбрасываются."""
+    result, after = [], MIN_CHAT_ID
+    while page := await recipients_page(session, after, limit, shard):
+        assert len(page) <= limit and page == sorted(page) and page[0] > after
+        result.extend(page)
+        after = page[-1]
+    return [chat_id for chat_id in result if chat_id in CHATS]
+
+
+def test_recipients_include_negative_chats():
+    async def scenario():
+        await create_db()
+        async with session_maker() as session:
+            when = datetime(DAY.year, DAY.month, DAY.day)
+            for number, chat_id in enumerate(CHATS):
+                await session.execute(insert(User).values(
+                    name='test', date=when, day=DAY, time=f'{9 + number:02d}:00', chat_id=chat_id))
+            await session.execute(insert(UserArchive).values(  # Тот же чат в архиве - одно сообщение
+                source_id=1, name='test', date=when, day=DAY, time='09:00', chat_id=-42))
+            await session.commit()
+
+            assert await recipients(session, limit=2) == CHATS
+            sharded = [chat_id for index in range(3) for chat_id in await recipients(session, 2, (index, 3))]
+            assert sorted(sharded) == CHATS
+
+            await session.execute(delete(User).where(User.day == DAY))
+            await session.execute(delete(UserArchive).where(UserArchive.day == DAY))
+            await session.commit()
+        await engine.dispose()
+
+    asyncio.run(scenario())
@@ -0,0 +1,43 @@
+# Запросы к базе по апдейтам (common.metrics): записи через очередь засчитываются апдейту, который их поставил
+import asyncio
+import os
+import tempfile
+from datetime import date, datetime
+
+os.environ.setdefault('DB_LITE', f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(prefix='test_mx_'), 'test.db')}")
+
+from sqlalchemy import delete  # noqa: E402
+
+from common.metrics import Metrics, UpdateRecord, current_update, install_engine_hooks  # noqa: E402
+from db.engine import create_db, engine, session_maker  # noqa: E402
+from db.models import User  # noqa: E402
+from db.orm_query import orm_add_user  # noqa: E402
+from db.write_queue import write_queue  # noqa: E402
+
+DAY = date(2031, 7, 7)
+
+
+def test_queued_writes_are_charged_to_their_update():
+    async def scenario():
+        await create_db()
+        await write_queue.close()  # Очередь запустится в контексте первого апдейта
+        install_engine_hooks(engine, Metrics())
+        first, second = UpdateRecord(), UpdateRecord()
+
+        async def handle(record: UpdateRecord, time: str) -> None:
+            current_update.set(record)  # Как MetricsMiddleware
+            await orm_add_user(name='test', phone='+7(900)123-45-67', date=datetime(DAY.year, DAY.month, DAY.day),
+                               time=time, chat_id=1)
+
+        await asyncio.create_task(handle(first, '10:00'))
+        await asyncio.create_task(handle(second, '11:00'))
+        assert first.queries >= 1  # INSERT записи
+        assert first.queries == second.queries  # Транзакции очереди и чужие записи первому апдейту не достаются
+
+        async with session_maker() as session:
+            await session.execute(delete(User).where(User.day == DAY))
+            await session.commit()
+        await write_queue.close()
+        await engine.dispose()
+
+    asyncio.run(scenario())
@@ -0,0 +1,40 @@
+# Ключ номера телефона (common.phone): по нему заполняется и ищется индексированная колонка user.phone_key
+import pytest
+
+from common.phone import format_phone, phone_key, phone_keys
+
+KEY = 79161234567
+
+
+@pytest.mark.parametrize('phone', [
+    '+79161234567',
+    '+7 916 123-45-67',
+    '+7(916)123-45-67',
+    '89161234567',
+    '8 (916) 123 45 67',
+    '9161234567',
+    '916.123.45.67',
+    'тел.: +7 916 123 45 67',
+    '٨٩١٦١٢٣٤٥٦٧',  # Арабские цифры
+    '+７ ９１６ １２３ ４５ ６７',  # Полноширинные цифры
+])
+def test_phone_key_formats(phone):
+    assert phone_key(phone) == KEY
+    assert phone_keys([phone]) == [KEY]
+
+
+@pytest.mark.parametrize('phone', [None, '', '916123456', '+7 (916) 123-45', 'нет телефона', '²³⁴⁵⁶⁷⁸⁹¹²'])
+def test_phone_key_invalid(phone):
+    assert phone_key(phone) is None
+    assert phone_keys([phone]) == [None]
+
+
+def test_phone_keys_batch_matches_single():
+    phones = ['+79161234567', None, '8 903 000-00-01', '123', '9035556677', '٩٠٣٥٥٥٦٦٧٧', 'a\x00b 9161234567']
+    assert phone_keys(phones) == [phone_key(phone) for phone in phones]
+    assert phone_keys(phones)[:5] == [KEY, None, 79030000001, None, 79035556677]
+
+
+def test_format_phone():
+    assert format_phone(KEY) == '+7(916)123-45-67'
+    assert format_phone(phone_key('8 (903) 000-00-01')) == '+7(903)000-00-01'
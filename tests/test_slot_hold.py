@@ -0,0 +1,96 @@
+# Брони слотов (db.slot_hold): истечение, бронь другого чата, одновременные брони в разных процессах
+from datetime import date
+
+import pytest
+
+from db import slot_hold
+from db.slot_hold import SlotHolds
+from db.slot_index import SLOT_ORDINALS
+
+DAY = date(2031, 6, 2)
+
+
+class Clock:
+    """Заглушка модуля time: monotonic() возвращает now."""
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(slot_hold, 'time', clock)
+    return clock
+
+
+def bit(slot: str) -> int:
+    return 1 << SLOT_ORDINALS[slot]
+
+
+def test_hold_expires_after_ttl(clock):
+    holds = SlotHolds(ttl=10)
+    assert holds.acquire(DAY, '10:00', holder=1)
+    clock.now += 5
+    assert not holds.acquire(DAY, '10:00', holder=2)
+    assert holds.held_mask(DAY, exclude_holder=2) == bit('10:00')
+
+    clock.now += 6
+    assert holds.held_mask(DAY, exclude_holder=2) == 0
+    assert holds.sweep() == 1
+    assert holds.acquire(DAY, '10:00', holder=2)
+    assert not holds.acquire(DAY, '10:00', holder=1)
+
+
+def test_other_chat_cannot_take_held_slot(clock):
+    holds = SlotHolds(ttl=10)
+    assert holds.acquire(DAY, '10:00', holder=1)
+    assert holds.acquire(DAY, '10:00', holder=1)  # Повторная бронь своим чатом продлевает ее
+    assert not holds.acquire(DAY, '10:00', holder=2)
+    assert holds.acquire(DAY, '11:00', holder=2)
+    assert holds.held_mask(DAY) == bit('10:00') | bit('11:00')
+    assert holds.held_mask(DAY, exclude_holder=1) == bit('11:00')
+
+    assert holds.acquire(DAY, '12:00', holder=1)  # У чата одна бронь: прежняя снимается
+    assert holds.held_mask(DAY, exclude_holder=2) == bit('12:00')
+    holds.release(1)
+    assert holds.acquire(DAY, '12:00', holder=2)
+    assert holds.held_mask(DAY) == bit('12:00')
+
+
+@pytest.mark.parametrize('local, remote', [(3, 7), (7, 3)])
+def test_simultaneous_holds_keep_lower_chat(clock, local, remote):
+    first, second = SlotHolds(ttl=10), SlotHolds(ttl=10)
+    first_events, second_events = [], []
+    first.on_change = lambda *event: first_events.append(event)
+    second.on_change = lambda *event: second_events.append(event)
+
+    assert first.acquire(DAY, '10:00', holder=local)
+    assert second.acquire(DAY, '10:00', holder=remote)  # Событие первого процесса еще не дошло
+    for event in first_events:
+        second.apply_change(*event)
+    for event in second_events:
+        first.apply_change(*event)
+
+    winner, loser = min(local, remote), max(local, remote)
+    for holds in (first, second):
+        assert holds.held_mask(DAY, exclude_holder=loser) == bit('10:00')
+        assert holds.held_mask(DAY, exclude_holder=winner) == 0
+        assert not holds.acquire(DAY, '10:00', holder=loser)  # Проигравший получит отказ при подтверждении
+
+
+def test_remote_release_frees_slot(clock):
+    first, second = SlotHolds(ttl=10), SlotHolds(ttl=10)
+    events = []
+    first.on_change = lambda *event: events.append(event)
+    assert first.acquire(DAY, '10:00', holder=5)
+    first.release(5)
+    first.release(5)  # Брони уже нет - событие не отправляется
+    assert [event[0] for event in events] == ['hold', 'release']
+    for event in events:
+        second.apply_change(*event)
+    assert second.held_mask(DAY) == 0
+    assert second.acquire(DAY, '10:00', holder=6)
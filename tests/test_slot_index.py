@@ -0,0 +1,128 @@
+# Индекс слотов (db.slot_index): изменения во время ленивой загрузки, занятые даты месяца, сверка с базой
+import asyncio
+import os
+import tempfile
+from datetime import date, datetime
+
+os.environ.setdefault('DB_LITE', f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(prefix='test_si_'), 'test.db')}")
+
+from sqlalchemy import delete, insert  # noqa: E402
+
+from db.engine import create_db, engine, session_maker  # noqa: E402
+from db.models import User  # noqa: E402
+from db.slot_index import ALL_SLOTS, FULL_MASK, SLOT_ORDINALS, SlotIndex, mask_to_slots  # noqa: E402
+
+DAY = date(2031, 5, 12)
+
+
+class GatedSession:
+    """Заглушка сессии: execute отвечает заданными строками, когда открыт gate."""
+
+    def __init__(self, rows: list) -> None:
+        self.rows = rows
+        self.gate = asyncio.Event()
+        self.calls = 0
+
+    async def execute(self, query):
+        self.calls += 1
+        await self.gate.wait()
+        return list(self.rows)
+
+
+def test_changes_during_load_are_applied():
+    async def scenario():
+        index = SlotIndex()
+        session = GatedSession([('10:00',), ('11:00',)])
+        loading = asyncio.create_task(index.busy_mask(session, DAY))
+        await asyncio.sleep(0)  # Загрузка началась и ждет ответа базы
+        waiting = asyncio.create_task(index.busy_mask(session, DAY))  # Второй обработчик ждет ту же загрузку
+        await asyncio.sleep(0)
+        index.occupy(DAY, '12:00')  # Зафиксировано после снимка базы
+        index.release(DAY, '10:00')
+        session.gate.set()
+
+        mask = await loading
+        assert mask_to_slots(mask) == ['11:00', '12:00']
+        assert await waiting == mask and session.calls == 1
+        index.occupy(DAY, '13:00')  # После загрузки маска меняется сразу
+        assert mask_to_slots(await index.busy_mask(session, DAY)) == ['11:00', '12:00', '13:00']
+
+    asyncio.run(scenario())
+
+
+def test_failed_load_is_retried():
+    async def scenario():
+        index = SlotIndex()
+
+        class BrokenSession:
+            async def execute(self, query):
+                raise RuntimeError('database is locked')
+
+        try:
+            await index.busy_mask(BrokenSession(), DAY)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('ошибка загрузки должна дойти до вызывающего')
+        session = GatedSession([('09:00',)])
+        session.gate.set()
+        assert await index.busy_mask(session, DAY) == 1 << SLOT_ORDINALS['09:00']
+
+    asyncio.run(scenario())
+
+
+def test_full_days_follow_index_changes():
+    async def scenario():
+        index = SlotIndex()
+        other, full = date(2031, 5, 13), date(2031, 5, 14)
+        month = GatedSession([(DAY,)])
+        month.gate.set()
+        assert await index.full_days(month, 2031, 5) == {DAY}
+
+        index.release(DAY, '09:00')  # Маска даты не загружена, но после освобождения дата точно не занята
+        month.rows = []  # Так же изменилась и база
+        assert await index.full_days(month, 2031, 5) == set() and month.calls == 1
+
+        slots = GatedSession([(slot,) for slot in ALL_SLOTS[:-1]])
+        slots.gate.set()
+        assert await index.busy_mask(slots, full) == FULL_MASK & ~(1 << len(ALL_SLOTS) - 1)
+        index.occupy(full, ALL_SLOTS[-1])
+        assert await index.full_days(month, 2031, 5) == {full} and month.calls == 1
+
+        index.occupy(other, '10:00')  # Маска неизвестна - месяц перечитывается из базы
+        assert await index.full_days(month, 2031, 5) == {full} and month.calls == 2
+
+    asyncio.run(scenario())
+
+
+def test_check_consistency_repairs_mismatch():
+    async def scenario():
+        await create_db()
+        index = SlotIndex()
+
+        async def book(time: str) -> None:
+            async with session_maker() as session:
+                await session.execute(insert(User).values(
+                    name='test', phone='+7(900)123-45-67', date=datetime(DAY.year, DAY.month, DAY.day), day=DAY,
+                    time=time))
+                await session.commit()
+
+        await book('10:00')
+        async with session_maker() as session:
+            assert mask_to_slots(await index.busy_mask(session, DAY)) == ['10:00']
+            await book('14:00')  # Запись в обход индекса
+            index.occupy(DAY, '15:00')  # Занятие, которого нет в базе
+            stale = (1 << SLOT_ORDINALS['10:00']) | (1 << SLOT_ORDINALS['15:00'])
+            actual = (1 << SLOT_ORDINALS['10:00']) | (1 << SLOT_ORDINALS['14:00'])
+
+            assert await index.check_consistency(session, repair=False) == {DAY: (stale, actual)}
+            assert await index.busy_mask(session, DAY) == stale
+            assert await index.check_consistency(session) == {DAY: (stale, actual)}
+            assert await index.busy_mask(session, DAY) == actual
+            assert await index.check_consistency(session) == {}
+
+            await session.execute(delete(User).where(User.day == DAY))
+            await session.commit()
+        await engine.dispose()
+
+    asyncio.run(scenario())
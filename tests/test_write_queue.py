@@ -0,0 +1,48 @@
+# Очередь записи (db.write_queue): пачка с конфликтом повторяется с точкой сохранения на каждое намерение
+import asyncio
+import os
+import tempfile
+from datetime import date, datetime
+
+os.environ.setdefault('DB_LITE', f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(prefix='test_wq_'), 'test.db')}")
+
+from sqlalchemy import delete, select  # noqa: E402
+from sqlalchemy.exc import IntegrityError  # noqa: E402
+
+from db.engine import create_db, engine, session_maker  # noqa: E402
+from db.models import User  # noqa: E402
+from db.orm_query import orm_add_user  # noqa: E402
+from db.write_queue import write_queue  # noqa: E402
+
+DAY = date(2031, 3, 3)
+
+
+async def scenario() -> None:
+    await create_db()
+    due = datetime(DAY.year, DAY.month, DAY.day)
+    batches, failed = write_queue.batches, write_queue.failed
+    results = await asyncio.gather(
+        orm_add_user(name='first', phone='+7(900)000-00-01', date=due, time='10:00', chat_id=1),
+        orm_add_user(name='second', phone='+7(900)000-00-02', date=due, time='10:00', chat_id=2),
+        orm_add_user(name='other', phone='+7(900)000-00-03', date=due, time='11:00', chat_id=3),
+        return_exceptions=True)
+
+    assert write_queue.batches == batches + 1  # Одна транзакция: повтор пачки с точками сохранения
+    assert write_queue.failed == failed + 1
+    conflicting, other = results[:2], results[2]
+    assert sum(isinstance(result, IntegrityError) for result in conflicting) == 1
+    assert conflicting.count(None) == 1 and other is None
+
+    async with session_maker() as session:
+        rows = (await session.execute(select(User.time, User.name).where(User.day == DAY).order_by(User.time))).all()
+        assert len(rows) == 2 and rows[0].time == '10:00' and rows[1] == ('11:00', 'other')
+        winner = 'first' if conflicting[0] is None else 'second'
+        assert rows[0].name == winner
+        await session.execute(delete(User).where(User.day == DAY))
+        await session.commit()
+    await write_queue.close()
+    await engine.dispose()
+
+
+def test_conflicting_bookings_in_one_batch():
+    asyncio.run(scenario())
@@ -0,0 +1,118 @@
+# Режим работы бота через вебхук: локальный aiohttp-сервер с ограничением числа одновременно обрабатываемых апдейтов
+import asyncio
+import os
+from typing import Any, Dict
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from logging_config import setup_logging
+
+# Настройка логгирования
+app_logger = setup_logging("webhook", "logs/main.log")
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик запросов вебхука с ограничением числа одновременно выполняющихся хендлеров.
+
+    Telegram получает ответ сразу, а апдейт обрабатывается в фоновой задаче. Пока число задач
+    в работе меньше max_concurrent, ответ отправляется немедленно. Когда лимит исчерпан, ответ
+    задерживается до освобождения места, и Telegram придерживает следующие апдейты у себя.
+
+    :param dispatcher: Диспетчер aiogram.
+    :param bot: Экземпляр бота.
+    :param max_concurrent: Максимальное число одновременно обрабатываемых апдейтов.
+    :param secret_token: Секрет для проверки заголовка X-Telegram-Bot-Api-Secret-Token.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_concurrent: int,
+                 secret_token: str | None = None, **data: Any) -> None:
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True,
+                         secret_token=secret_token, **data)
+        self.max_concurrent = max_concurrent
+        self._slots = asyncio.Semaphore(max_concurrent)
+
+    async def _background_feed_update(self, bot: Bot, update: Dict[str, Any]) -> None:
+        try:
+            await super()._background_feed_update(bot=bot, update=update)
+        except Exception as e:
+            app_logger.error(f'Update: {update} caused error: {e}')
+        finally:
+            self._slots.release()
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        await self._slots.acquire()  # Ждем только если лимит одновременных задач исчерпан
+        try:
+            return await super()._handle_request_background(bot=bot, request=request)
+        except BaseException:
+            self._slots.release()  # Задача не была создана
+            raise
+
+    async def close(self) -> None:
+        """
+        Дожидается завершения фоновых задач и закрывает сессию бота.
+        """
+        if self._background_feed_update_tasks:
+            await asyncio.gather(*self._background_feed_update_tasks, return_exceptions=True)
+        await super().close()
+
+
+def webhook_url(path: str) -> str:
+    """
+    Собирает адрес вебхука из WEBHOOK_URL и пути обработчика.
+
+    :param path: Путь обработчика на локальном сервере.
+    :return: Адрес, который передается Telegram в setWebhook.
+    :raises RuntimeError: Если WEBHOOK_URL не задан.
+    """
+    base = os.getenv('WEBHOOK_URL', '').strip()
+    if not base:
+        raise RuntimeError('Для BOT_MODE=webhook нужно задать WEBHOOK_URL - внешний адрес, '
+                           'по которому Telegram будет отправлять апдейты (например, https://example.com)')
+    return base.rstrip('/') + path
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot) -> None:
+    """
+    Запускает бота в режиме вебхука.
+
+    Параметры берутся из окружения:
+        WEBHOOK_URL - внешний адрес, по которому Telegram отправляет апдейты (обязательно);
+        WEBHOOK_PATH - путь обработчика на локальном сервере (по умолчанию /webhook);
+        WEBHOOK_HOST, WEBHOOK_PORT - адрес и порт локального aiohttp-сервера;
+        WEBHOOK_SECRET - секрет для проверки запросов от Telegram;
+        MAX_CONCURRENT_UPDATES - лимит одновременно обрабатываемых апдейтов;
+        DROP_PENDING_UPDATES - сбрасывать ли накопившиеся апдейты при установке вебхука.
+
+    :param dp: Диспетчер с зарегистрированными роутерами и мидлварями.
+    :param bot: Экземпляр бота.
+    """
+    path = os.getenv('WEBHOOK_PATH', '/webhook')
+    url = webhook_url(path)
+    secret = os.getenv('WEBHOOK_SECRET') or None
+    max_concurrent = int(os.getenv('MAX_CONCURRENT_UPDATES', 100))
+
+    async def set_webhook() -> None:
+        # Накопившиеся апдейты не сбрасываем: Telegram доставит их после перезапуска
+        await bot.set_webhook(url, secret_token=secret, allowed_updates=dp.resolve_used_update_types(),
+                              drop_pending_updates=os.getenv('DROP_PENDING_UPDATES', '0') == '1',
+                              max_connections=min(max_concurrent, 100))
+        app_logger.info(f'Вебхук установлен: {url}, одновременных апдейтов не более {max_concurrent}')
+
+    dp.startup.register(set_webhook)
+
+    app = web.Application()
+    BoundedRequestHandler(dispatcher=dp, bot=bot, max_concurrent=max_concurrent,
+                          secret_token=secret).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=os.getenv('WEBHOOK_HOST', '127.0.0.1'), port=int(os.getenv('WEBHOOK_PORT', 8080)))
+    await site.start()
+    try:
+        await asyncio.Event().wait()  # Сервер работает до остановки процесса
+    finally:
+        await runner.cleanup()